@@ -12,6 +12,7 @@ import scipy.ndimage as ni
 import scipy.interpolate as ip
 import scipy.spatial as spatial
 import scipy.cluster as cluster
+from multiprocessing.pool import ThreadPool
 import corticalmapping.SingleCellAnalysis as sca
 import corticalmapping.core.ImageAnalysis as ia
 import corticalmapping.core.PlottingTools as pt
@@ -80,6 +81,8 @@ PLOTTING_PARAMS = {
     'dire_line_width': 2,
 }
 
+RESULT_STR_COLUMNS = ('date', 'mouse_id', 'plane_n', 'roi_n') # string columns in the roi/axon result tables
+
 
 def get_nt_index(dire_lst, weights=None, is_arc=False, half_span=45., sum_thr=10):
     """
@@ -224,95 +227,146 @@ def get_roi_triplets(nwb_f, overlap_ratio=0.9, size_thr=25.):
     this is to find cells appear in multiple plane, and the results can be passed
     to HighLevel.plot_roi_traces_three_planes to plot and decided if they represent
     same cell.
+
+    the masks of each plane are loaded only once and indexed by their centroids, so that binary overlap is only
+    calculated for the rois close enough to possibly overlap.
+
     :param nwb_f:
     :param overlap_ratio:
     :param size_thr: only rois bigger than this size will be considered, um^2
     :return: list of triplets (tuple of three strings)
     """
 
-    roi_grp0 = nwb_f['processing/rois_and_traces_plane0/ImageSegmentation/imaging_plane']
-    roi_lst0 = roi_grp0['roi_list'].value
-    roi_lst0 = [r for r in roi_lst0 if r[0:4] == 'roi_']
-    roi_lst0_new = []
-    for roi_n0 in roi_lst0:
-        curr_roi = get_roi(nwb_f=nwb_f, plane_n='plane0', roi_n=roi_n0)
-        if curr_roi.get_pixel_area() * 1e12 >= size_thr:
-            roi_lst0_new.append(roi_n0)
-    roi_lst0 = roi_lst0_new
-
-    roi_grp1 = nwb_f['processing/rois_and_traces_plane1/ImageSegmentation/imaging_plane']
-    roi_lst1 = roi_grp1['roi_list'].value
-    roi_lst1 = [r for r in roi_lst1 if r[0:4] == 'roi_']
-    roi_lst1_new = []
-    for roi_n1 in roi_lst1:
-        curr_roi = get_roi(nwb_f=nwb_f, plane_n='plane1', roi_n=roi_n1)
-        if curr_roi.get_pixel_area() * 1e12 >= size_thr:
-            roi_lst1_new.append(roi_n1)
-    roi_lst1 = roi_lst1_new
-
-    roi_grp2 = nwb_f['processing/rois_and_traces_plane2/ImageSegmentation/imaging_plane']
-    roi_lst2 = roi_grp2['roi_list'].value
-    roi_lst2 = [r for r in roi_lst2 if r[0:4] == 'roi_']
-    roi_lst2_new = []
-    for roi_n2 in roi_lst2:
-        curr_roi = get_roi(nwb_f=nwb_f, plane_n='plane2', roi_n=roi_n2)
-        if curr_roi.get_pixel_area() * 1e12 >= size_thr:
-            roi_lst2_new.append(roi_n2)
-    roi_lst2 = roi_lst2_new
+    indices = []
+    for plane_n in ['plane0', 'plane1', 'plane2']:
+        rois = get_rois(nwb_f=nwb_f, plane_n=plane_n)
+        roi_ns = [rn for rn in get_roi_ns(nwb_f=nwb_f, plane_n=plane_n)
+                  if rois[rn].get_pixel_area() * 1e12 >= size_thr]
+        indices.append(RoiSpatialIndex(rois=[rois[rn] for rn in roi_ns], roi_ns=roi_ns))
+    index0, index1, index2 = indices
 
     triplets = []
 
-    while roi_lst1: # start from middle plane
-
-        curr_roi1_n = roi_lst1.pop(0)
+    for curr_roi1_n, curr_roi1 in zip(index1.roi_ns, index1.rois): # start from middle plane
         curr_triplet = [None, curr_roi1_n, None]
 
-        curr_roi1 = get_roi(nwb_f=nwb_f, plane_n='plane1', roi_n=curr_roi1_n)
-        curr_roi1_area = curr_roi1.get_binary_area()
-
-        for curr_roi0_ind, curr_roi0_n in enumerate(roi_lst0):
-            # look through rois in plane0, pick the one overlaps with curr_roi1
-            curr_roi0 = get_roi(nwb_f=nwb_f, plane_n='plane0', roi_n=curr_roi0_n)
-            curr_roi0_area = curr_roi0.get_binary_area()
-            curr_overlap = curr_roi1.binary_overlap(curr_roi0)
-            if float(curr_overlap) / min([curr_roi1_area, curr_roi0_area]) >= overlap_ratio:
-                curr_triplet[0] = roi_lst0.pop(curr_roi0_ind)
-                break
-
-        for curr_roi2_ind, curr_roi2_n in enumerate(roi_lst2):
-            # look through rois in plane0, pick the one overlaps with curr_roi1
-            curr_roi2 = get_roi(nwb_f=nwb_f, plane_n='plane2', roi_n=curr_roi2_n)
-            curr_roi2_area = curr_roi2.get_binary_area()
-            curr_overlap = curr_roi1.binary_overlap(curr_roi2)
-            if float(curr_overlap) / min([curr_roi1_area, curr_roi2_area]) >= overlap_ratio:
-                curr_triplet[2] = roi_lst2.pop(curr_roi2_ind)
-                break
+        # look through rois in plane0 and plane2, pick the ones overlap with curr_roi1
+        curr_triplet[0] = index0.pop_first_overlapping(curr_roi1, overlap_ratio=overlap_ratio)
+        curr_triplet[2] = index2.pop_first_overlapping(curr_roi1, overlap_ratio=overlap_ratio)
 
         print(curr_triplet)
         triplets.append(tuple(curr_triplet))
 
-    while roi_lst2: # next, more superficial plane
+    for curr_roi2_n in index2.get_remaining_roi_ns(): # next, more superficial plane
+        curr_roi2 = index2.remove(curr_roi2_n)
 
-        curr_roi2_n = roi_lst2.pop(0)
-        curr_triplet = [None, None, curr_roi2_n]
+        # look through rois in plane0, pick the one overlaps with curr_roi2
+        curr_roi0_n = index0.pop_first_overlapping(curr_roi2, overlap_ratio=overlap_ratio)
 
-        curr_roi2 = get_roi(nwb_f=nwb_f, plane_n='plane2', roi_n=curr_roi2_n)
-        curr_roi2_area = curr_roi2.get_binary_area()
+        triplets.append((curr_roi0_n, None, curr_roi2_n))
 
-        for curr_roi0_ind, curr_roi0_n in enumerate(roi_lst0):
-            # look through rois in plane0, pick the one overlaps with curr_roi2
-            curr_roi0 = get_roi(nwb_f=nwb_f, plane_n='plane0', roi_n=curr_roi0_n)
-            curr_roi0_area = curr_roi0.get_binary_area()
-            curr_overlap = curr_roi2.binary_overlap(curr_roi0)
-            if float(curr_overlap) / min([curr_roi2_area, curr_roi0_area]) >= overlap_ratio:
-                curr_triplet[0] = roi_lst0.pop(curr_roi0_ind)
-                break
+    triplets = triplets + [(rn, None, None) for rn in index0.get_remaining_roi_ns()] # finally add the rest rois in deep plane
 
-        triplets.append(tuple(curr_triplet))
+    return triplets
 
-    triplets = triplets + [(rn, None, None) for rn in roi_lst0] # finally add the rest rois in deep plane
 
-    return triplets
+class RoiSpatialIndex(object):
+    """
+    a KD-tree index over the centroids of a list of rois in one imaging plane, to quickly find the rois overlapping
+    with a given roi. Rois can be removed from the index, the remaining rois keep their original order.
+
+    two rois can only overlap if the distance between their centroids is no larger than the sum of their radii
+    (the largest distance from a pixel to the centroid), so only rois within this distance are checked by
+    ROI.binary_overlap()
+    """
+
+    def __init__(self, rois, roi_ns):
+        """
+        :param rois: list of corticalmapping.core.ImageAnalysis.ROI objects, all with same dimension
+        :param roi_ns: list of strings, names of the rois, same length as rois
+        """
+
+        if len(rois) != len(roi_ns):
+            raise ValueError('the length of "rois" and "roi_ns" should be the same.')
+
+        self.rois = list(rois)
+        self.roi_ns = list(roi_ns)
+        self._roi_inds = dict([(rn, i) for i, rn in enumerate(self.roi_ns)])
+        self._is_available = np.ones(len(self.rois), dtype=np.bool_)
+
+        self._centers = np.zeros((len(self.rois), 2))
+        self._radii = np.zeros(len(self.rois))
+        for i, roi in enumerate(self.rois):
+            self._centers[i], self._radii[i] = self._get_center_radius(roi)
+
+        if len(self.rois) > 0:
+            self._tree = spatial.cKDTree(self._centers)
+            self._max_radius = np.max(self._radii)
+        else:
+            self._tree = None
+            self._max_radius = 0.
+
+    @staticmethod
+    def _get_center_radius(roi):
+        pixels = np.array(roi.pixels, dtype=np.float64).transpose()
+        center = np.mean(pixels, axis=0)
+        radius = np.max(np.sqrt(np.sum((pixels - center) ** 2, axis=1)))
+        return center, radius
+
+    def get_remaining_roi_ns(self):
+        """
+        :return: list of strings, names of the rois not removed yet, in the original order
+        """
+        return [rn for rn, is_a in zip(self.roi_ns, self._is_available) if is_a]
+
+    def remove(self, roi_n):
+        """
+        remove a roi from the index
+
+        :param roi_n: string, name of the roi
+        :return: the removed roi object
+        """
+        roi_ind = self._roi_inds[roi_n]
+        self._is_available[roi_ind] = False
+        return self.rois[roi_ind]
+
+    def get_candidate_indices(self, roi):
+        """
+        :param roi: corticalmapping.core.ImageAnalysis.ROI object
+        :return: sorted list of indices of remaining rois that may overlap with the input roi
+        """
+
+        if self._tree is None:
+            return []
+
+        center, radius = self._get_center_radius(roi)
+        inds = self._tree.query_ball_point(center, r=radius + self._max_radius + 1e-6)
+        return sorted([i for i in inds if self._is_available[i]])
+
+    def pop_first_overlapping(self, roi, overlap_ratio):
+        """
+        find the first remaining roi (in original order) that overlaps with the input roi, remove it from the index
+        and return its name. The overlap is measured as overlapping pixel number divided by the pixel number of the
+        smaller roi.
+
+        :param roi: corticalmapping.core.ImageAnalysis.ROI object
+        :param overlap_ratio: float, threshold of overlap
+        :return: string, name of the overlapping roi, None if no remaining roi overlaps enough with the input roi
+        """
+
+        if overlap_ratio <= 0: # non-overlapping rois also pass
+            inds = [i for i in range(len(self.rois)) if self._is_available[i]]
+        else:
+            inds = self.get_candidate_indices(roi)
+
+        roi_area = roi.get_binary_area()
+        for i in inds:
+            curr_overlap = roi.binary_overlap(self.rois[i])
+            if float(curr_overlap) / min([roi_area, self.rois[i].get_binary_area()]) >= overlap_ratio:
+                self._is_available[i] = False
+                return self.roi_ns[i]
+
+        return None
 
 
 def get_plane_ns(nwb_f):
@@ -460,6 +514,35 @@ def get_roi(nwb_f, plane_n, roi_n):
     return ia.WeightedROI(mask=mask, pixelSize=pixel_size, pixelSizeUnit=pixel_size_unit)
 
 
+def get_rois(nwb_f, plane_n, roi_ns=None):
+    """
+    load a set of rois of one plane, the pixel size is only read once.
+
+    :param nwb_f: h5py File object of the nwb file
+    :param plane_n:
+    :param roi_ns: list of roi names, if None, all rois of the plane
+    :return: dictionary, {roi_n: core.ImageAnalysis.WeightedROI object}
+    """
+
+    try:
+        pixel_size = nwb_f['acquisition/timeseries/2p_movie_{}/pixel_size'.format(plane_n)].value
+        pixel_size_unit = nwb_f['acquisition/timeseries/2p_movie_{}/pixel_size_unit'.format(plane_n)].value
+    except Exception as e:
+        pixel_size = None
+        pixel_size_unit = None
+
+    if roi_ns is None:
+        roi_ns = get_roi_ns(nwb_f=nwb_f, plane_n=plane_n)
+
+    seg_grp = nwb_f['processing/rois_and_traces_{}/ImageSegmentation/imaging_plane'.format(plane_n)]
+
+    rois = {}
+    for roi_n in roi_ns:
+        mask = seg_grp['{}/img_mask'.format(roi_n)].value
+        rois[roi_n] = ia.WeightedROI(mask=mask, pixelSize=pixel_size, pixelSizeUnit=pixel_size_unit)
+    return rois
+
+
 def get_traces(nwb_f, plane_n, trace_type=ANALYSIS_PARAMS['trace_type']):
 
     traces = nwb_f['processing/rois_and_traces_{}/Fluorescence/{}/data'.format(plane_n, trace_type)].value
@@ -513,6 +596,7 @@ def get_UC_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
         return mask, False
 
     else:
+        intervals = []
         for stim_n in stim_ns:
 
             stim_dur = nwb_f['stimulus/presentation/{}/duration'.format(stim_n)].value
@@ -521,8 +605,9 @@ def get_UC_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
             pd_key = pd_grp.keys()[0]
             stim_onset = pd_grp[pd_key]['pd_onset_ts_sec'][0]
 
-            curr_inds = np.logical_and(ts >= stim_onset, ts <= (stim_onset + stim_dur))
-            mask = np.logical_or(mask, curr_inds)
+            intervals.append([stim_onset, stim_onset + stim_dur])
+
+        mask = ta.TimeIntervals(intervals=ta.merge_intervals(intervals)).is_contain_ts(ts)
 
         if np.sum(mask) < len_thr:
             return mask, False
@@ -553,6 +638,7 @@ def get_DGC_spont_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
         return mask, False
 
     else:
+        intervals = []
         for stim_n in stim_ns:
             midgap_dur = nwb_f['stimulus/presentation/{}/midgap_dur'.format(stim_n)].value
             block_dur = nwb_f['stimulus/presentation/{}/block_dur'.format(stim_n)].value
@@ -562,19 +648,17 @@ def get_DGC_spont_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
 
             for pd_key in pd_keys:
 
-                stim_onsets = pd_grp[pd_key]['pd_onset_ts_sec']
-
-                for stim_onset in stim_onsets:
+                stim_onsets = np.array(pd_grp[pd_key]['pd_onset_ts_sec'].value, dtype=np.float64).flatten()
 
-                    if pd_key[-36:] == 'sf0.00_tf00.0_dire000_con0.00_rad000':  # blank sweeps
+                if pd_key[-36:] == 'sf0.00_tf00.0_dire000_con0.00_rad000':  # blank sweeps
+                    intervals.append(np.array([stim_onsets - 0.5 * midgap_dur,
+                                               stim_onsets + block_dur + midgap_dur]).transpose())
 
-                        curr_inds = np.logical_and(ts >= (stim_onset - 0.5 * midgap_dur),
-                                                   ts <= (stim_onset + block_dur + midgap_dur))
-                        mask = np.logical_or(mask, curr_inds)
+                else: # other sweeps
+                    intervals.append(np.array([stim_onsets - 0.5 * midgap_dur, stim_onsets]).transpose())
 
-                    else: # other sweeps
-                        curr_inds = np.logical_and(ts >= (stim_onset - 0.5 * midgap_dur), ts <= stim_onset)
-                        mask = np.logical_or(mask, curr_inds)
+        intervals = np.concatenate(intervals + [np.zeros((0, 2))], axis=0)
+        mask = ta.TimeIntervals(intervals=ta.merge_intervals(intervals)).is_contain_ts(ts)
 
         if np.sum(mask) < len_thr:
             return mask, False
@@ -604,6 +688,7 @@ def get_LSN_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
         return mask, False
 
     else:
+        intervals = []
         for stim_n in stim_ns:
 
             probe_frame_num = nwb_f['stimulus/presentation/{}/probe_frame_num'.format(stim_n)].value
@@ -630,9 +715,9 @@ def get_LSN_ts_mask(nwb_f, plane_n='plane0', len_thr=100):
 
             stim_offset = stim_offset + probe_dur
 
-            curr_inds = np.logical_and(ts >= stim_onset, ts <= stim_offset)
+            intervals.append([stim_onset, stim_offset])
 
-            mask = np.logical_or(mask, curr_inds)
+        mask = ta.TimeIntervals(intervals=ta.merge_intervals(intervals)).is_contain_ts(ts)
 
         if np.sum(mask) < len_thr:
             return mask, False
@@ -818,15 +903,131 @@ def get_everything_from_roi(nwb_f, plane_n, roi_n, params=ANALYSIS_PARAMS, verbo
 
     roi_ind = int(roi_n[-4:])
 
-    roi_properties = {'date': nwb_f['identifier'].value[0:6],
-                      'mouse_id': nwb_f['identifier'].value[7:14],
+    roi = get_roi(nwb_f=nwb_f, plane_n=plane_n, roi_n=roi_n)
+    pixel_size = nwb_f['acquisition/timeseries/2p_movie_{}/pixel_size'.format(plane_n)].value * 1000000.
+    trace, trace_ts = get_single_trace(nwb_f=nwb_f, plane_n=plane_n, roi_n=roi_n,
+                                       trace_type=params['trace_type'])
+    strf = get_strf(nwb_f=nwb_f, plane_n=plane_n, roi_ind=roi_ind, trace_type='sta_' + params['trace_type'])
+    dgcrm = get_dgcrm(nwb_f=nwb_f, plane_n=plane_n, roi_ind=roi_ind, trace_type='sta_' + params['trace_type'])
+    if dgcrm is not None:
+        dgcrm_grp_key = get_dgcrm_grp_key(nwb_f=nwb_f)
+        dgc_block_dur = nwb_f['stimulus/presentation/{}/block_dur'.format(dgcrm_grp_key[15:])].value
+    else:
+        dgc_block_dur = None
+
+    return _get_everything_from_roi_data(identifier=nwb_f['identifier'].value,
+                                         plane_n=plane_n,
+                                         roi_n=roi_n,
+                                         depth=get_depth(nwb_f=nwb_f, plane_n=plane_n),
+                                         roi=roi,
+                                         pixel_size=pixel_size,
+                                         trace=trace,
+                                         trace_ts=trace_ts,
+                                         strf=strf,
+                                         dgcrm=dgcrm,
+                                         dgc_block_dur=dgc_block_dur,
+                                         params=params,
+                                         verbose=verbose)
+
+
+def iter_everything_from_plane(nwb_f, plane_n, roi_ns=None, params=ANALYSIS_PARAMS, batch_size=500, verbose=False):
+    """
+    plane level batch version of get_everything_from_roi(). For each batch of rois, the roi masks, traces, strfs and
+    drifting grating response matrices are read from the nwb file in one pass, and the results of each roi are then
+    computed from in memory arrays.
+
+    :param nwb_f: h5py.File object
+    :param plane_n:
+    :param roi_ns: list of roi names, if None, all rois in the plane
+    :param params: dictionary, analysis parameters
+    :param batch_size: positive int, number of rois read from the file in one pass
+    :param verbose: bool
+    :return: generator, yields (roi_n, outputs) for each roi in roi_ns, outputs is the same tuple as returned by
+             get_everything_from_roi()
+    """
+
+    if roi_ns is None:
+        roi_ns = get_roi_ns(nwb_f=nwb_f, plane_n=plane_n)
+
+    identifier = nwb_f['identifier'].value
+    depth = get_depth(nwb_f=nwb_f, plane_n=plane_n)
+    pixel_size = nwb_f['acquisition/timeseries/2p_movie_{}/pixel_size'.format(plane_n)].value * 1000000.
+
+    trace_path = 'processing/rois_and_traces_{}/Fluorescence/{}'.format(plane_n, params['trace_type'])
+    trace_ts = nwb_f[trace_path + '/timestamps'].value
+    trace_dset = nwb_f[trace_path + '/data']
+
+    strf_key = get_strf_grp_key(nwb_f=nwb_f)
+    dgcrm_key = get_dgcrm_grp_key(nwb_f=nwb_f)
+    if dgcrm_key is not None:
+        dgc_block_dur = nwb_f['stimulus/presentation/{}/block_dur'.format(dgcrm_key[15:])].value
+    else:
+        dgc_block_dur = None
+
+    batch_size = max(int(batch_size), 1)
+    for batch_start in range(0, len(roi_ns), batch_size):
+        batch_ns = roi_ns[batch_start: batch_start + batch_size]
+        batch_inds = [int(rn[-4:]) for rn in batch_ns]
+
+        rois = get_rois(nwb_f=nwb_f, plane_n=plane_n, roi_ns=batch_ns)
+
+        batch_traces = sca._read_roi_rows(trace_dset, batch_inds)
+
+        if strf_key is not None:
+            strfs = sca.get_strfs_from_nwb(h5_grp=nwb_f['analysis/{}/{}'.format(strf_key, plane_n)],
+                                           roi_inds=batch_inds, trace_type='sta_' + params['trace_type'])
+        else:
+            strfs = [None] * len(batch_ns)
+
+        if dgcrm_key is not None:
+            dgcrms = sca.get_dgc_response_matrices_from_nwb(h5_grp=nwb_f['analysis/{}/{}'.format(dgcrm_key, plane_n)],
+                                                            roi_inds=batch_inds,
+                                                            trace_type='sta_' + params['trace_type'])
+        else:
+            dgcrms = [None] * len(batch_ns)
+
+        for roi_n, trace, strf, dgcrm in zip(batch_ns, batch_traces, strfs, dgcrms):
+            yield roi_n, _get_everything_from_roi_data(identifier=identifier,
+                                                       plane_n=plane_n,
+                                                       roi_n=roi_n,
+                                                       depth=depth,
+                                                       roi=rois[roi_n],
+                                                       pixel_size=pixel_size,
+                                                       trace=trace,
+                                                       trace_ts=trace_ts,
+                                                       strf=strf,
+                                                       dgcrm=dgcrm,
+                                                       dgc_block_dur=dgc_block_dur,
+                                                       params=params,
+                                                       verbose=verbose)
+
+
+def _get_everything_from_roi_data(identifier, plane_n, roi_n, depth, roi, pixel_size, trace, trace_ts, strf, dgcrm,
+                                  dgc_block_dur, params=ANALYSIS_PARAMS, verbose=False):
+    """
+    compute everything of one roi from data already loaded from the nwb file.
+
+    :param identifier: str, identifier of the nwb file
+    :param plane_n:
+    :param roi_n:
+    :param depth: float, imaging depth in microns
+    :param roi: core.ImageAnalysis.WeightedROI object
+    :param pixel_size: array of two floats, pixel size in microns
+    :param trace: 1d array, trace of the roi
+    :param trace_ts: 1d array, timestamps of the trace
+    :param strf: SingleCellAnalysis.SpatialTemporalReceptiveField object or None
+    :param dgcrm: SingleCellAnalysis.DriftingGratingResponseMatrix object or None
+    :param dgc_block_dur: float or None, duration of drifting grating display
+    :return: same as get_everything_from_roi()
+    """
+
+    roi_properties = {'date': identifier[0:6],
+                      'mouse_id': identifier[7:14],
                       'plane_n': plane_n,
                       'roi_n': roi_n,
-                      'depth': get_depth(nwb_f=nwb_f, plane_n=plane_n)}
+                      'depth': depth}
 
     # get roi properties
-    roi = get_roi(nwb_f=nwb_f, plane_n=plane_n, roi_n=roi_n)
-    pixel_size = nwb_f['acquisition/timeseries/2p_movie_{}/pixel_size'.format(plane_n)].value * 1000000.
     roi_area = roi.get_binary_area() * pixel_size[0] * pixel_size[1]
     roi_center_row, roi_center_col = roi.get_weighted_center()
     roi_properties.update({'roi_area': roi_area,
@@ -834,8 +1035,6 @@ def get_everything_from_roi(nwb_f, plane_n, roi_n, params=ANALYSIS_PARAMS, verbo
                            'roi_center_col': roi_center_col})
 
     # get skewness
-    trace, trace_ts = get_single_trace(nwb_f=nwb_f, plane_n=plane_n, roi_n=roi_n,
-                                       trace_type=params['trace_type'])
     skew_raw, skew_fil = sca.get_skewness(trace=trace, ts=trace_ts,
                                           filter_length=params['filter_length_skew_sec'])
     roi_properties.update({'skew_raw': skew_raw,
@@ -846,7 +1045,6 @@ def get_everything_from_roi(nwb_f, plane_n, roi_n, params=ANALYSIS_PARAMS, verbo
     else:
         add_to_trace = 0.
 
-    strf = get_strf(nwb_f=nwb_f, plane_n=plane_n, roi_ind=roi_ind, trace_type='sta_' + params['trace_type'])
     if strf is not None:
 
         # get strf properties
@@ -1004,11 +1202,7 @@ def get_everything_from_roi(nwb_f, plane_n, roi_n, params=ANALYSIS_PARAMS, verbo
 
 
     # analyze response to drifring grating
-    dgcrm = get_dgcrm(nwb_f=nwb_f, plane_n=plane_n, roi_ind=roi_ind, trace_type='sta_' + params['trace_type'])
     if dgcrm is not None:
-        dgcrm_grp_key = get_dgcrm_grp_key(nwb_f=nwb_f)
-        dgc_block_dur = nwb_f['stimulus/presentation/{}/block_dur'.format(dgcrm_grp_key[15:])].value
-        # print('block duration: {}'.format(block_dur))
 
         # get df statistics ============================================================================================
         _ = dgcrm.get_df_response_table(baseline_win=params['baseline_window_dgc'],
@@ -3200,6 +3394,201 @@ def axon_page_report(nwb_f, clu_f, plane_n, axon_n, params=ANALYSIS_PARAMS, plot
     return f
 
 
+def get_result_schema(df, columns=None, str_columns=RESULT_STR_COLUMNS):
+    """
+    typed schema of a roi/axon result table inferred from the column dtypes of df. columns in str_columns and object
+    columns holding only strings are saved as strings, bool, int and float columns keep their dtypes, all other
+    columns (e.g. object columns mixing numbers and NaN) are saved as 64-bit floats. columns not in df are 64-bit
+    floats so they can be filled with NaN.
+
+    :param df: pandas.DataFrame, result table
+    :param columns: list of column names, if None, df.columns
+    :param str_columns: list of column names that are strings
+    :return: list of (column name, dtype) tuples
+    """
+
+    if columns is None:
+        columns = df.columns
+
+    schema = []
+    for col in columns:
+        if col in str_columns:
+            dtype = 'S'
+        elif col not in df.columns:
+            dtype = 'f8'
+        elif df[col].dtype.kind in 'biuf':
+            dtype = df[col].dtype.str
+        elif df[col].dtype.kind == 'O' and len(df) > 0 and all([isinstance(v, str) for v in df[col]]):
+            dtype = 'S'
+        else:
+            dtype = 'f8'
+        schema.append((col, dtype))
+    return schema
+
+
+def write_plane_results(store_path, df, date, mouse_id, plane_n, schema=None, is_overwrite=False):
+    """
+    append the result table of one plane to a columnar hdf5 result store. Each plane is saved in group
+    '/<date>/<mouse_id>/<plane_n>' with one dataset per column, so reading a subset of planes or columns does not
+    need to parse the whole store.
+
+    :param store_path: str, path to the .hdf5 store, will be created if not exists
+    :param df: pandas.DataFrame, result table of the plane, one row for each roi (or axon)
+    :param date: str
+    :param mouse_id: str
+    :param plane_n: str
+    :param schema: list of (column name, dtype) tuples, if None, get_result_schema(df). columns in the schema but
+                   not in df are filled with NaN (or empty strings), so they should be floats (or strings)
+    :param is_overwrite: bool, if False, raise IOError if the plane already exists in the store
+    """
+
+    if schema is None:
+        schema = get_result_schema(df)
+
+    grp_n = '{}/{}/{}'.format(date, mouse_id, plane_n)
+
+    with h5py.File(store_path, 'a') as store_f:
+
+        if grp_n in store_f:
+            if is_overwrite:
+                del store_f[grp_n]
+            else:
+                raise IOError('plane "{}" already exists in result store: {}'.format(grp_n, store_path))
+
+        plane_grp = store_f.create_group(grp_n)
+        plane_grp.attrs['columns'] = np.array([str(col) for col, _ in schema], dtype='S')
+
+        for col, dtype in schema:
+            if col in df.columns:
+                values = df[col].values
+            elif dtype == 'S':
+                values = [''] * len(df)
+            elif np.dtype(dtype).kind == 'f':
+                values = np.full(len(df), np.nan)
+            else:
+                raise ValueError('column "{}" is not in the dataframe and cannot be filled with NaN as {}.'
+                                 .format(col, dtype))
+
+            if dtype == 'S':
+                data = np.array([str(v) for v in values], dtype='S')
+            else:
+                data = np.array(values, dtype=dtype)
+
+            plane_grp.create_dataset(col, data=data)
+
+
+def get_result_planes(store_path, dates=None, mouse_ids=None, plane_ns=None):
+    """
+    :param store_path: str, path to the .hdf5 result store
+    :param dates: list of str, if None, all dates
+    :param mouse_ids: list of str, if None, all mice
+    :param plane_ns: list of str, if None, all planes
+    :return: sorted list of (date, mouse_id, plane_n) tuples in the store that match the filters
+    """
+
+    planes = []
+    with h5py.File(store_path, 'r') as store_f:
+        for date in store_f.keys():
+            if dates is not None and date not in dates:
+                continue
+            for mouse_id in store_f[date].keys():
+                if mouse_ids is not None and mouse_id not in mouse_ids:
+                    continue
+                for plane_n in store_f['{}/{}'.format(date, mouse_id)].keys():
+                    if plane_ns is None or plane_n in plane_ns:
+                        planes.append((date, mouse_id, plane_n))
+    planes.sort()
+    return planes
+
+
+def read_results(store_path, dates=None, mouse_ids=None, plane_ns=None, columns=None):
+    """
+    read result tables from a columnar hdf5 result store. only the planes that match the filters and the requested
+    columns are read.
+
+    :param store_path: str, path to the .hdf5 result store
+    :param dates: list of str, if None, all dates
+    :param mouse_ids: list of str, if None, all mice
+    :param plane_ns: list of str, if None, all planes
+    :param columns: list of column names, if None, all columns
+    :return: pandas.DataFrame, concatenated results of all matching planes with a fresh index
+    """
+
+    planes = get_result_planes(store_path=store_path, dates=dates, mouse_ids=mouse_ids, plane_ns=plane_ns)
+
+    dfs = []
+    with h5py.File(store_path, 'r') as store_f:
+        for plane in planes:
+            plane_grp = store_f['/'.join(plane)]
+            plane_cols = list(plane_grp.attrs['columns'].astype(str))
+            if columns is not None:
+                plane_cols = [c for c in columns if c in plane_cols]
+
+            data = {}
+            for col in plane_cols:
+                values = plane_grp[col][()]
+                if values.dtype.kind == 'S':
+                    values = values.astype(str)
+                data[col] = values
+            dfs.append(pd.DataFrame(data, columns=plane_cols))
+
+    if len(dfs) == 0:
+        return pd.DataFrame([], columns=columns)
+
+    return pd.concat(dfs, axis=0, ignore_index=True, sort=False)
+
+
+def _get_masked_union_corr_tile(traces_i, masks_i, masked_i, traces_j, masks_j, masked_j, len_thr):
+    """
+    Pearson's correlation coefficients between two sets of traces, each pair is calculated over the union of their
+    event masks. Over the union mask u = m_i + m_j - m_i * m_j, every sum needed by Pearson's r can be written as
+    matrix products of traces (x), masks (m) and masked traces (x * m).
+
+    :param traces_i: p x m array, traces of the first set
+    :param masks_i: p x m array, float (0. or 1.), event masks of the first set
+    :param masked_i: p x m array, traces_i * masks_i
+    :param traces_j: q x m array, traces of the second set
+    :param masks_j: q x m array, float (0. or 1.), event masks of the second set
+    :param masked_j: q x m array, traces_j * masks_j
+    :param len_thr: float, minimum length of the union mask, pairs with shorter union will have 0 correlation
+    :return: p x q array, correlation coefficients
+    """
+
+    n_i = np.sum(masks_i, axis=1)[:, None]
+    n_j = np.sum(masks_j, axis=1)[None, :]
+    n = n_i + n_j - np.dot(masks_i, masks_j.T)
+
+    # sums of x_i, x_i^2 over the union
+    sum_i = np.sum(masked_i, axis=1)[:, None] + np.dot(traces_i, masks_j.T) - np.dot(masked_i, masks_j.T)
+    sq_i = masked_i * traces_i
+    sum_sq_i = np.sum(sq_i, axis=1)[:, None] + np.dot(traces_i ** 2, masks_j.T) - np.dot(sq_i, masks_j.T)
+    del sq_i
+
+    # sums of x_j, x_j^2 over the union
+    sum_j = np.sum(masked_j, axis=1)[None, :] + np.dot(masks_i, traces_j.T) - np.dot(masks_i, masked_j.T)
+    sq_j = masked_j * traces_j
+    sum_sq_j = np.sum(sq_j, axis=1)[None, :] + np.dot(masks_i, (traces_j ** 2).T) - np.dot(masks_i, sq_j.T)
+    del sq_j
+
+    # sum of x_i * x_j over the union
+    sum_ij = np.dot(masked_i, traces_j.T) + np.dot(traces_i, masked_j.T) - np.dot(masked_i, masked_j.T)
+
+    cov = n * sum_ij - sum_i * sum_j
+    var_i = n * sum_sq_i - sum_i ** 2
+    var_j = n * sum_sq_j - sum_j ** 2
+
+    # traces constant over the union give nan, as np.corrcoef does
+    eps = 1e-10
+    var_i[var_i <= eps * n * sum_sq_i] = np.nan
+    var_j[var_j <= eps * n * sum_sq_j] = np.nan
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.clip(cov / np.sqrt(var_i * var_j), -1., 1.)
+
+    corr[n < len_thr] = 0.
+    return corr
+
+
 class BoutonClassifier(object):
 
     def __init__(self, skew_filter_sigma=5., skew_thr=0.6, lowpass_sigma=0.1, detrend_sigma=3.,
@@ -3332,42 +3721,74 @@ class BoutonClassifier(object):
 
         return np.array(traces_res), roi_ns_res, np.array(event_masks)
 
-    def get_correlation_coefficient_matrix(self, traces, event_masks, sample_dur, is_plot=False):
+    def get_correlation_coefficient_matrix(self, traces, event_masks, sample_dur, is_plot=False, block_size=500,
+                                           worker_num=1):
         """
         calculate event based correcation coefficient matrix of a set of rois.
         ideally, the traces and event_masks will be the output of self.filter_traces() method.
 
+        for each pair of rois, the correlation coefficient is calculated on the union of their event masks. instead
+        of looping through pairs, the sums needed by Pearson's r over the union masks are assembled from matrix
+        products of the (standardized) traces and the event mask matrix. the matrix is computed in square tiles of
+        block_size x block_size rois, so the memory usage is bounded by roughly 10 x block_size x block_size floats
+        on top of the input arrays.
+
         :param traces: l x m array, l: number of rois, m: number of time points
         :param event_masks: array same size of traces, dtype=np.bool, masks of event for each trace.
         :param sample_dur:  float, duration of each sample in second.
         :param is_plot: bool
+        :param block_size: positive int, number of rois in each tile
+        :param worker_num: positive int, number of threads to compute tiles in parallel
         :return mat_corr: l x l array, correlation coefficient matrix
         """
 
+        traces = np.array(traces, dtype=np.float64)
+        masks = np.array(event_masks, dtype=np.bool_)
+
+        if traces.shape != masks.shape:
+            raise ValueError('the shape of "traces" and "event_masks" should be the same.')
+
         roi_num_res = traces.shape[0]
         mat_corr = np.zeros((roi_num_res, roi_num_res))
-        np.fill_diagonal(mat_corr, 1.)
-
-        for i in range(0, roi_num_res - 1):
-            for j in range(i + 1, roi_num_res):
-                trace_i = traces[i]
-                event_mask_i = event_masks[i]
 
-                trace_j = traces[j]
-                event_mask_j = event_masks[j]
+        if roi_num_res > 1:
+
+            # Pearson's r is invariant to per-roi offset and scaling, standardize for numerical stability
+            traces = traces - np.mean(traces, axis=1, keepdims=True)
+            stds = np.std(traces, axis=1, keepdims=True)
+            stds[stds == 0] = 1.
+            traces = traces / stds
+
+            masks_f = masks.astype(np.float64)
+            masked = traces * masks_f
+            len_thr = self.corr_len_thr // sample_dur
+
+            block_size = max(int(block_size), 1)
+            starts = range(0, roi_num_res, block_size)
+            tiles = [(i, j) for i in starts for j in starts if j >= i]
+
+            def _compute_tile(tile):
+                i0, j0 = tile
+                si = slice(i0, min(i0 + block_size, roi_num_res))
+                sj = slice(j0, min(j0 + block_size, roi_num_res))
+                mat_corr[si, sj] = _get_masked_union_corr_tile(traces[si], masks_f[si], masked[si],
+                                                               traces[sj], masks_f[sj], masked[sj], len_thr)
+
+            if worker_num > 1 and len(tiles) > 1:
+                pool = ThreadPool(int(worker_num))
+                try:
+                    pool.map(_compute_tile, tiles)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for tile in tiles:
+                    _compute_tile(tile)
 
-                res_ind_merge = np.logical_or(event_mask_i, event_mask_j)
-                #         print("({}, {}), trace_length: {}".format(i, j, np.sum(res_ind_merge)))
+            mat_corr = np.triu(mat_corr, k=1)
+            mat_corr = mat_corr + mat_corr.T
 
-                if np.sum(res_ind_merge) < self.corr_len_thr // sample_dur:
-                    mat_corr[i, j] = 0
-                    mat_corr[j, i] = 0
-                else:
-                    trace_i = trace_i[res_ind_merge]
-                    trace_j = trace_j[res_ind_merge]
-                    coeff = np.corrcoef(np.array([trace_i, trace_j]), rowvar=True)
-                    mat_corr[i, j] = coeff[1, 0]
-                    mat_corr[j, i] = coeff[1, 0]
+        np.fill_diagonal(mat_corr, 1.)
 
         if is_plot:
             f = plt.figure(figsize=(8, 6))
@@ -4028,20 +4449,6 @@ class BoutonClassifier(object):
         :return:
         """
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         stim_ns = nwb_f['analysis/photodiode_onsets'].keys()
         lsn_stim_n = [n for n in stim_ns if 'LocallySparseNoiseRetinotopicMapping' in n]
         if len(lsn_stim_n) == 0:
@@ -4096,8 +4503,8 @@ class BoutonClassifier(object):
             curr_probe_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
             for trace_n, trace in traces.items():
-                sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets, frame_start=frame_start,
-                              frame_end=frame_end)
+                sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets,
+                                                frame_start=frame_start, frame_end=frame_end)
                 # curr_probe_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
                 curr_probe_grp.create_dataset('sta_' + trace_n, data=sta)
 
@@ -4115,20 +4522,6 @@ class BoutonClassifier(object):
         :return:
         """
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         if t_win[0] >= t_win[1]:
             raise ValueError('time window should be from early time to late time.')
 
@@ -4182,8 +4575,8 @@ class BoutonClassifier(object):
             curr_grating_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
             for trace_n, trace in traces.items():
-                sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets, frame_start=frame_start,
-                              frame_end=frame_end)
+                sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets,
+                                                frame_start=frame_start, frame_end=frame_end)
                 # curr_grating_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
                 curr_grating_grp.create_dataset('sta_' + trace_n, data=sta)
 
@@ -4533,20 +4926,6 @@ class BoutonClassifier(object):
         :return:
         """
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         stim_ns = nwb_f['analysis/photodiode_onsets'].keys()
         lsn_stim_n = [n for n in stim_ns if 'LocallySparseNoiseRetinotopicMapping' in n]
         if len(lsn_stim_n) == 0:
@@ -4603,8 +4982,8 @@ class BoutonClassifier(object):
             curr_probe_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
             for trace_n, trace in traces.items():
-                sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets, frame_start=frame_start,
-                              frame_end=frame_end)
+                sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets,
+                                                frame_start=frame_start, frame_end=frame_end)
                 # curr_probe_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
                 curr_probe_grp.create_dataset('sta_' + trace_n, data=sta)
 
@@ -4622,20 +5001,6 @@ class BoutonClassifier(object):
         :return:
         """
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         if t_win[0] >= t_win[1]:
             raise ValueError('time window should be from early time to late time.')
 
@@ -4691,8 +5056,8 @@ class BoutonClassifier(object):
             curr_grating_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
             for trace_n, trace in traces.items():
-                sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets, frame_start=frame_start,
-                              frame_end=frame_end)
+                sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets,
+                                                frame_start=frame_start, frame_end=frame_end)
                 # curr_grating_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
                 curr_grating_grp.create_dataset('sta_' + trace_n, data=sta)
 
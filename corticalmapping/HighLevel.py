@@ -5,6 +5,7 @@ import json
 import h5py
 import numpy as np
 import itertools
+import multiprocessing
 import pandas as pd
 import scipy.stats as stats
 import scipy.ndimage as ni
@@ -77,10 +78,72 @@ def translateMovieByVasculature(mov, parameterPath, matchingDecimation=2, refere
     return movT
 
 
+def _translateMovieChunk(params):
+    '''
+    worker function of translateHugeMovieByVasculature, translate one frame range of the input movie and write it into
+    the preallocated output movie
+
+    :return: (indStart, indEnd) of the translated frame range
+    '''
+
+    inputPath, outputPath, parameterPath, matchingDecimation, referenceDecimation, indStart, indEnd = params
+
+    inputMov = np.load(inputPath, mmap_mode='r')
+    outputMov = np.load(outputPath, mmap_mode='r+')
+
+    currMovT = translateMovieByVasculature(np.array(inputMov[indStart:indEnd, :, :]), parameterPath=parameterPath,
+                                           matchingDecimation=matchingDecimation,
+                                           referenceDecimation=referenceDecimation, verbose=False)
+    if len(currMovT.shape) == 2:
+        currMovT = currMovT.reshape((1, currMovT.shape[0], currMovT.shape[1]))
+
+    outputMov[indStart:indEnd, :, :] = currMovT.astype(outputMov.dtype)
+    outputMov.flush()
+    del inputMov, outputMov
+
+    return indStart, indEnd
+
+
+def _getTranslationFingerprint(inputPath, parameterPath, outputDtype, matchingDecimation, referenceDecimation,
+                               chunkLength):
+    '''
+    one line summary of everything that decides the content of the output of translateHugeMovieByVasculature, saved as
+    the first line of the progress file. a previous run is only resumed if its fingerprint matches.
+
+    :return: str
+    '''
+
+    with open(parameterPath) as f:
+        matchingParams = json.load(f)
+
+    inputStat = os.stat(inputPath)
+
+    fingerprint = {'inputPath': os.path.abspath(inputPath),
+                   'inputMtime': inputStat.st_mtime,
+                   'inputSize': inputStat.st_size,
+                   'matchingParams': matchingParams,
+                   'outputDtype': np.dtype(outputDtype).str,
+                   'matchingDecimation': float(matchingDecimation),
+                   'referenceDecimation': float(referenceDecimation),
+                   'chunkLength': int(chunkLength)}
+
+    return json.dumps(fingerprint, sort_keys=True)
+
+
 def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, outputDtype=None, matchingDecimation=2,
-                                    referenceDecimation=2, chunkLength=100, verbose=True):
+                                    referenceDecimation=2, chunkLength=100, processNum=1, isResume=True,
+                                    verbose=True):
     '''
-    translate huge .npy matrix with alignment parameters into another huge .npy matrix without loading everything into memory
+    translate huge .npy matrix with alignment parameters into another huge .npy matrix without loading everything into
+    memory. the output .npy file is preallocated as a memory map, each chunk of frames is translated and written into
+    its own frame range, so chunks can be translated by multiple processes in parallel.
+
+    the finished frame ranges are recorded in a progress file (outputPath + '.progress'), which is deleted after all
+    frames are translated. if the job is interrupted, running it again with isResume=True will only translate the
+    unfinished chunks. the progress file starts with a fingerprint of the input path, its modification time and size,
+    the translation parameters (offsets, zoom, rotation ...), the decimations, chunkLength and outputDtype. if any of
+    them changed, the previous output is discarded and everything is translated again.
+
     :param inputPath: path of input movie (.npy file)
     :param outputPath: path of output movie (.npy file)
     :param outputDtype: data type of output movie
@@ -88,12 +151,15 @@ def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, output
     :param matchingDecimation: decimation factor on the matching side (usually 2)
     :param referenceDecimation: decimation factor on the reference side (if using standard retinotopic mapping pkl file, should be 2)
     :param chunkLength: frame number of chunks
-    :return:
+    :param processNum: positive int, number of worker processes
+    :param isResume: bool, if True and an unfinished output from previous run exists, continue from where it stopped
+    :return: path of output movie
     '''
 
     chunkLength = int(chunkLength)
+    if processNum < 1: raise ValueError, 'processNum should be a positive integer!'
 
-    inputMov = BinarySlicer(inputPath)
+    inputMov = np.load(inputPath, mmap_mode='r')
 
     if outputDtype is None: outputDtype = inputMov.dtype.str
 
@@ -102,6 +168,7 @@ def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, output
     frameNum = inputMov.shape[0]
 
     if outputPath[-4:] != '.npy': outputPath += '.npy'
+    progressPath = outputPath + '.progress'
 
     if verbose: print '\nInput movie shape:', inputMov.shape
 
@@ -114,30 +181,79 @@ def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, output
         if verbose: print 'Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
             chunkLength) + ' frame(s)' + ' + ' + str(frameNum % chunkLength) + ' frame(s)'
 
-    frameT1 = translateMovieByVasculature(inputMov[0, :, :], parameterPath=parameterPath,
+    frameT1 = translateMovieByVasculature(np.array(inputMov[0, :, :]), parameterPath=parameterPath,
                                           matchingDecimation=matchingDecimation,
                                           referenceDecimation=referenceDecimation, verbose=False)
-    plt.imshow(frameT1, cmap='gray')
-    plt.show()
+    outputShape = (frameNum, frameT1.shape[0], frameT1.shape[1])
+    del inputMov
+
+    if verbose: print 'Output movie shape:', outputShape, '\n'
+
+    fingerprint = _getTranslationFingerprint(inputPath=inputPath, parameterPath=parameterPath,
+                                             outputDtype=outputDtype, matchingDecimation=matchingDecimation,
+                                             referenceDecimation=referenceDecimation, chunkLength=chunkLength)
+
+    # check if there is an unfinished output to resume
+    finishedChunks = set()
+    if isResume and os.path.isfile(outputPath) and os.path.isfile(progressPath):
+        with open(progressPath, 'r') as f:
+            isMatched = f.readline().rstrip('\n') == fingerprint
+        if not isMatched:
+            if verbose: print 'Parameters changed since previous run, translating from the beginning.'
+        else:
+            try:
+                outputMov = np.load(outputPath, mmap_mode='r')
+                isMatched = (outputMov.shape == outputShape) and (outputMov.dtype == np.dtype(outputDtype))
+                del outputMov
+            except (IOError, ValueError):
+                isMatched = False
+
+        if isMatched:
+            with open(progressPath, 'r') as f:
+                f.readline()
+                for line in f:
+                    currChunk = line.split()
+                    if len(currChunk) == 2:
+                        finishedChunks.add((int(currChunk[0]), int(currChunk[1])))
+            if verbose: print 'Resuming from previous run, ' + str(len(finishedChunks)) + ' chunk(s) already translated.'
+
+    if not finishedChunks:
+        outputMov = np.lib.format.open_memmap(outputPath, mode='w+', dtype=outputDtype, shape=outputShape)
+        del outputMov
+        with open(progressPath, 'w') as f:
+            f.write(fingerprint + '\n')
+
+    chunkParams = []
+    for i in range(chunkNum):
+        indStart = i * chunkLength
+        indEnd = min((i + 1) * chunkLength, frameNum)
+        if (indStart, indEnd) not in finishedChunks:
+            chunkParams.append((inputPath, outputPath, parameterPath, matchingDecimation, referenceDecimation,
+                                indStart, indEnd))
+
+    if processNum == 1:
+        chunkResults = itertools.imap(_translateMovieChunk, chunkParams)
+        pool = None
+    else:
+        if verbose: print 'Translating with ' + str(processNum) + ' processes.'
+        pool = multiprocessing.Pool(processNum)
+        chunkResults = pool.imap_unordered(_translateMovieChunk, chunkParams)
 
-    if verbose: print 'Output movie shape:', (frameNum, frameT1.shape[0], frameT1.shape[1]), '\n'
+    try:
+        with open(progressPath, 'a') as f:
+            for n, (indStart, indEnd) in enumerate(chunkResults):
+                f.write(str(indStart) + ' ' + str(indEnd) + '\n')
+                f.flush()
+                if verbose: print 'Translated frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
+                    (n + 1 + len(finishedChunks)) * 100. / chunkNum) + '%'
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    with open(outputPath, 'wb') as f:
-        np.lib.format.write_array_header_1_0(f, {'descr': outputDtype, 'fortran_order': False,
-                                                 'shape': (frameNum, frameT1.shape[0], frameT1.shape[1])})
+    os.remove(progressPath)
 
-        for i in range(chunkNum):
-            indStart = i * chunkLength
-            indEnd = (i + 1) * chunkLength
-            if indEnd > frameNum: indEnd = frameNum
-            currMov = inputMov[indStart:indEnd, :, :]
-            if verbose: print 'Translating frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
-                i * 100. / chunkNum) + '%'
-            currMovT = translateMovieByVasculature(currMov, parameterPath=parameterPath,
-                                                   matchingDecimation=matchingDecimation,
-                                                   referenceDecimation=referenceDecimation, verbose=False)
-            currMovT = currMovT.astype(outputDtype)
-            currMovT.reshape((np.prod(currMovT.shape),)).tofile(f)
+    return outputPath
 
 
 def segmentPhotodiodeSignal(pd, digitizeThr=0.9, filterSize=0.01, segmentThr=0.02, Fs=10000.,
@@ -523,6 +639,57 @@ def getAverageDfMovie(movPath, frameTS, onsetTimes, chunkDur, startTime=0., temp
     return aveMov, aveMovNor
 
 
+def getAverageDfMovies(movPath, frameTS, onsetTimes, chunkDurs, startTimes, temporalDownSampleRate=1,
+                       is_load_all=False):
+    '''
+    same as getAverageDfMovie but for several groups of sweeps (i.e. sweep directions), the movie is read only once
+    for all groups by corticalmapping.core.ImageAnalysis.get_average_movies function
+
+    :param movPath: path to the image movie
+    :param frameTS: the timestamps for each frame of the raw movie
+    :param onsetTimes: dictionary, {group key: time stamps of onset of each sweep}
+    :param chunkDurs: dictionary, {group key: duration of each chunk}
+    :param startTimes: dictionary, {group key: chunck start time relative to the sweep onset time (length of pre gray
+                       period)}
+    :param temporalDownSampleRate: decimation factor in time after recording
+    :return: aveMovs, aveMovNors, dictionaries of averageed movies and normalized averaged movies of each group
+    '''
+
+    if temporalDownSampleRate == 1:
+        frameTS_real = frameTS
+    elif temporalDownSampleRate > 1:
+        frameTS_real = frameTS[::temporalDownSampleRate]
+    else:
+        raise ValueError, 'temporal downsampling rate can not be less than 1!'
+
+    if is_load_all:
+        if movPath[-4:] == '.npy':
+            try:
+                mov = np.load(movPath)
+            except ValueError:
+                print 'Cannot load the entire npy file into memroy. Trying BinarySlicer...'
+                mov = BinarySlicer(movPath)
+        elif movPath[-4:] == '.tif':
+            mov = tf.imread(movPath)
+        else:
+            mov, _, _ = ft.importRawJCamF(movPath)
+    else:
+        mov = BinarySlicer(movPath)
+
+    shiftedOnsetTimes = dict([(key, np.asarray(onsets) + startTimes[key]) for key, onsets in onsetTimes.items()])
+    aveMovs, _ = ia.get_average_movies(mov, frameTS_real, shiftedOnsetTimes, chunkDurs)
+
+    meanFrameDur = np.mean(np.diff(frameTS_real))
+
+    aveMovNors = {}
+    for key, aveMov in aveMovs.items():
+        baselineFrameDur = int(abs(startTimes[key]) / meanFrameDur)
+        baselinePicture = np.mean((aveMov[0:baselineFrameDur, :, :]).astype(np.float32), axis=0)
+        _, aveMovNors[key], _ = ia.normalize_movie(aveMov, baselinePicture)
+
+    return aveMovs, aveMovNors
+
+
 def getAverageDfMovieFromH5Dataset(dset, frameTS, onsetTimes, chunkDur, startTime=0., temporalDownSampleRate=1):
     '''
     :param dset: hdf5 dataset object, 3-d matrix, zyx
@@ -585,9 +752,10 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
     else:
         raise LookupError, 'FFTmode should be either "peak" or "valley"!'
 
-    for dir in ['B2U', 'U2B', 'L2R', 'R2L']:
-        print '\nAnalyzing sweeps with direction:', dir
+    dirs = ['B2U', 'U2B', 'L2R', 'R2L']
+    onsetTimes = {}
 
+    for dir in dirs:
         onsetInd = list(displayInfo[dir]['ind'])
 
         for ind in displayInfo[dir]['ind']:
@@ -596,13 +764,22 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
                     ind) + ' was not displayed. Remove from averageing.'
                 onsetInd.remove(ind)
 
-        aveMov, aveMovNor = getAverageDfMovie(movPath=movPath,
-                                              frameTS=frameTS,
-                                              onsetTimes=displayOnsets[onsetInd],
-                                              chunkDur=displayInfo[dir]['sweepDur'],
-                                              startTime=displayInfo[dir]['startTime'],
-                                              temporalDownSampleRate=temporalDownSampleRate,
-                                              is_load_all=is_load_all)
+        onsetTimes[dir] = displayOnsets[onsetInd]
+
+    # read the movie once for all four directions
+    aveMovs, aveMovNors = getAverageDfMovies(movPath=movPath,
+                                             frameTS=frameTS,
+                                             onsetTimes=onsetTimes,
+                                             chunkDurs=dict([(dir, displayInfo[dir]['sweepDur']) for dir in dirs]),
+                                             startTimes=dict([(dir, displayInfo[dir]['startTime']) for dir in dirs]),
+                                             temporalDownSampleRate=temporalDownSampleRate,
+                                             is_load_all=is_load_all)
+
+    for dir in dirs:
+        print '\nAnalyzing sweeps with direction:', dir
+
+        aveMov = aveMovs[dir]
+        aveMovNor = aveMovNors[dir]
 
         if isRectify:
             aveMovNorRec = np.array(aveMovNor)
@@ -638,10 +815,12 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
     return altPosMap, aziPosMap, altPowerMap, aziPowerMap
 
 
-def regression_detrend(mov, roi, verbose=True):
+def regression_detrend(mov, roi, verbose=True, chunk_size=10000, is_return_p=False):
     """
     detrend a movie by subtracting global trend as average activity in side the roi. It work on a pixel by pixel bases
-    and use linear regress to determine the contribution of the global signal to the pixel activity.
+    and use linear regress to determine the contribution of the global signal to the pixel activity. the regression of
+    all pixels is solved in closed form by corticalmapping.core.ImageAnalysis.linear_regress_multi, a chunk of pixels
+    at a time.
 
     ref:
     1. J Neurosci. 2016 Jan 27;36(4):1261-72. doi: 10.1523/JNEUROSCI.2744-15.2016. Resolution of High-Frequency
@@ -652,7 +831,9 @@ def regression_detrend(mov, roi, verbose=True):
 
     :param mov: input movie
     :param roi: binary, weight and binaryNan roi to define global signal
-    :return: detrended movie, trend, amp_map, rvalue_map
+    :param chunk_size: int, approximate number of pixels processed in each chunk, to limit memory usage
+    :param is_return_p: bool, if True, the p value map of the regression is also returned
+    :return: detrended movie, trend, amp_map, rvalue_map (, pvalue_map, only if is_return_p is True)
     """
 
     if len(mov.shape) != 3:
@@ -664,24 +845,36 @@ def regression_detrend(mov, roi, verbose=True):
     mov_new = np.empty(mov.shape, dtype=np.float32)
     slopes = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
     rvalues = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
+    if is_return_p:
+        pvalues = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
 
-    pixel_num = mov.shape[1] * mov.shape[2]
-
-    n = 0
+    # chunks of whole image rows
+    row_num = max(int(chunk_size) // mov.shape[2], 1)
+    trend_f = trend.astype(np.float64)
 
-    for i, j in itertools.product(range(mov.shape[1]), range(mov.shape[2])):
-        pixel_trace = mov[:, i, j]
-        slope, intercept, r_value, p_value, stderr = stats.linregress(trend, pixel_trace)
-        slopes[i, j] = slope
-        rvalues[i, j] = r_value
-        mov_new[:, i, j] = pixel_trace - trend * slope
+    for row_start in range(0, mov.shape[1], row_num):
+        row_end = min(row_start + row_num, mov.shape[1])
 
         if verbose:
-            if n % (pixel_num // 10) == 0:
-                print 'progress:', int(round(float(n) * 100 / pixel_num)), '%'
-        n += 1
+            print 'progress:', int(round(float(row_start) * 100 / mov.shape[1])), '%'
+
+        chunk = np.asarray(mov[:, row_start:row_end, :], dtype=np.float64)
+        chunk_shape = chunk.shape
+        chunk = chunk.reshape((chunk_shape[0], -1))
 
-    return mov_new, trend, slopes, rvalues
+        reg = ia.linear_regress_multi(trend_f, chunk, is_return_p=is_return_p)
+
+        slopes[row_start:row_end, :] = reg[0].reshape(chunk_shape[1:])
+        rvalues[row_start:row_end, :] = reg[2].reshape(chunk_shape[1:])
+        if is_return_p:
+            pvalues[row_start:row_end, :] = reg[3].reshape(chunk_shape[1:])
+
+        mov_new[:, row_start:row_end, :] = (chunk - np.outer(trend_f, reg[0])).reshape(chunk_shape)
+
+    if is_return_p:
+        return mov_new, trend, slopes, rvalues, pvalues
+    else:
+        return mov_new, trend, slopes, rvalues
 
 
 def neural_pil_subtraction(trace_center, trace_surround, lam=0.05):
@@ -843,11 +1036,34 @@ def array_to_rois(input_folder, overlap_threshold=0.9, neuropil_limit=(5, 10), i
     return center_mask_array, neuropil_mask_array
 
 
+def _get_block_slices(length, block_size):
+    """
+    split range(length) into consecutive blocks
+
+    :return: list of (start, end) tuples
+    """
+    return [(start, min(start + block_size, length)) for start in range(0, length, block_size)]
+
+
+def _get_running_channel_names(ts_grp):
+    """
+    return names of the running signal and running reference channels in an nwb '/acquisition/timeseries' group
+    """
+    if 'running_ref' in ts_grp.keys():
+        return 'running_sig', 'running_ref'
+    else:
+        return 'running_sig', 'Running_ref'
+
+
 def concatenate_nwb_files(path_list, save_path, gap_dur=100., roi_path=None, is_save_running=False, analog_chs=(),
-                          unit_groups=(), time_series_paths=()):
+                          unit_groups=(), time_series_paths=(), external_link_paths=(), block_sample_num=1000000):
     """
     concatenate multiple nwb files in to one compact hdf5 file
 
+    the output layout (shapes, dtypes and timestamp offsets) is calculated from the metadata of the input files first,
+    then the data is copied block by block into chunked output datasets, so the memory usage does not depend on the
+    size of the input files. The gaps between files in analog channels are filled with NaN.
+
     :param path_list: list of strings, list of paths of nwb filed to be concatenated
     :param save_path: string, path for the saved hdf5 file
     :param gap_dur: float, in seconds, gap duration between each file
@@ -859,42 +1075,37 @@ def concatenate_nwb_files(path_list, save_path, gap_dur=100., roi_path=None, is_
     :param time_series_paths: list of strings, hdf5 paths to each timeseries to be concatenated, these timeseries
                               should have 'timestamps' field as their timestamps, not 'starting_time' and 'rate' as
                               timestamps
+    :param external_link_paths: list of strings, hdf5 paths to bulky objects (for example
+                                '/acquisition/timeseries/2p_movie') that will not be copied. For each path, a group
+                                named by the last part of the path is created in '/external_links', holding one
+                                external link to the object in each input file ('file_000', 'file_001', ...) and an
+                                attribute 'start_times' with the start time of each file in the concatenated time
+    :param block_sample_num: positive int, number of samples (along time axis) copied in each block
     :return: None
     """
 
-    save_f = h5py.File(save_path)
+    block_sample_num = int(block_sample_num)
+    if block_sample_num <= 0:
+        raise ValueError('block_sample_num should be a positive integer.')
 
+    # ================================ first pass: read metadata ==============================================
     fs = None  # analog sampling rate
+    start_times = []
+    analog_lens = []
 
-    if roi_path is not None:
-        roi_dict_center = {}
-        roi_dict_surround = {}
-
-    next_start = 0.
-
-    analog_dict = {}
-    for analog_ch in analog_chs:
-        analog_dict.update({analog_ch: []})
-
-    if is_save_running:
-        analog_dict.update({'running': []})
+    ts_ns = [os.path.split(ts_path)[1] for ts_path in time_series_paths]
+    ts_shapes = {}
+    ts_dtypes = {}
+    ts_lens = []
 
-    if unit_groups:
-        unit_dict = {}
-        for unit_group in unit_groups:
-            unit_dict.update({unit_group: {}})
+    unit_ns = dict([(unit_group, []) for unit_group in unit_groups])
+    unit_lens = dict([(unit_group, {}) for unit_group in unit_groups])
+    unit_dtypes = dict([(unit_group, {}) for unit_group in unit_groups])
 
-    if time_series_paths:
-        time_series_dict = {}
-        for ts_path in time_series_paths:
-            ts_n = os.path.split(ts_path)[1]
-            time_series_dict.update({ts_n: {'data': [],
-                                            'timestamps': []}})
+    next_start = 0.
 
     for i, curr_path in enumerate(path_list):
 
-        print('\n\nprocessing ' + curr_path + '...')
-
         curr_f = h5py.File(curr_path, 'r')
 
         # handle sampling rate
@@ -904,6 +1115,131 @@ def concatenate_nwb_files(path_list, save_path, gap_dur=100., roi_path=None, is_
             if fs != curr_f['general/extracellular_ephys/sampling_rate'].value:
                 raise ValueError('ephys sampling rate are different.')
 
+        # check analog start time
+        all_chs_grp = curr_f['acquisition/timeseries']
+        for curr_chn, curr_ch_grp in all_chs_grp.items():
+            if 'starting_time' in curr_ch_grp.keys():
+                total_analog_sample_count = curr_ch_grp['num_samples'].value
+                if curr_ch_grp['starting_time'].value != 0:
+                    raise ValueError('starting time of analog channel: {} is not 0.'.format(curr_chn))
+
+        # lengths of analog channels
+        curr_analog_lens = {}
+        for analog_ch in analog_chs:
+            curr_analog_lens[analog_ch] = all_chs_grp[analog_ch]['data'].shape[0]
+
+        if is_save_running:
+            sig_n, ref_n = _get_running_channel_names(all_chs_grp)
+            sig_len = all_chs_grp[sig_n]['data'].shape[0]
+            if sig_len != all_chs_grp[ref_n]['data'].shape[0]:
+                raise ValueError('running signal and running reference have different lengths in {}.'
+                                 .format(curr_path))
+            curr_analog_lens['running'] = sig_len
+
+        analog_lens.append(curr_analog_lens)
+
+        # shapes of ephys units
+        for curr_ug in unit_groups:
+            curr_ug_grp = curr_f['processing'][curr_ug]['UnitTimes']
+            curr_unit_ns = list(curr_ug_grp['unit_list'].value)
+            try:
+                curr_unit_ns.remove('unit_aua')
+            except Exception:
+                pass
+            for curr_unit_n in curr_unit_ns:
+                curr_times = curr_ug_grp[curr_unit_n]['times']
+                if curr_unit_n not in unit_lens[curr_ug]:
+                    unit_ns[curr_ug].append(curr_unit_n)
+                    unit_lens[curr_ug][curr_unit_n] = 0
+                    unit_dtypes[curr_ug][curr_unit_n] = np.float64
+                unit_lens[curr_ug][curr_unit_n] += curr_times.shape[0]
+                unit_dtypes[curr_ug][curr_unit_n] = np.result_type(unit_dtypes[curr_ug][curr_unit_n],
+                                                                   curr_times.dtype)
+
+        # shapes of time series, data is concatenated along its last axis and saved transposed
+        curr_ts_lens = {}
+        for curr_ts_path, curr_ts_n in zip(time_series_paths, ts_ns):
+            curr_ts_data = curr_f[curr_ts_path]['data']
+            curr_ts_ts = curr_f[curr_ts_path]['timestamps']
+            curr_shape = curr_ts_data.shape[::-1][1:]
+            if curr_ts_n not in ts_shapes:
+                ts_shapes[curr_ts_n] = curr_shape
+                ts_dtypes[curr_ts_n] = (curr_ts_data.dtype, np.result_type(np.float64, curr_ts_ts.dtype))
+            elif ts_shapes[curr_ts_n] != curr_shape:
+                raise ValueError('data shape of time series: {} in {} is not aligned for concatenation.'
+                                 .format(curr_ts_path, curr_path))
+            else:
+                ts_dtypes[curr_ts_n] = (np.result_type(ts_dtypes[curr_ts_n][0], curr_ts_data.dtype),
+                                        np.result_type(ts_dtypes[curr_ts_n][1], curr_ts_ts.dtype))
+            curr_ts_lens[curr_ts_n] = (curr_ts_data.shape[-1], curr_ts_ts.shape[0])
+        ts_lens.append(curr_ts_lens)
+
+        start_times.append(next_start)
+        next_start = next_start + gap_dur + float(total_analog_sample_count) / fs
+        curr_f.close()
+
+    gap_sample_num = int(gap_dur * fs)
+
+    # ================================ create output datasets ==================================================
+    save_f = h5py.File(save_path)
+
+    fs_dset = save_f.create_dataset('sampling_rate', data=fs)
+    fs_dset.attrs['unit'] = 'Hz'
+
+    analog_dsets = {}
+    analog_offsets = []
+    analog_names = list(analog_chs)
+    if is_save_running:
+        analog_names.append('running')
+    if analog_names:
+        curr_offsets = dict([(analog_n, 0) for analog_n in analog_names])
+        for curr_analog_lens in analog_lens:
+            analog_offsets.append(dict(curr_offsets))
+            for analog_n in analog_names:
+                curr_offsets[analog_n] += curr_analog_lens[analog_n] + gap_sample_num
+        for analog_n in analog_names:
+            analog_dsets[analog_n] = save_f.create_dataset('analog_' + analog_n, shape=(curr_offsets[analog_n],),
+                                                           maxshape=(None,), dtype=np.float32, chunks=True,
+                                                           fillvalue=np.nan)
+
+    unit_dsets = {}
+    for unit_group in unit_groups:
+        save_units_grp = save_f.create_group(unit_group)
+        unit_dsets[unit_group] = {}
+        for unit_n in unit_ns[unit_group]:
+            save_unit_grp = save_units_grp.create_group(unit_n)
+            unit_dsets[unit_group][unit_n] = save_unit_grp.create_dataset('timestamps',
+                                                                          shape=(unit_lens[unit_group][unit_n],),
+                                                                          dtype=unit_dtypes[unit_group][unit_n])
+    unit_offsets = dict([(unit_group, dict([(unit_n, 0) for unit_n in unit_ns[unit_group]]))
+                         for unit_group in unit_groups])
+
+    ts_dsets = {}
+    for ts_n in ts_ns:
+        data_len = sum([curr_ts_lens[ts_n][0] for curr_ts_lens in ts_lens])
+        ts_len = sum([curr_ts_lens[ts_n][1] for curr_ts_lens in ts_lens])
+        save_ts_grp = save_f.create_group(ts_n)
+        ts_dsets[ts_n] = (save_ts_grp.create_dataset('data', shape=(data_len,) + ts_shapes[ts_n],
+                                                     maxshape=(None,) + ts_shapes[ts_n], dtype=ts_dtypes[ts_n][0],
+                                                     chunks=True),
+                          save_ts_grp.create_dataset('timestamps', shape=(ts_len,), maxshape=(None,),
+                                                     dtype=ts_dtypes[ts_n][1], chunks=True))
+    ts_offsets = dict([(ts_n, [0, 0]) for ts_n in ts_ns])
+
+    for link_path in external_link_paths:
+        link_grp = save_f.require_group('external_links').create_group(os.path.split(link_path.rstrip('/'))[1])
+        for i, curr_path in enumerate(path_list):
+            link_grp['file_{:03d}'.format(i)] = h5py.ExternalLink(os.path.abspath(curr_path), link_path)
+        link_grp.attrs['start_times'] = np.array(start_times)
+
+    # ================================ second pass: copy data ==================================================
+    for i, curr_path in enumerate(path_list):
+
+        print('\n\nprocessing ' + curr_path + '...')
+
+        curr_f = h5py.File(curr_path, 'r')
+        curr_start = start_times[i]
+
         # handle rois
         if (roi_path is not None) and (i == 0):
 
@@ -917,135 +1253,82 @@ def concatenate_nwb_files(path_list, save_path, gap_dur=100., roi_path=None, is_
             except Exception:
                 pixel_size_unit = None
 
-            roi_grp = curr_f[roi_path]
-            for roi_n in roi_grp.keys():
+            print('\nsaving rois ...')
+            roi_grp = save_f.create_group('rois')
+            src_roi_grp = curr_f[roi_path]
+            roi_ns = src_roi_grp.keys()
+            for roi_n in roi_ns:
                 if roi_n[0: 4] == 'roi_' and roi_n != 'roi_list':
-                    roi_dict_center.update({roi_n: ia.ROI(roi_grp[roi_n]['img_mask'].value, pixelSize=pixel_size,
-                                                          pixelSizeUnit=pixel_size_unit)})
+                    curr_roi_c = ia.ROI(src_roi_grp[roi_n]['img_mask'].value, pixelSize=pixel_size,
+                                        pixelSizeUnit=pixel_size_unit)
+                    curr_roi_grp = roi_grp.create_group(roi_n)
+                    curr_roi_c.to_h5_group(curr_roi_grp.create_group('center'))
+
+                    try:
+                        curr_roi_n_s = 'surround_' + roi_n[4:]
+                        curr_roi_s = ia.ROI(src_roi_grp[curr_roi_n_s]['img_mask'].value, pixelSize=pixel_size,
+                                            pixelSizeUnit=pixel_size_unit)
+                        curr_roi_s.to_h5_group(curr_roi_grp.create_group('surround'))
+                    except Exception as e:
+                        print('error in saving surrounding roi: {}. \nError message: {}'.format(roi_n, e))
                 elif roi_n[0: 9] == 'surround_':
-                    roi_dict_surround.update({roi_n: ia.ROI(roi_grp[roi_n]['img_mask'].value, pixelSize=pixel_size,
-                                                            pixelSizeUnit=pixel_size_unit)})
+                    pass
                 else:
-                    # print('avoid loading {}/{} as an roi.'.format(roi_path, roi_n))
                     print('avoid loading {} as an roi.'.format(roi_n))
 
-        # check analog start time
-        all_chs_grp = curr_f['acquisition/timeseries']
-        for curr_chn, curr_ch_grp in all_chs_grp.items():
-            if 'starting_time' in curr_ch_grp.keys():
-                total_analog_sample_count = curr_ch_grp['num_samples'].value
-                if curr_ch_grp['starting_time'].value != 0:
-                    raise ValueError('starting time of analog channel: {} is not 0.'.format(curr_chn))
-
         # handle analog channels
+        all_chs_grp = curr_f['acquisition/timeseries']
         for analog_ch in analog_chs:
-            curr_analog_trace = curr_f['acquisition/timeseries'][analog_ch]['data'].value.astype(np.float32) * \
-                                curr_f['acquisition/timeseries'][analog_ch]['data'].attrs['conversion']
-            analog_gap = np.zeros(int(gap_dur * fs), dtype=np.float32)
-            analog_gap[:] = np.nan
-            analog_dict[analog_ch] += [curr_analog_trace, analog_gap]
+            src_dset = all_chs_grp[analog_ch]['data']
+            conversion = src_dset.attrs['conversion']
+            offset = analog_offsets[i][analog_ch]
+            for start, end in _get_block_slices(src_dset.shape[0], block_sample_num):
+                analog_dsets[analog_ch][offset + start: offset + end] = \
+                    src_dset[start: end].astype(np.float32) * conversion
 
         # handle running signals
         if is_save_running:
-            curr_running_sig_trace = curr_f['acquisition/timeseries']['running_sig']['data']. \
-                                         value.astype(np.float32) * \
-                                     curr_f['acquisition/timeseries']['running_sig']['data'].attrs['conversion']
+            sig_n, ref_n = _get_running_channel_names(all_chs_grp)
+            sig_dset = all_chs_grp[sig_n]['data']
+            ref_dset = all_chs_grp[ref_n]['data']
+            sig_conversion = sig_dset.attrs['conversion']
+            ref_conversion = ref_dset.attrs['conversion']
+            offset = analog_offsets[i]['running']
+            for start, end in _get_block_slices(sig_dset.shape[0], block_sample_num):
+                analog_dsets['running'][offset + start: offset + end] = \
+                    sig_dset[start: end].astype(np.float32) * sig_conversion - \
+                    ref_dset[start: end].astype(np.float32) * ref_conversion
 
+        # handle ephys units
+        for curr_ug in unit_groups:
+            curr_ug_grp = curr_f['processing'][curr_ug]['UnitTimes']
+            curr_unit_ns = list(curr_ug_grp['unit_list'].value)
             try:
-                curr_running_ref_trace = curr_f['acquisition/timeseries']['running_ref']['data']. \
-                                             value.astype(np.float32) * \
-                                         curr_f['acquisition/timeseries']['running_ref']['data']. \
-                                             attrs['conversion']
-            except KeyError:
-                curr_running_ref_trace = curr_f['acquisition/timeseries']['Running_ref']['data']. \
-                                             value.astype(np.float32) * \
-                                         curr_f['acquisition/timeseries']['Running_ref']['data']. \
-                                             attrs['conversion']
-            curr_running_trace = curr_running_sig_trace - curr_running_ref_trace
-            curr_running_gap = np.zeros(int(gap_dur * fs), dtype=np.float32)
-            curr_running_gap[:] = np.nan
-            analog_dict['running'] += [curr_running_trace, curr_running_gap]
+                curr_unit_ns.remove('unit_aua')
+            except Exception:
+                pass
+            for curr_unit_n in curr_unit_ns:
+                curr_times = curr_ug_grp[curr_unit_n]['times'].value + curr_start
+                offset = unit_offsets[curr_ug][curr_unit_n]
+                unit_dsets[curr_ug][curr_unit_n][offset: offset + curr_times.shape[0]] = curr_times
+                unit_offsets[curr_ug][curr_unit_n] = offset + curr_times.shape[0]
 
-        # handle ephys units
-        if unit_groups:
-            for curr_ug in unit_groups:
-                curr_ug_dict = unit_dict[curr_ug]
-                curr_ug_grp = curr_f['processing'][curr_ug]['UnitTimes']
-                curr_unit_ns = list(curr_ug_grp['unit_list'].value)
-                try:
-                    curr_unit_ns.remove('unit_aua')
-                except Exception:
-                    pass
-                for curr_unit_n in curr_unit_ns:
-                    if curr_unit_n in curr_ug_dict.keys():
-                        curr_ug_dict[curr_unit_n].append(curr_ug_grp[curr_unit_n]['times'].value + next_start)
-                    else:
-                        curr_ug_dict[curr_unit_n] = [curr_ug_grp[curr_unit_n]['times'].value + next_start]
-
-        if time_series_paths:
-            for curr_ts_path in time_series_paths:
-                curr_ts_n = os.path.split(curr_ts_path)[1]
-                curr_ts_data = curr_f[curr_ts_path]['data'].value
-                curr_ts_ts = curr_f[curr_ts_path]['timestamps'].value
-                time_series_dict[curr_ts_n]['data'].append(curr_ts_data)
-                time_series_dict[curr_ts_n]['timestamps'].append(curr_ts_ts + next_start)
+        # handle time series
+        for curr_ts_path, curr_ts_n in zip(time_series_paths, ts_ns):
+            src_data = curr_f[curr_ts_path]['data']
+            src_ts = curr_f[curr_ts_path]['timestamps']
+            data_dset, ts_dset = ts_dsets[curr_ts_n]
+            data_offset, ts_offset = ts_offsets[curr_ts_n]
 
-        next_start = next_start + gap_dur + float(total_analog_sample_count) / fs
-        curr_f.close()
+            for start, end in _get_block_slices(src_data.shape[-1], block_sample_num):
+                data_dset[data_offset + start: data_offset + end] = src_data[..., start: end].transpose()
 
-    fs_dset = save_f.create_dataset('sampling_rate', data=fs)
-    fs_dset.attrs['unit'] = 'Hz'
+            for start, end in _get_block_slices(src_ts.shape[0], block_sample_num):
+                ts_dset[ts_offset + start: ts_offset + end] = src_ts[start: end] + curr_start
+
+            ts_offsets[curr_ts_n] = [data_offset + src_data.shape[-1], ts_offset + src_ts.shape[0]]
 
-    if roi_path is not None:
-        print('\nsaving rois ...')
-        roi_grp = save_f.create_group('rois')
-        if roi_dict_center:
-            for curr_roi_n_c, curr_roi_c in roi_dict_center.items():
-                curr_roi_grp = roi_grp.create_group(curr_roi_n_c)
-                curr_roi_grp_c = curr_roi_grp.create_group('center')
-                curr_roi_c.to_h5_group(curr_roi_grp_c)
-
-                try:
-                    curr_roi_n_s = 'surround_' + curr_roi_n_c[4:]
-                    curr_roi_s = roi_dict_surround[curr_roi_n_s]
-                    curr_roi_grp_s = curr_roi_grp.create_group('surround')
-                    curr_roi_s.to_h5_group(curr_roi_grp_s)
-                except Exception as e:
-                    print('error in saving surrounding roi: {}. \nError message: {}'.format(curr_roi_n_c, e))
-
-    if analog_chs or is_save_running:
-        print('\nsaving analog channels ...')
-        for curr_analog_n, curr_analog_trace_list in analog_dict.items():
-            print curr_analog_n
-            curr_analog_trace_all = np.concatenate(curr_analog_trace_list, axis=0)
-            save_f['analog_' + curr_analog_n] = curr_analog_trace_all
-
-    if unit_groups:
-        for unit_group in unit_groups:
-            print('\nsaving ephys units for unit group: {}'.format(unit_group))
-            save_units_grp = save_f.create_group(unit_group)
-            for unit_n, unit_ts in unit_dict[unit_group].items():
-                save_unit_grp = save_units_grp.create_group(unit_n)
-                save_unit_grp.create_dataset('timestamps', data=np.concatenate(unit_ts, axis=0))
-
-    if time_series_paths:
-        print('\nsaving other time series ...')
-        for save_ts_n, save_ts_dict in time_series_dict.items():
-            print(save_ts_n)
-            save_ts_grp = save_f.create_group(save_ts_n)
-            curr_ts_data = save_ts_dict['data']
-
-            # try:
-            #     curr_ts_data_con = np.concatenate(curr_ts_data, axis=0)
-            # except ValueError:
-            #     print('data shape is not aligned for concatenation. Try concatenate in next axis.')
-            #     curr_ts_data_t = [ctd.transpose() for ctd in curr_ts_data]
-            #     curr_ts_data_con = np.concatenate(curr_ts_data_t, axis=0)
-
-            curr_ts_data_t = [ctd.transpose() for ctd in curr_ts_data]
-            curr_ts_data_con = np.concatenate(curr_ts_data_t, axis=0)
-            save_ts_grp['data'] = curr_ts_data_con
-            save_ts_grp['timestamps'] = np.concatenate(save_ts_dict['timestamps'], axis=0)
+        curr_f.close()
 
     save_f.close()
 
@@ -1272,30 +1555,60 @@ def generate_strf_from_timestamps(unit_ts, squares_ts_grp, unit_n='', sta_start=
     :return: corticalmapping.SingleCellAnalysis.SpatialTemporalReceptiveField object
     """
 
+    strfs = generate_strfs_from_timestamps({unit_n: unit_ts}, squares_ts_grp, sta_start=sta_start, sta_end=sta_end,
+                                           bin_num=bin_num)
+    return strfs[unit_n]
+
+
+def generate_strfs_from_timestamps(units_ts, squares_ts_grp, sta_start=-0.055, sta_end=0.205, bin_num=26):
+    """
+    generate corticalmapping.SingleCellAnalysis.SpatialTemporalReceptiveField objects of many units from their
+    discrete spike timestamps series. the spike counts of all units around every displayed square are binned in one
+    call of corticalmapping.core.TimingAnalysis.discrete_cross_correlations
+
+    :param units_ts: dictionary, {unit name: 1d array, spike timestamps}
+    :param squares_ts_grp: h5py group object, containing the timestamps of each square displayed, this should be the
+                         output of corticalmapping.NwbTools.RecordedFile.analyze_visual_stimuli_corticalmapping()
+                         function
+    :param sta_start: float, stimulus triggered average start time relative to stimulus onset
+    :param sta_end: float, stimulus triggered average end time relative to stimulus onset
+    :param bin_num: positive int, number of bins
+    :return: dictionary, {unit name: corticalmapping.SingleCellAnalysis.SpatialTemporalReceptiveField object}
+    """
+
     bin_width = (sta_end - sta_start) / bin_num
     t = np.arange((sta_start + bin_width / 2), (sta_end + bin_width / 2), bin_width)
     t = np.round(t * 100000) / 100000
 
     all_squares = squares_ts_grp.keys()
-    traces = []
     locations = []
     signs = []
+    square_ts_lst = []
 
     for square in all_squares:
         square_grp = squares_ts_grp[square]
-        square_ts = square_grp['timestamps'].value
-        curr_square_traces = []
-
-        for ts in square_ts:
-            _, curr_trace = ta.discrete_cross_correlation([ts], unit_ts, (sta_start, sta_end), bin_num)
-            curr_trace = curr_trace.astype(np.float32)
-            curr_square_traces.append(curr_trace)
-
-        traces.append(np.array(curr_square_traces))
+        square_ts_lst.append(np.array(square_grp['timestamps'].value, dtype=np.float64).flatten())
         locations.append([square_grp['altitude_deg'].value, square_grp['azimuth_deg'].value])
         signs.append(square_grp['sign'].value)
 
-    return sca.SpatialTemporalReceptiveField(locations, signs, traces, t, name=unit_n, trace_data_type='spike_count')
+    # each single display of each square is a probe
+    probes = [[ts] for square_ts in square_ts_lst for ts in square_ts]
+    square_ends = np.cumsum([len(square_ts) for square_ts in square_ts_lst])
+    square_starts = square_ends - np.array([len(square_ts) for square_ts in square_ts_lst], dtype=np.int64)
+
+    unit_ns = list(units_ts.keys())
+    _, all_traces = ta.discrete_cross_correlations(probes, [units_ts[unit_n] for unit_n in unit_ns],
+                                                   t_range=(sta_start, sta_end), bins=bin_num)
+    all_traces = all_traces.astype(np.float32)
+
+    strfs = {}
+    for unit_i, unit_n in enumerate(unit_ns):
+        traces = [all_traces[unit_i, square_start:square_end]
+                  for square_start, square_end in zip(square_starts, square_ends)]
+        strfs[unit_n] = sca.SpatialTemporalReceptiveField(locations, signs, traces, t, name=unit_n,
+                                                          trace_data_type='spike_count')
+
+    return strfs
 
 
 def generate_strf_from_continuous(continuous, continuous_ts, squares_ts_grp, roi_n='', sta_start=0.5, sta_end=1.5):
@@ -1330,15 +1643,9 @@ def generate_strf_from_continuous(continuous, continuous_ts, squares_ts_grp, roi
     for square in all_squares:
         square_grp = squares_ts_grp[square]
         square_ts = square_grp['timestamps'].value
-        square_traces = []
-
-        for ts in square_ts:
-            curr_frame_start = ta.find_nearest(continuous_ts, ts) + chunk_frame_start
-            curr_frame_end = curr_frame_start + chunk_frame_dur
-            if curr_frame_start >= 0 and curr_frame_end <= len(continuous_ts):
-                square_traces.append(continuous[curr_frame_start: curr_frame_end])
-
-        square_traces = np.array(square_traces)
+        square_traces = ta.event_triggered_traces(arr=continuous, arr_ts=continuous_ts, trigger_ts=square_ts,
+                                                  frame_start=chunk_frame_start,
+                                                  frame_end=chunk_frame_start + chunk_frame_dur)
         square_bl = np.mean(square_traces[:, 0: abs(chunk_frame_start)], axis=1)
         square_bl = np.array([square_bl]).transpose()
         square_dff = (square_traces - square_bl) / square_bl
@@ -1362,19 +1669,6 @@ def get_drifting_grating_response_nwb(nwb_path, plane_ns, grating_onsets_path, t
     :return: None
     """
 
-    def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-
-        sta_arr = []
-
-        for trig in trigger_ts:
-            trig_ind = ta.find_nearest(arr_ts, trig)
-            curr_sta = arr[:, (trig_ind + frame_start) : (trig_ind + frame_end)]
-            sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-        sta_arr = np.concatenate(sta_arr, axis=1)
-        return sta_arr
-
-
     if time_window[0] >= time_window[1]:
         raise ValueError('time window should be from early time to late time.')
 
@@ -1419,8 +1713,8 @@ def get_drifting_grating_response_nwb(nwb_path, plane_ns, grating_onsets_path, t
 
             grating_onsets = onsets_grating_grp['timestamps'].value
             for trace_n, trace in traces.items():
-                sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets, frame_start=frame_start,
-                              frame_end=frame_end)
+                sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets,
+                                                frame_start=frame_start, frame_end=frame_end)
                 curr_grating_grp.create_dataset('sta_' + trace_n, data=sta)
 
 
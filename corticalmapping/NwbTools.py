@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import h5py
+import scipy.signal as sig
 import matplotlib.pyplot as plt
 import corticalmapping.ephys.OpenEphysWrapper as oew
 import corticalmapping.ephys.KilosortWrapper as kw
@@ -563,7 +564,7 @@ class RecordedFile(NWB):
 
             #  get timestamps of current unit
             curr_ts = spike_ind[unit]
-            curr_ts = curr_ts[np.logical_and(curr_ts >= ind_start, curr_ts < ind_end)] - ind_start
+            curr_ts = kw.get_spike_indices_in_range(curr_ts, ind_start, ind_end) - ind_start
             curr_ts = curr_ts / fs + file_starting_time
 
             # array to store waveforms from all channels
@@ -847,12 +848,16 @@ class RecordedFile(NWB):
         return fig
 
     def generate_dat_file_for_kilosort(self, output_folder, output_name, ch_ns, is_filtered=True, cutoff_f_low=300.,
-                                       cutoff_f_high=6000.):
+                                       cutoff_f_high=6000., block_sample_num=1000000):
         """
         generate .dat file for kilolsort: "https://github.com/cortex-lab/KiloSort", it is binary raw code, with
         structure: ch0_t0, ch1_t0, ch2_t0, ...., chn_t0, ch0_t1, ch1_t1, ch2_t1, ..., chn_t1, ..., ch0_tm, ch1_tm,
         ch2_tm, ..., chn_tm
 
+        the data is streamed in time blocks: each block of all channels is read from the nwb file, interleaved, filtered
+        and appended to the .dat file(s), so the memory usage only depends on block_sample_num. the filter state is
+        carried from one block to the next, so the filtered data is identical to filtering each whole channel at once.
+
         :param output_folder: str, path to output directory
         :param output_name: str, output file name, an extension of '.dat' will be automatically added.
         :param ch_ns: list of strings, name of included analog channels
@@ -862,6 +867,7 @@ class RecordedFile(NWB):
                             to the filtered file name.
         :param cutoff_f_low: float, low cutoff frequency, Hz. if None, it will be low-pass
         :param cutoff_f_high: float, high cutoff frequency, Hz, if None, it will be high-pass
+        :param block_sample_num: positive int, number of samples (of each channel) in each time block
         :return: None
         """
 
@@ -869,37 +875,55 @@ class RecordedFile(NWB):
         if os.path.isfile(save_path):
             raise IOError('Output file already exists.')
 
-        data_lst = []
-        for ch_n in ch_ns:
-            data_lst.append(self.file_pointer['acquisition/timeseries'][ch_n]['data'].value)
+        if block_sample_num < 1:
+            raise ValueError('block_sample_num should be a positive integer.')
 
-        dtype = data_lst[0].dtype
-        data = np.array(data_lst, dtype=dtype).flatten(order='F')
-        data.tofile(save_path)
+        dsets = [self.file_pointer['acquisition/timeseries'][ch_n]['data'] for ch_n in ch_ns]
+        dtype = dsets[0].dtype
+        sample_num = dsets[0].shape[0]
+        for dset in dsets:
+            if len(dset.shape) != 1 or dset.shape[0] != sample_num:
+                raise ValueError('all included channels should be 1-d and have same length.')
 
         if is_filtered:
-
             if cutoff_f_low is None and cutoff_f_high is None:
                 print ('both low cutoff frequency and high cutoff frequency are None. Do nothing.')
-                return
-
-            save_path_f = os.path.join(output_folder, output_name + '_filtered.dat')
-            if os.path.isfile(save_path_f):
-                raise IOError('Output file for filtered data already existes.')
+                is_filtered = False
+            else:
+                save_path_f = os.path.join(output_folder, output_name + '_filtered.dat')
+                if os.path.isfile(save_path_f):
+                    raise IOError('Output file for filtered data already existes.')
 
-            fs = self.file_pointer['general/extracellular_ephys/sampling_rate'].value
-            data_lst_f = []
-            for data_r in data_lst:
+                fs = self.file_pointer['general/extracellular_ephys/sampling_rate'].value
                 if cutoff_f_high is None:
-                    data_lst_f.append(ta.butter_lowpass(data_r, fs=fs, cutoff=cutoff_f_low).astype(dtype))
+                    b, a = ta.butter_lowpass_filter(cutoff=cutoff_f_low, fs=fs)
                 elif cutoff_f_low is None:
-                    data_lst_f.append(ta.butter_highpass(data_r, fs=fs, cutoff=cutoff_f_high).astype(dtype))
+                    b, a = ta.butter_highpass_filter(cutoff=cutoff_f_high, fs=fs)
                 else:
-                    data_lst_f.append(ta.butter_bandpass(data_r,
-                                                         fs=fs,
-                                                         cutoffs=(cutoff_f_low, cutoff_f_high)).astype(dtype))
-            data_f = np.array(data_lst_f, dtype=dtype).flatten(order='F')
-            data_f.tofile(save_path_f)
+                    b, a = ta.butter_bandpass_filter(cutoffs=(cutoff_f_low, cutoff_f_high), fs=fs)
+
+                # initial filter state of zeros, same as filtering without initial state
+                zi = np.zeros((max(len(a), len(b)) - 1, len(dsets)))
+
+        block_sample_num = int(block_sample_num)
+        block = np.empty((min(block_sample_num, sample_num), len(dsets)), dtype=dtype)
+
+        with open(save_path, 'wb') as f:
+            f_f = open(save_path_f, 'wb') if is_filtered else None
+            try:
+                for block_start in range(0, sample_num, block_sample_num):
+                    block_end = min(block_start + block_sample_num, sample_num)
+                    curr_block = block[0: block_end - block_start]
+                    for ch_i, dset in enumerate(dsets):
+                        curr_block[:, ch_i] = dset[block_start: block_end]
+                    curr_block.tofile(f)
+
+                    if is_filtered:
+                        curr_block_f, zi = sig.lfilter(b, a, curr_block, axis=0, zi=zi)
+                        curr_block_f.astype(dtype).tofile(f_f)
+            finally:
+                if f_f is not None:
+                    f_f.close()
 
     def _get_channel_names(self):
         """
@@ -1329,21 +1353,6 @@ class RecordedFile(NWB):
 
     def get_drifting_grating_response_table_retinotopic_mapping(self, stim_name, time_window=(-1, 2.5)):
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         if time_window[0] >= time_window[1]:
             raise ValueError('time window should be from early time to late time.')
 
@@ -1405,28 +1414,13 @@ class RecordedFile(NWB):
                 curr_grating_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
                 for trace_n, trace in traces.items():
-                    sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets, frame_start=frame_start,
-                                  frame_end=frame_end)
+                    sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=grating_onsets,
+                                                    frame_start=frame_start, frame_end=frame_end)
                     curr_grating_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
 
     def get_spatial_temporal_receptive_field_retinotopic_mapping(self, stim_name, time_window=(-0.5, 2.),
                                                                  verbose=True):
 
-        def get_sta(arr, arr_ts, trigger_ts, frame_start, frame_end):
-
-            sta_arr = []
-
-            for trig in trigger_ts:
-                trig_ind = ta.find_nearest(arr_ts, trig)
-
-                if trig_ind + frame_end < arr.shape[1]:
-                    curr_sta = arr[:, (trig_ind + frame_start): (trig_ind + frame_end)]
-                    # print(curr_sta.shape)
-                    sta_arr.append(curr_sta.reshape((curr_sta.shape[0], 1, curr_sta.shape[1])))
-
-            sta_arr = np.concatenate(sta_arr, axis=1)
-            return sta_arr
-
         if time_window[0] >= time_window[1]:
             raise ValueError('time window should be from early time to late time.')
 
@@ -1489,8 +1483,8 @@ class RecordedFile(NWB):
                 curr_probe_grp.attrs['sta_traces_dimenstion'] = 'roi x trial x timepoint'
 
                 for trace_n, trace in traces.items():
-                    sta = get_sta(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets, frame_start=frame_start,
-                                  frame_end=frame_end)
+                    sta = ta.event_triggered_traces(arr=trace, arr_ts=trace_ts, trigger_ts=probe_onsets,
+                                                    frame_start=frame_start, frame_end=frame_end)
                     curr_probe_grp.create_dataset('sta_' + trace_n, data=sta, compression='lzf')
 
     def _add_stimulus_separator_retinotopic_mapping(self, ss_dict):
@@ -161,28 +161,28 @@ def generatePhaseMap(movie, cycles=1, isReverse=False, isFilter=False, sigma=3.,
     than 'sigma' standard deviation from the mean power of all frequencies.
 
     '''
-    if isReverse:
-        movie = np.amax(movie) - movie
+    if isFilter == True:
+        # the filtering needs power of all frequencies, so the full spectrum is computed
+        if isReverse:
+            movie = np.amax(movie) - movie
 
-    spectrumMovie = np.fft.fft(movie, axis=0)
+        spectrumMovie = np.fft.fft(movie, axis=0)
 
-    # generate power movie
-    powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
-    powerMap = np.abs(powerMovie[cycles, :, :])
+        # generate power movie
+        powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
+        powerMap = np.abs(powerMovie[cycles, :, :])
 
-    # generate phase movie
-    phaseMovie = np.angle(spectrumMovie)
-    # phaseMap = phaseMovie[cycles,:,:]
-    phaseMap = -1 * phaseMovie[cycles, :, :]
+        # generate phase movie
+        phaseMovie = np.angle(spectrumMovie)
+        # phaseMap = phaseMovie[cycles,:,:]
+        phaseMap = -1 * phaseMovie[cycles, :, :]
 
-    # remove pixels with not enough power in the ideal frequency
-    if isFilter == True:
+        # remove pixels with not enough power in the ideal frequency
         meanPower = np.mean(powerMovie, axis=0)
         stdPower = np.std(powerMovie, axis=0)
-        for i in np.arange(powerMap.shape[0]):
-            for j in np.arange(powerMap.shape[1]):
-                if powerMap[i, j] < meanPower[i, j] + sigma * stdPower[i, j]:
-                    phaseMap[i, j] = np.nan
+        phaseMap[powerMap < meanPower + sigma * stdPower] = np.nan
+    else:
+        phaseMap, powerMap = generatePhaseMapSingleFrequency(movie, cycles=cycles, isReverse=isReverse)
 
     if isplot == True:
         plt.figure()
@@ -198,20 +198,63 @@ def generatePhaseMap2(movie, cycles, isReverse=False, isPlot=False):
     generating phase map of a 3-d movie, on the frequency defined by cycles.
     the movie should have the same length of 'cycles' number of cycles.
     '''
-    if isReverse:
-        movie = np.amax(movie) - movie
+    return generatePhaseMapSingleFrequency(movie, cycles=cycles, isReverse=isReverse, isPlot=isPlot)
+
+
+def generatePhaseMapSingleFrequency(movie, cycles=1, isReverse=False, chunkSize=100, isPlot=False):
+    '''
+    generating phase map and power map of a 3-d movie at the single frequency defined by cycles, without computing the
+    full spectrum. the movie is projected onto a precomputed complex sinusoid (direct DFT of one frequency bin) in one
+    streaming pass over chunks of frames, so the movie does not need to be loaded into memory as a whole.
+
+    the movie should have the same length of 'cycles' number of cycles.
 
-    spectrumMovie = np.fft.fft(movie, axis=0)
+    :param movie: 3-d array like object, frame x height x width, can be np.ndarray, BinarySlicer or h5py dataset, any
+                  object supports slicing along the first axis
+    :param cycles: int, the frequency bin (number of cycles in the movie)
+    :param isReverse: bool, if True, the map will be generated from np.amax(movie) - movie (detect valley)
+    :param chunkSize: positive int, number of frames loaded each time
+    :param isPlot: bool
+    :return: phaseMap, from 0 to 2pi; powerMap. identical to the outputs of generatePhaseMap2
+    '''
+
+    if len(movie.shape) != 3:
+        raise ValueError('input movie should be 3-d!')
+
+    if chunkSize < 1:
+        raise ValueError('chunkSize should be a positive integer!')
+
+    frameNum = movie.shape[0]
+    mapShape = (movie.shape[1], movie.shape[2])
+
+    kernelAngle = 2 * np.pi * cycles * np.arange(frameNum, dtype=np.float64) / frameNum
+    kernelCos = np.cos(kernelAngle)
+    kernelSin = np.sin(kernelAngle)
+
+    spectrumReal = np.zeros(mapShape[0] * mapShape[1], dtype=np.float64)
+    spectrumImag = np.zeros(mapShape[0] * mapShape[1], dtype=np.float64)
+    movieMax = None
+
+    for indStart in range(0, frameNum, chunkSize):
+        indEnd = min(indStart + chunkSize, frameNum)
+        chunk = np.asarray(movie[indStart:indEnd]).reshape((indEnd - indStart, -1)).astype(np.float64)
+        spectrumReal += kernelCos[indStart:indEnd].dot(chunk)
+        spectrumImag -= kernelSin[indStart:indEnd].dot(chunk)
+
+        if isReverse:
+            chunkMax = np.amax(chunk)
+            if movieMax is None or chunkMax > movieMax:
+                movieMax = chunkMax
+
+    # the projection is linear: DFT(max - movie) = max * DFT(ones) - DFT(movie)
+    if isReverse:
+        spectrumReal = movieMax * np.sum(kernelCos) - spectrumReal
+        spectrumImag = -movieMax * np.sum(kernelSin) - spectrumImag
 
-    # generate power movie
-    powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
-    powerMap = np.abs(powerMovie[cycles, :, :])
+    spectrum = (spectrumReal + 1j * spectrumImag).reshape(mapShape)
 
-    # generate phase movie
-    phaseMovie = np.angle(spectrumMovie)
-    # phaseMap = phaseMovie[cycles,:,:]
-    phaseMap = -1 * phaseMovie[cycles, :, :]
-    phaseMap = phaseMap % (2 * np.pi)
+    powerMap = (np.abs(spectrum) * 2.) / frameNum
+    phaseMap = (-1 * np.angle(spectrum)) % (2 * np.pi)
 
     if isPlot == True:
         plt.figure()
@@ -499,23 +542,27 @@ def dilationPatches(rawPatches, smallPatchThr=5, borderWidth=1):  # pixel width
     # genertating new patches
     newPatches = np.multiply(-1 * (patchBorder - 1), total_area)
 
-    # removing small edges
+    # removing small edges, only the bounding box of each patch is processed
     labeledPatches, patchNum = ni.label(newPatches)
+    patchAreas = np.bincount(labeledPatches.ravel(), minlength=patchNum + 1)
+    rawOverlaps = np.bincount(labeledPatches.ravel(), weights=np.asarray(rawPatches, dtype=np.float64).ravel(),
+                              minlength=patchNum + 1)
+    pad = borderWidth + 3
 
-    for i in xrange(1, patchNum + 1):
-        currPatch = np.array(labeledPatches)
-        currPatch[currPatch != i] = 0
-        currPatch = currPatch / i
+    for i, slc in enumerate(ni.find_objects(labeledPatches)):
+        if slc is None:
+            continue
 
-        if (np.sum(np.multiply(currPatch, rawPatches)[:]) == 0) or (np.sum(currPatch[:]) < smallPatchThr):
-            # revCurrPatch = -1 * (currPatch - 1)
-            # newPatches = np.multiply(newPatches, revCurrPatch)
-            newPatches[currPatch == 1] = 0
+        if (rawOverlaps[i + 1] == 0) or (patchAreas[i + 1] < smallPatchThr):
+            currRegion = newPatches[slc]
+            currRegion[labeledPatches[slc] == i + 1] = 0
 
         else:
-            currPatch = ni.binary_closing(currPatch,
-                                          structure=np.ones((borderWidth + 2, borderWidth + 2))).astype(np.int)
-            newPatches[currPatch == 1] = 1
+            slc = tuple(slice(max(sl.start - pad, 0), min(sl.stop + pad, dim)) for sl, dim in zip(slc, newPatches.shape))
+            currPatch = ni.binary_closing(labeledPatches[slc] == i + 1,
+                                          structure=np.ones((borderWidth + 2, borderWidth + 2)))
+            currRegion = newPatches[slc]
+            currRegion[currPatch] = 1
 
     return newPatches
 
@@ -540,20 +587,14 @@ def dilationPatches2(rawPatches, dilationIter=20, borderWidth=1):  # pixel width
     # genertating new patches
     newPatches = np.multiply(-1 * (patchBorder - 1), total_area)
 
-    # removing small edges
+    # removing small edges, keep the labels overlapping with raw patches
     labeledPatches, patchNum = ni.label(newPatches)
+    rawOverlaps = np.bincount(labeledPatches.ravel(), weights=np.asarray(rawPatches, dtype=np.float64).ravel(),
+                              minlength=patchNum + 1)
+    isKept = rawOverlaps > 0
+    isKept[0] = False
 
-    newPatches2 = np.zeros(newPatches.shape, dtype=np.int)
-
-    for i in xrange(1, patchNum + 1):
-        currPatch = np.zeros(labeledPatches.shape, dtype=np.int)
-        currPatch[labeledPatches == i] = 1
-        currPatch[labeledPatches != i] = 0
-
-        if (np.sum(np.multiply(currPatch, rawPatches)[:]) > 0):
-            #            currPatch = ni.binary_closing(currPatch,
-            #                                          structure = np.ones((borderWidth+2,borderWidth+2))).astype(np.int)
-            newPatches2[currPatch == 1] = 1
+    newPatches2 = isKept[labeledPatches].astype(np.int)
 
     return newPatches2
 
@@ -562,36 +603,50 @@ def labelPatches(patchmap, signMap, connectivity=4):
     '''
     from a segregated patchmap generate a dictionary with each entry represents
     a single patch, sorted by area
+
+    area and visual sign of all patches are measured from one label image, each patch is built from its own pixel
+    coordinates as a sparse array
+
+    connectivity: 4 or 8, pixel connectivity used to label patches
     '''
 
-    labeledPatches, patchNum = ni.label(patchmap)
+    if connectivity == 8:
+        labeledPatches, patchNum = ni.label(patchmap, structure=np.ones((3, 3)))
+    elif connectivity == 4:
+        labeledPatches, patchNum = ni.label(patchmap)
+    else:
+        raise ValueError('connectivity should be either 4 or 8.')
+
+    labels = np.arange(1, patchNum + 1)
 
     # list of area of every patch, first column: patch label, second column: area
     patchArea = np.zeros((patchNum, 2), dtype=np.int)
+    patchArea[:, 0] = labels
+    patchArea[:, 1] = np.bincount(labeledPatches.ravel(), minlength=patchNum + 1)[1:]
 
-    for i in range(1, patchNum + 1):
-        currPatch = np.zeros(labeledPatches.shape, dtype=np.int)
-        currPatch[labeledPatches == i] = 1
-        currPatch[labeledPatches != i] = 0
-        patchArea[i - 1] = [i, np.sum(currPatch[:])]
+    # sum of sign map within each patch
+    signSums = np.array(ni.sum(signMap, labels=labeledPatches, index=labels), dtype=np.float64).reshape(-1)
 
     # sort patches by the area, from largest to the smallest
     sortArea = patchArea[patchArea[:, 1].argsort(axis=0)][::-1, :]
 
+    patchSlices = ni.find_objects(labeledPatches)
+
     patches = {}
     for i, ind in enumerate(sortArea[:, 0]):
-        currPatch = np.zeros(labeledPatches.shape, dtype=np.int)
-        currPatch[labeledPatches == ind] = 1
-        currPatch[labeledPatches != ind] = 0
-        currSignPatch = np.multiply(currPatch, signMap)
 
-        if np.sum(currSignPatch[:]) > 0:
+        if signSums[ind - 1] > 0:
             currSign = 1
-        elif np.sum(currSignPatch[:]) < 0:
+        elif signSums[ind - 1] < 0:
             currSign = -1
         else:
             raise LookupError, 'This patch has no visual Sign!!'
 
+        slc = patchSlices[ind - 1]
+        rows, cols = np.nonzero(labeledPatches[slc] == ind)
+        currPatch = sparse.coo_matrix((np.ones(len(rows), dtype=np.uint8), (rows + slc[0].start, cols + slc[1].start)),
+                                      shape=labeledPatches.shape)
+
         patchname = 'patch' + ft.int2str(i, 2)
 
         patches.update({patchname: Patch(currPatch, currSign)})
@@ -696,16 +751,32 @@ def localMin(eccMap, binSize):
 def adjacentPairs(patches, borderWidth=2):
     '''
     return all the patch pairs with same visual sign and sharing border
+
+    two patches share border if they touch each other after both being dilated by (borderWidth - 1) iterations, same as
+    corticalmapping.core.ImageAnalysis.is_adjacent(). the patches should not overlap with each other. the adjacency of
+    all patches is measured from one label image by getPatchAdjacency()
     '''
 
     keyList = patches.keys()
+
+    if borderWidth < 2:
+        # dilation with no iteration limit, every two patches touch each other
+        adjKeys = None
+    else:
+        labelImage, patchKeys = getPatchLabelImage(patches)
+        adjLabels = getPatchAdjacency(labelImage, distance=2 * (borderWidth - 1))
+        adjKeys = set((patchKeys[l1 - 1], patchKeys[l2 - 1]) for l1, l2 in adjLabels)
+
     pairKeyList = []
 
     for pair in combinations(keyList, 2):
         patch1 = patches[pair[0]]
         patch2 = patches[pair[1]]
 
-        if (ia.is_adjacent(patch1.array, patch2.array, borderWidth=borderWidth)) and (patch1.sign == patch2.sign):
+        if patch1.sign != patch2.sign:
+            continue
+
+        if (adjKeys is None) or (pair in adjKeys) or ((pair[1], pair[0]) in adjKeys):
             pairKeyList.append(pair)
 
     return pairKeyList
@@ -760,6 +831,126 @@ def eccentricityMap(altMap, aziMap, altCenter, aziCenter):
     return eccMap
 
 
+def getPatchLabelImage(patches):
+    '''
+    generate a single label image from a dictionary of patches, the patches should not overlap with each other
+
+    :param patches: dictionary of Patch objects
+    :return: labelImage, 2d int array, 0 is background, pixels of patches[patchKeys[i]] are labeled as i + 1
+             patchKeys, sorted list of patch names
+    '''
+
+    patchKeys = sorted(patches.keys())
+    labelImage = None
+
+    for i, key in enumerate(patchKeys):
+        currPatch = patches[key].sparseArray
+        if labelImage is None:
+            labelImage = np.zeros(currPatch.shape, dtype=np.int32)
+        labelImage[currPatch.row[currPatch.data != 0], currPatch.col[currPatch.data != 0]] = i + 1
+
+    return labelImage, patchKeys
+
+
+def getPatchAdjacency(labelImage, distance=1):
+    '''
+    find all pairs of labeled patches that are within certain distance to each other in one sweep over the label image.
+    two patches are paired if the city block distance between their closest pixels is no greater than distance, which
+    is the same as a patch touches the other one after being dilated by distance iterations (with the default cross
+    structure)
+
+    :param labelImage: 2d int array, 0 is background, each positive integer labels one patch
+    :param distance: positive int, city block distance in pixels
+    :return: set of tuples, (label1, label2) of every paired patches, label1 < label2
+    '''
+
+    if distance < 1:
+        raise ValueError('distance should be integer no less than 1.')
+
+    labelImage = np.asarray(labelImage)
+    height, width = labelImage.shape
+    pairCodes = []
+    maxLabel = int(labelImage.max()) if labelImage.size > 0 else 0
+
+    # only half of the offsets are needed since the pairs are symmetric
+    for dy in range(0, min(distance, height - 1) + 1):
+        for dx in range(-min(distance - dy, width - 1), min(distance - dy, width - 1) + 1):
+            if dy == 0 and dx <= 0:
+                continue
+
+            labels1 = labelImage[0:height - dy, max(0, -dx):width - max(0, dx)]
+            labels2 = labelImage[dy:height, max(0, dx):width - max(0, -dx)]
+
+            isPair = (labels1 != labels2) & (labels1 > 0) & (labels2 > 0)
+            if not np.any(isPair):
+                continue
+
+            labels1 = labels1[isPair].astype(np.int64)
+            labels2 = labels2[isPair].astype(np.int64)
+            pairCodes.append(np.unique(np.minimum(labels1, labels2) * (maxLabel + 1) + np.maximum(labels1, labels2)))
+
+    if len(pairCodes) == 0:
+        return set()
+
+    pairCodes = np.unique(np.concatenate(pairCodes))
+
+    return set(zip((pairCodes // (maxLabel + 1)).tolist(), (pairCodes % (maxLabel + 1)).tolist()))
+
+
+def getVisualSpaces(labelImage, altMap, aziMap, altRange=(-40., 60.), aziRange=(-20., 120.), visualFieldOrigin=None,
+                    pixelSize=1., closeIter=None):
+    '''
+    get the visual response space (visual coverage) of every labeled cortical patch in one call. all labeled pixels are
+    binned into (altitude, azimuth) visual space pixels with array operations. gives the same visual space for each
+    patch as Patch.getVisualSpace()
+
+    :param labelImage: 2d int array, 0 is background, each positive integer labels one patch
+    :param altMap: altitude position map, same shape as labelImage
+    :param aziMap: azimuth position map, same shape as labelImage
+    :param altRange: altitude range of the visual space
+    :param aziRange: azimuth range of the visual space
+    :param visualFieldOrigin: [altitude, azimuth] of visual field origin, if not None, the maps will be shifted
+    :param pixelSize: pixel size of visual space, deg
+    :param closeIter: int, binary closing iteration of the visual space of each patch, None or 0 for no closing
+    :return: visualSpaces, dictionary {label: 2d uint8 array, visual space, altitude x azimuth}, one item for each
+             label present in the labelImage
+             altAxis, aziAxis
+    '''
+
+    pixelSize = np.float(pixelSize)
+
+    if visualFieldOrigin:
+        altMap = altMap - visualFieldOrigin[0]
+        aziMap = aziMap - visualFieldOrigin[1]
+
+    altAxis = np.arange(altRange[0], altRange[1], pixelSize)
+    aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
+
+    labels = np.unique(labelImage[labelImage > 0])
+
+    labelInd = np.flatnonzero(labelImage > 0)
+    corAlt = altMap.flat[labelInd]
+    corAzi = aziMap.flat[labelInd]
+    isInRange = (corAlt >= altRange[0]) & (corAlt <= altRange[1]) & (corAzi >= aziRange[0]) & (corAzi <= aziRange[1])
+    labelInd = labelInd[isInRange]
+
+    indAlt = ((corAlt[isInRange] - altRange[0]) // pixelSize).astype(np.int64)
+    indAzi = ((corAzi[isInRange] - aziRange[0]) // pixelSize).astype(np.int64)
+
+    # pixels exactly on the upper edges of the ranges fall outside the visual space axes
+    isInAxes = (indAlt < len(altAxis)) & (indAzi < len(aziAxis))
+
+    visualSpaces = np.zeros((len(labels), len(altAxis), len(aziAxis)), dtype=np.uint8)
+    visualSpaces[np.searchsorted(labels, labelImage.flat[labelInd[isInAxes]]), indAlt[isInAxes], indAzi[isInAxes]] = 1
+
+    if closeIter is not None and closeIter >= 1:
+        # close each patch's visual space independently
+        structure = ni.generate_binary_structure(2, 1)[None, :, :]
+        visualSpaces = ni.binary_closing(visualSpaces, structure=structure, iterations=closeIter)
+
+    return dict([(label, visualSpaces[i]) for i, label in enumerate(labels)]), altAxis, aziAxis
+
+
 def sortPatches(patchDict):
     '''
     from a patch dictionary generate an new dictionary with patches sorted by there area
@@ -1462,17 +1653,13 @@ class RetinotopicMappingTrial(object):
                 rawPatches.pop(key)
 
         # remove isolated Patches
-        rawPatches2 = dict(rawPatches)
-        for key in rawPatches2.iterkeys():
-            isTouching = 0
-            for key2 in rawPatches2.iterkeys():
-                if key != key2:
-                    if rawPatches2[key].isTouching(rawPatches2[key2], borderWidth * 2):
-                        isTouching = 1
-                        break
-
-            if isTouching == 0:
-                rawPatches.pop(key)
+        if len(rawPatches) > 0:
+            labelImage, patchKeys = getPatchLabelImage(rawPatches)
+            adjLabels = getPatchAdjacency(labelImage, distance=borderWidth * 2)
+            touchingLabels = set([l for pair in adjLabels for l in pair])
+            for i, key in enumerate(patchKeys):
+                if (i + 1) not in touchingLabels:
+                    rawPatches.pop(key)
 
         rawPatches = sortPatches(rawPatches)
 
@@ -1583,11 +1770,20 @@ class RetinotopicMappingTrial(object):
         overlapPatches = []
         newPatchesDict = {}
 
+        # visual spaces of all raw patches in one call
+        labelImage, patchKeys = getPatchLabelImage(patches)
+        visualSpaces, altAxis, aziAxis = getVisualSpaces(labelImage,
+                                                         altPosMapf,
+                                                         aziPosMapf,
+                                                         pixelSize=visualSpacePixelSize,
+                                                         closeIter=visualSpaceCloseIter)
+
         for key, value in patches.iteritems():
-            visualSpace, _, _ = value.getVisualSpace(altPosMapf,
-                                                     aziPosMapf,
-                                                     pixelSize=visualSpacePixelSize,
-                                                     closeIter=visualSpaceCloseIter)
+            patchLabel = patchKeys.index(key) + 1
+            if patchLabel in visualSpaces:
+                visualSpace = visualSpaces[patchLabel]
+            else:
+                visualSpace = np.zeros((len(altAxis), len(aziAxis)), dtype=np.uint8)
             AU = np.sum(visualSpace[:]) * (visualSpacePixelSize ** 2)
 
             AS = value.getSigmaArea(detMap)
@@ -3426,40 +3622,14 @@ class Patch(object):
         eccentricity map of a cortical patch
         '''
 
-        #        altRange = np.array([np.amin(altMap)-10., np.amax(altMap)+10.])
-        #        aziRange = np.array([np.amin(aziMap)-10., np.amax(aziMap)+10.])
-
-        pixelSize = np.float(pixelSize)
-
-        if visualFieldOrigin:
-            altMap = altMap - visualFieldOrigin[0]
-            aziMap = aziMap - visualFieldOrigin[1]
-
-        # altAxis = np.arange(altRange[0], altRange[1], pixelSize)[::-1]
-        # aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
-
-        # visualSpace = np.zeros((np.ceil((altRange[1] - altRange[0]) / pixelSize),
-        #                         np.ceil((aziRange[1] - aziRange[0]) / pixelSize)))
-
-        altAxis = np.arange(altRange[0], altRange[1], pixelSize)
-        aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
-
-        visualSpace = np.zeros((len(altAxis), len(aziAxis)), dtype=np.uint8)
-
-        patchArray = self.array
-        for i in range(patchArray.shape[0]):
-            for j in range(patchArray.shape[1]):
-                if patchArray[i, j]:
-                    corAlt = altMap[i, j]
-                    corAzi = aziMap[i, j]
-                    if (corAlt >= altRange[0]) & (corAlt <= altRange[1]) & (corAzi >= aziRange[0]) & (
-                            corAzi <= aziRange[1]):
-                        indAlt = (corAlt - altRange[0]) // pixelSize
-                        indAzi = (corAzi - aziRange[0]) // pixelSize
-                        visualSpace[int(indAlt), int(indAzi)] = 1
+        visualSpaces, altAxis, aziAxis = getVisualSpaces(self.array, altMap, aziMap, altRange=altRange,
+                                                         aziRange=aziRange, visualFieldOrigin=visualFieldOrigin,
+                                                         pixelSize=pixelSize, closeIter=closeIter)
 
-        if closeIter >= 1:
-            visualSpace = ni.binary_closing(visualSpace, iterations=closeIter)
+        if 1 in visualSpaces:
+            visualSpace = visualSpaces[1]
+        else:  # empty patch
+            visualSpace = np.zeros((len(altAxis), len(aziAxis)), dtype=np.uint8)
 
         if isplot:
             f = plt.figure()
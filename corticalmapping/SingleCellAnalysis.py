@@ -268,17 +268,15 @@ def get_strf_from_nwb(h5_grp, roi_ind, trace_type='sta_f_center_subtracted', loc
 def get_dgc_response_matrix_from_nwb(h5_grp, roi_ind, trace_type='sta_f_center_subtracted'):
     sta_ts = h5_grp.attrs['sta_timestamps']
 
-    dgcrm = DataFrame([], columns=['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad', 'onset_ts', 'matrix'])
-
     condi_ns = h5_grp.keys()
     condi_ns.sort()
 
+    rows = []
+
     for condi_i, condi_n in enumerate(condi_ns):
 
         condi_grp = h5_grp[condi_n]
 
-        alt, azi, sf, tf, dire, con, rad = get_dgc_condition_params(condi_name=condi_n)
-
         if 'global_trigger_timestamps' in condi_grp.attrs:
             onset_ts = condi_grp.attrs['global_trigger_timestamps']
         else:
@@ -286,19 +284,106 @@ def get_dgc_response_matrix_from_nwb(h5_grp, roi_ind, trace_type='sta_f_center_s
 
         matrix = condi_grp[trace_type][roi_ind, :, :]
 
-        dgcrm.loc[condi_i, 'alt'] = alt
-        dgcrm.loc[condi_i, 'azi'] = azi
-        dgcrm.loc[condi_i, 'sf'] = sf
-        dgcrm.loc[condi_i, 'tf'] = tf
-        dgcrm.loc[condi_i, 'dire'] = dire
-        dgcrm.loc[condi_i, 'con'] = con
-        dgcrm.loc[condi_i, 'rad'] = rad
-        dgcrm.loc[condi_i, 'onset_ts'] = onset_ts
-        dgcrm.loc[condi_i, 'matrix'] = matrix
+        rows.append(list(get_dgc_condition_params(condi_name=condi_n)) + [onset_ts, matrix])
+
+    dgcrm = DataFrame(rows, columns=['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad', 'onset_ts', 'matrix'])
 
     return DriftingGratingResponseMatrix(sta_ts=sta_ts, trace_type=trace_type, data=dgcrm)
 
 
+def _read_roi_rows(dset, roi_inds, max_span_ratio=4.):
+    """
+    read the rows of a set of rois from a h5py dataset (first dimension is roi). roi_inds do not need to be sorted or
+    contiguous. if the rois are dense, all rows from the smallest to the largest index are read in one contiguous
+    read. if they are sparse (the span is longer than max_span_ratio times the number of rois), only the requested
+    rows are read, so a few rois far apart do not load all the rows in between.
+
+    :param dset: h5py dataset or array
+    :param roi_inds: list of int
+    :param max_span_ratio: float, maximum ratio between the number of rows read and the number of unique rois for
+                           the contiguous read
+    :return: array, first dimension has the same length as roi_inds
+    """
+    roi_inds = np.array(roi_inds, dtype=np.int64)
+    unique_inds, inverse = np.unique(roi_inds, return_inverse=True)
+    ind_min = unique_inds[0]
+    ind_max = unique_inds[-1]
+
+    if ind_max - ind_min + 1 <= max_span_ratio * len(unique_inds):
+        return dset[ind_min: ind_max + 1][roi_inds - ind_min]
+    else:
+        # h5py point selection needs increasing indices
+        return dset[list(unique_inds)][inverse]
+
+
+def get_strfs_from_nwb(h5_grp, roi_inds, trace_type='sta_f_center_subtracted', location_unit='degree'):
+    """
+    batch version of get_strf_from_nwb(), each probe dataset is read only once for all rois
+
+    :return: list of SpatialTemporalReceptiveField objects, one for each roi in roi_inds
+    """
+
+    sta_ts = h5_grp.attrs['sta_timestamps']
+
+    probe_ns = h5_grp.keys()
+    probe_ns.sort()
+
+    locations = []
+    signs = []
+    probe_traces = []
+    trigger_ts = []
+
+    for probe_i, probe_n in enumerate(probe_ns):
+
+        locations.append([float(probe_n[3:9]), float(probe_n[13:19])])
+        signs.append(int(probe_n[24:26]))
+
+        probe_traces.append(_read_roi_rows(h5_grp['{}/{}'.format(probe_n, trace_type)], roi_inds))
+        trigger_ts.append(h5_grp['{}/global_trigger_timestamps'.format(probe_n)].value)
+
+    strfs = []
+    for i, roi_ind in enumerate(roi_inds):
+        strfs.append(SpatialTemporalReceptiveField(locations=locations, signs=signs,
+                                                   traces=[t[i] for t in probe_traces], time=sta_ts,
+                                                   trigger_ts=trigger_ts, name='roi_{:04d}'.format(roi_ind),
+                                                   locationUnit=location_unit, trace_data_type=trace_type))
+    return strfs
+
+
+def get_dgc_response_matrices_from_nwb(h5_grp, roi_inds, trace_type='sta_f_center_subtracted'):
+    """
+    batch version of get_dgc_response_matrix_from_nwb(), each condition dataset is read only once for all rois
+
+    :return: list of DriftingGratingResponseMatrix objects, one for each roi in roi_inds
+    """
+    sta_ts = h5_grp.attrs['sta_timestamps']
+
+    condi_ns = h5_grp.keys()
+    condi_ns.sort()
+
+    condi_params = []
+    condi_matrices = []
+
+    for condi_i, condi_n in enumerate(condi_ns):
+
+        condi_grp = h5_grp[condi_n]
+
+        if 'global_trigger_timestamps' in condi_grp.attrs:
+            onset_ts = condi_grp.attrs['global_trigger_timestamps']
+        else:
+            onset_ts = []
+
+        condi_params.append(list(get_dgc_condition_params(condi_name=condi_n)) + [onset_ts])
+        condi_matrices.append(_read_roi_rows(condi_grp[trace_type], roi_inds))
+
+    dgcrms = []
+    for i in range(len(roi_inds)):
+        rows = [condi_param + [condi_matrix[i]] for condi_param, condi_matrix in zip(condi_params, condi_matrices)]
+        dgcrm = DataFrame(rows, columns=['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad', 'onset_ts', 'matrix'])
+        dgcrms.append(DriftingGratingResponseMatrix(sta_ts=sta_ts, trace_type=trace_type, data=dgcrm))
+    return dgcrms
+
+
 def get_local_similarity_index(mask1, mask2):
     """
     calculate local similarity index between two receptive field maps
@@ -1359,6 +1444,458 @@ class SpatialTemporalReceptiveField(object):
         pass
 
 
+class DenseSpatialTemporalReceptiveField(object):
+    """
+    dense array version of SpatialTemporalReceptiveField. All traces are saved in one 3d array with shape
+    (probe, trial, time_point), probes with fewer trials are padded by nan, the trial number of each probe is saved
+    in self.trial_nums. Probe coordinates are saved in 1d arrays: self.altitudes, self.azimuths and self.signs.
+    Probes are always sorted by altitude, azimuth and sign.
+
+    maps and receptive fields are calculated with array operations instead of looping through probes. It can be
+    converted to and from SpatialTemporalReceptiveField by self.to_strf() and
+    DenseSpatialTemporalReceptiveField.from_strf()
+    """
+
+    def __init__(self,
+                 locations,
+                 signs,
+                 traces,
+                 time,
+                 trigger_ts=None,
+                 trial_nums=None,
+                 name=None,
+                 locationUnit='degree',
+                 trace_data_type='dF_over_F'):
+        """
+        locations : list, tuple or 2-d array of retinotopic locations mapped
+            each element has two float numbers: [altitude, azimuth]
+
+        signs: list, tuple or 1d array of signs for each location
+
+        traces: 3d array (probe, trial, time_point) or list of 2d arrays (trial, time_point) for each location
+
+        time: time axis for trace
+
+        trigger_ts: None, 2d array (probe, trial) or list of 1d arrays, global trigger timestamps of each trial
+
+        trial_nums: None or 1d array of int, number of valid trials of each probe. Only used when traces is a 3d
+            array padded by nan, if None, all trials in traces are valid
+        """
+
+        self.time = np.array(time, dtype=np.float32)
+        locations = np.array(locations, dtype=np.float32).reshape((-1, 2))
+        signs = np.array(signs, dtype=np.float32)
+
+        if isinstance(traces, np.ndarray) and len(traces.shape) == 3:
+            traces = traces.astype(np.float32)
+            if trial_nums is None:
+                trial_nums = np.full(traces.shape[0], traces.shape[1], dtype=np.int64)
+        else:
+            traces = [np.array([np.array(t, dtype=np.float32) for t in trace]).reshape((-1, len(self.time)))
+                      for trace in traces]
+            trial_nums = np.array([len(trace) for trace in traces], dtype=np.int64)
+            traces = self._pad(traces, shape=(len(self.time),))
+
+        trial_nums = np.array(trial_nums, dtype=np.int64)
+
+        if traces.shape[2] != len(self.time):
+            raise ValueError('the shape of traces: {} is not consistent with length of time axis: {:d}.'
+                             .format(traces.shape, len(self.time)))
+
+        if not (len(locations) == len(signs) == len(traces) == len(trial_nums)):
+            raise ValueError('length of "locations", "signs", "traces" should be the same!')
+
+        if len(locations) == 0:
+            raise ValueError('Can not find input traces!')
+
+        if trigger_ts is None:
+            trigger_ts = np.full(traces.shape[0:2], np.nan, dtype=np.float32)
+        elif isinstance(trigger_ts, np.ndarray) and len(trigger_ts.shape) == 2:
+            trigger_ts = trigger_ts.astype(np.float32)
+        else:
+            if len(trigger_ts) != len(locations):
+                raise ValueError('length of trigger_ts: {:d} is not consistent with number of probes: {:d}.'
+                                 .format(len(trigger_ts), len(locations)))
+            trigger_ts = self._pad([np.array(ts, dtype=np.float32).flatten() for ts in trigger_ts], shape=())
+
+        # trigger_ts are always aligned with traces along the trial axis
+        trigger_ts_pad = np.full(traces.shape[0:2], np.nan, dtype=np.float32)
+        trial_num_ts = min(trigger_ts.shape[1], traces.shape[1])
+        trigger_ts_pad[:, 0:trial_num_ts] = trigger_ts[:, 0:trial_num_ts]
+
+        self.altitudes = locations[:, 0]
+        self.azimuths = locations[:, 1]
+        self.signs = signs
+        self.traces = traces
+        self.trial_nums = trial_nums
+        self.trigger_ts = trigger_ts_pad
+
+        self.name = str(name)
+        self.locationUnit = str(locationUnit)
+        self.trace_data_type = str(trace_data_type)
+
+        self.sort_probes()
+
+    @staticmethod
+    def _pad(arrs, shape):
+        """
+        stack a list of arrays with different lengths along first axis into one array padded by nan
+
+        :param arrs: list of arrays, each with shape (n_i,) + shape
+        :param shape: tuple, shape of each element
+        :return: array, (len(arrs), max(n_i)) + shape
+        """
+        max_len = max([len(arr) for arr in arrs] + [0])
+        padded = np.full((len(arrs), max_len) + tuple(shape), np.nan, dtype=np.float32)
+        for arr_i, arr in enumerate(arrs):
+            padded[arr_i, 0:len(arr)] = arr
+        return padded
+
+    def _set_probes(self, probe_inds):
+        self.altitudes = self.altitudes[probe_inds]
+        self.azimuths = self.azimuths[probe_inds]
+        self.signs = self.signs[probe_inds]
+        self.traces = self.traces[probe_inds]
+        self.trial_nums = self.trial_nums[probe_inds]
+        self.trigger_ts = self.trigger_ts[probe_inds]
+
+    def sort_probes(self):
+        self._set_probes(np.lexsort((self.signs, self.azimuths, self.altitudes)))
+
+    def get_probes(self):
+        return list(np.array([self.altitudes, self.azimuths, self.signs]).transpose())
+
+    def get_probe_num(self):
+        return len(self.signs)
+
+    def get_trial_mask(self):
+        """
+        :return: 2d boolean array, (probe, trial), True for valid trials, False for padding
+        """
+        return np.arange(self.traces.shape[1])[None, :] < self.trial_nums[:, None]
+
+    def get_mean_traces(self):
+        """
+        :return: 2d array, (probe, time_point), mean trace across trials of each probe
+        """
+        trial_mask = self.get_trial_mask()
+        sum_traces = np.sum(np.where(trial_mask[:, :, None], self.traces, 0.), axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sum_traces / self.trial_nums[:, None].astype(np.float32)
+
+    def merge_duplication(self):
+        """
+        merge probes with same altitude, azimuth and sign, trials are concatenated in the order of probes.
+        """
+
+        probes = np.array([self.altitudes, self.azimuths, self.signs]).transpose()
+        uni_probes, probe_grp_inds = np.unique(probes, axis=0, return_inverse=True)
+        probe_grp_inds = probe_grp_inds.flatten()
+
+        if len(uni_probes) == len(probes):
+            return
+
+        trial_mask = self.get_trial_mask()
+        src_probe_inds, src_trial_inds = np.nonzero(trial_mask) # sorted by probe then trial
+        dst_grp_inds = probe_grp_inds[src_probe_inds]
+
+        # position of each trial in its merged probe, keeping the order of the original probes
+        order = np.argsort(dst_grp_inds, kind='mergesort')
+        grp_trial_nums = np.bincount(dst_grp_inds, minlength=len(uni_probes))
+        grp_starts = np.concatenate(([0], np.cumsum(grp_trial_nums)[:-1]))
+        dst_trial_inds = np.empty(len(order), dtype=np.int64)
+        dst_trial_inds[order] = np.arange(len(order)) - np.repeat(grp_starts, grp_trial_nums)
+
+        traces = np.full((len(uni_probes), max(grp_trial_nums.max(), 0), self.traces.shape[2]), np.nan,
+                         dtype=np.float32)
+        traces[dst_grp_inds, dst_trial_inds] = self.traces[src_probe_inds, src_trial_inds]
+        trigger_ts = np.full(traces.shape[0:2], np.nan, dtype=np.float32)
+        trigger_ts[dst_grp_inds, dst_trial_inds] = self.trigger_ts[src_probe_inds, src_trial_inds]
+
+        self.altitudes = uni_probes[:, 0].astype(np.float32)
+        self.azimuths = uni_probes[:, 1].astype(np.float32)
+        self.signs = uni_probes[:, 2].astype(np.float32)
+        self.traces = traces
+        self.trial_nums = grp_trial_nums.astype(np.int64)
+        self.trigger_ts = trigger_ts
+        self.sort_probes()
+
+    def shrink(self, altRange=None, aziRange=None):
+        """
+        shrink the current spatial temporal receptive field into the defined altitude and/or azimuth range
+        """
+
+        if altRange is None and aziRange is None:
+            raise LookupError('At least one of altRange and aziRange should be defined!')
+
+        ind = np.ones(self.get_probe_num(), dtype=np.bool_)
+        if altRange is not None:
+            ind = ind & (self.altitudes >= altRange[0]) & (self.altitudes <= altRange[1])
+        if aziRange is not None:
+            ind = ind & (self.azimuths >= aziRange[0]) & (self.azimuths <= aziRange[1])
+
+        if np.sum(ind) == 0:
+            raise ValueError('No probes were sampled within the given altitude and azimuth range.')
+
+        self._set_probes(ind)
+
+    def _get_map_index(self):
+        """
+        return row and column indices of each probe in the 2d map, and the retinotopic coordinates of the map, the
+        retinotopic visual space was defined by np.meshgrid(allAziPos, allAltPos)
+        """
+
+        allAltPos = np.unique(self.altitudes)[::-1]
+        allAziPos = np.unique(self.azimuths)
+        rows = len(allAltPos) - 1 - np.searchsorted(allAltPos[::-1], self.altitudes)
+        cols = np.searchsorted(allAziPos, self.azimuths)
+
+        for sign in [1, -1]:
+            sign_ind = self.signs == sign
+            flat_ind = rows[sign_ind] * len(allAziPos) + cols[sign_ind]
+            if len(np.unique(flat_ind)) < len(flat_ind):
+                raise LookupError('Duplication of trace items found for sign: {:d}!'.format(sign))
+
+        return rows, cols, allAltPos, allAziPos
+
+    def _to_maps(self, values):
+        """
+        put one value of each probe into ON and OFF 2d maps, pixels without probe are nan
+        """
+
+        rows, cols, allAltPos, allAziPos = self._get_map_index()
+
+        ampON = np.full((len(allAltPos), len(allAziPos)), np.nan)
+        ampOFF = ampON.copy()
+
+        ind_on = self.signs == 1
+        ind_off = self.signs == -1
+        ampON[rows[ind_on], cols[ind_on]] = values[ind_on]
+        ampOFF[rows[ind_off], cols[ind_off]] = values[ind_off]
+
+        return ampON, ampOFF, allAltPos, allAziPos
+
+    def get_amplitude_map(self, timeWindow=(0, 0.5)):
+        """
+        return 2d receptive field map and altitude and azimuth coordinates
+        each pixel in the map represent mean amplitute of traces within the window defined by timeWindow, and the
+        coordinate of each pixel is defined by np.meshgrid(allAziPos, allAltPos)
+        """
+        windowIndex = np.logical_and(self.time >= timeWindow[0], self.time <= timeWindow[1])
+        return self._to_maps(np.mean(self.get_mean_traces()[:, windowIndex], axis=1))
+
+    def get_delta_amplitude_map(self, timeWindow=(0, 0.5)):
+        """
+        return 2d receptive field map and altitude and azimuth coordinates
+        each pixel in the map represent mean delta amplitute (raw amplitude minus the mean amplitude before trigger
+        onset) of traces within the window defined by timeWindow, and the
+        coordinate of each pixel is defined by np.meshgrid(allAziPos, allAltPos)
+        """
+        windowIndex = np.logical_and(self.time >= timeWindow[0], self.time <= timeWindow[1])
+        mean_traces = self.get_mean_traces()
+        baselines = np.mean(mean_traces[:, self.time < 0], axis=1)
+        return self._to_maps(np.mean(mean_traces[:, windowIndex], axis=1) - baselines)
+
+    def get_zscore_map(self, timeWindow=(0, 0.5)):
+        """
+        return 2d receptive field and altitude and azimuth coordinates
+        each pixel in the map represent Z score of mean amplitute of traces within the window defined by timeWindow
+        """
+        ampON, ampOFF, allAltPos, allAziPos = self.get_amplitude_map(timeWindow)
+        return ia.zscore(ampON), ia.zscore(ampOFF), allAltPos, allAziPos
+
+    def get_amplitude_receptive_field(self, timeWindow=(0, 0.5)):
+        ampON, ampOFF, allAltPos, allAziPos = self.get_amplitude_map(timeWindow)
+        ampRFON = SpatialReceptiveField(mask=ampON, altPos=allAltPos, aziPos=allAziPos, sign=1,
+                                        temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                        dataType='amplitude')
+        ampRFOFF = SpatialReceptiveField(mask=ampOFF, altPos=allAltPos, aziPos=allAziPos, sign=-1,
+                                         temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                         dataType='amplitude')
+        return ampRFON, ampRFOFF
+
+    def get_delta_amplitude_receptive_field(self, timeWindow=(0, 0.5)):
+        ampON, ampOFF, allAltPos, allAziPos = self.get_delta_amplitude_map(timeWindow)
+        ampRFON = SpatialReceptiveField(mask=ampON, altPos=allAltPos, aziPos=allAziPos, sign=1,
+                                        temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                        dataType='delta_amplitude')
+        ampRFOFF = SpatialReceptiveField(mask=ampOFF, altPos=allAltPos, aziPos=allAziPos, sign=-1,
+                                         temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                         dataType='delta_amplitude')
+        return ampRFON, ampRFOFF
+
+    def get_zscore_receptive_field(self, timeWindow=(0, 0.5)):
+        zscoreON, zscoreOFF, allAltPos, allAziPos = self.get_zscore_map(timeWindow)
+        zscoreRFON = SpatialReceptiveField(mask=zscoreON, altPos=allAltPos, aziPos=allAziPos, sign='ON',
+                                           temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                           dataType='zscore')
+        zscoreRFOFF = SpatialReceptiveField(mask=zscoreOFF, altPos=allAltPos, aziPos=allAziPos, sign='OFF',
+                                            temporalWindow=timeWindow, pixelSizeUnit=self.locationUnit,
+                                            dataType='zscore')
+        return zscoreRFON, zscoreRFOFF
+
+    def _get_local_normalized_strf(self, is_collaps_before_normalize, add_to_trace, is_dff):
+
+        bl_inds = self.time <= 0
+
+        if is_collaps_before_normalize:
+            traces = self.get_mean_traces()[:, None, :] + add_to_trace
+            trial_nums = np.ones(self.get_probe_num(), dtype=np.int64)
+            trigger_ts = None
+        else:
+            traces = self.traces + add_to_trace
+            trial_nums = self.trial_nums
+            trigger_ts = self.trigger_ts
+
+        baselines = np.mean(traces[:, :, bl_inds], axis=2, keepdims=True)
+        traces = traces - baselines
+        if is_dff:
+            traces = traces / baselines
+            data_type = self.trace_data_type + '_local_dff'
+        else:
+            data_type = self.trace_data_type + '_local_df'
+
+        return DenseSpatialTemporalReceptiveField(locations=np.array([self.altitudes, self.azimuths]).transpose(),
+                                                  signs=self.signs, traces=traces, time=self.time,
+                                                  trigger_ts=trigger_ts, trial_nums=trial_nums, name=self.name,
+                                                  locationUnit=self.locationUnit, trace_data_type=data_type)
+
+    def get_local_dff_strf(self, is_collaps_before_normalize=True, add_to_trace=0.):
+        """
+        :param is_collaps_before_normalize: if True, for each location, the traces across multiple trials will be
+                                            averaged before calculating df/f
+        :return: DenseSpatialTemporalReceptiveField
+        """
+        return self._get_local_normalized_strf(is_collaps_before_normalize, add_to_trace, is_dff=True)
+
+    def get_local_df_strf(self, is_collaps_before_normalize=True, add_to_trace=0.):
+        """
+        :param is_collaps_before_normalize: if True, for each location, the traces across multiple trials will be
+                                            averaged before calculating df
+        :return: DenseSpatialTemporalReceptiveField
+        """
+        return self._get_local_normalized_strf(is_collaps_before_normalize, add_to_trace, is_dff=False)
+
+    def to_strf(self):
+        """
+        :return: SpatialTemporalReceptiveField object with the same probes and traces
+        """
+        traces = [self.traces[i, 0:n] for i, n in enumerate(self.trial_nums)]
+        trigger_ts = [self.trigger_ts[i, 0:n] for i, n in enumerate(self.trial_nums)]
+        trigger_ts = [ts if not np.all(np.isnan(ts)) else [] for ts in trigger_ts]
+        return SpatialTemporalReceptiveField(locations=np.array([self.altitudes, self.azimuths]).transpose(),
+                                             signs=self.signs, traces=traces, time=self.time,
+                                             trigger_ts=trigger_ts, name=self.name, locationUnit=self.locationUnit,
+                                             trace_data_type=self.trace_data_type)
+
+    @staticmethod
+    def from_strf(strf):
+        """
+        :param strf: SpatialTemporalReceptiveField object
+        :return: DenseSpatialTemporalReceptiveField object
+        """
+        trigger_ts = [ts if len(ts) > 0 else np.full(len(tr), np.nan) for ts, tr in
+                      zip(strf.data['trigger_ts'], strf.data['traces'])]
+        return DenseSpatialTemporalReceptiveField(locations=np.array([strf.data['altitude'],
+                                                                      strf.data['azimuth']]).transpose(),
+                                                  signs=np.array(strf.data['sign']),
+                                                  traces=list(strf.data['traces']), time=strf.time,
+                                                  trigger_ts=trigger_ts, name=strf.name,
+                                                  locationUnit=strf.locationUnit,
+                                                  trace_data_type=strf.trace_data_type)
+
+    def to_h5_group(self, h5Group):
+        """
+        save into a hdf5 group, all traces are saved in one dataset 'traces' (probe, trial, time_point)
+        """
+
+        h5Group.attrs['time'] = self.time
+        h5Group.attrs['time_unit'] = 'second'
+        h5Group.attrs['retinotopic_location_unit'] = self.locationUnit
+        h5Group.attrs['trace_data_type'] = self.trace_data_type
+        h5Group.attrs['trace_shape'] = '(probe, trial, time_point)'
+        h5Group.attrs['name'] = self.name
+
+        h5Group.create_dataset('traces', data=self.traces, dtype='f')
+        h5Group.create_dataset('trial_nums', data=self.trial_nums)
+        h5Group.create_dataset('trigger_ts_sec', data=self.trigger_ts, dtype='f')
+        probes = h5Group.create_dataset('probes', data=np.array([self.altitudes, self.azimuths, self.signs]).T,
+                                        dtype='f')
+        probes.attrs['columns'] = 'altitude, azimuth, sign'
+
+    @staticmethod
+    def from_h5_group(h5Group):
+        """
+        load DenseSpatialTemporalReceptiveField object from a hdf5 data group saved by self.to_h5_group()
+        """
+        probes = h5Group['probes'][()]
+        return DenseSpatialTemporalReceptiveField(locations=probes[:, 0:2], signs=probes[:, 2],
+                                                  traces=h5Group['traces'][()], time=h5Group.attrs['time'],
+                                                  trigger_ts=h5Group['trigger_ts_sec'][()],
+                                                  trial_nums=h5Group['trial_nums'][()],
+                                                  name=h5Group.attrs['name'],
+                                                  locationUnit=h5Group.attrs['retinotopic_location_unit'],
+                                                  trace_data_type=h5Group.attrs['trace_data_type'])
+
+
+def _stack_trial_matrices(matrices, trace_len, dtype=np.float64):
+    """
+    stack a list of 2d matrices (trial x time point) with different trial numbers into one 3d array
+    (condition x trial x time point), conditions with fewer trials are padded by nan
+
+    :param matrices: list of 2d arrays
+    :param trace_len: int, number of time points
+    :param dtype: data type of the stack
+    :return stack: 3d array, condition x trial x time point
+    :return trial_nums: 1d array of int, number of valid trials of each condition
+    """
+    trial_nums = np.array([m.shape[0] for m in matrices], dtype=np.int64)
+    max_trial_num = trial_nums.max() if len(trial_nums) > 0 else 0
+    stack = np.full((len(matrices), max_trial_num, trace_len), np.nan, dtype=dtype)
+    for condi_i, matrix in enumerate(matrices):
+        stack[condi_i, :matrix.shape[0]] = matrix
+    return stack, trial_nums
+
+
+def _unstack_trial_matrices(stack, trial_nums, dtype=None):
+    """
+    reverse of _stack_trial_matrices(), return a 1d object array of 2d matrices which can be assigned to a
+    DataFrame column directly
+    """
+    matrices = np.empty(len(trial_nums), dtype=object)
+    for condi_i, trial_num in enumerate(trial_nums):
+        matrix = stack[condi_i, :trial_num]
+        matrices[condi_i] = matrix if dtype is None else matrix.astype(dtype)
+    return matrices
+
+
+def _get_trial_mask(trial_nums, max_trial_num):
+    """
+    :return: 2d bool array, condition x trial, True for valid trials
+    """
+    return np.arange(max_trial_num)[None, :] < trial_nums[:, None]
+
+
+def _get_masked_trial_stats(values, trial_mask):
+    """
+    mean, max, min and standard deviation across valid trials for each condition, conditions without valid trials
+    get nan
+
+    :param values: 2d array, condition x trial
+    :param trial_mask: 2d bool array, condition x trial
+    :return: mean, max, min, std; each is a 1d array with length of condition number
+    """
+    ns = np.sum(trial_mask, axis=1).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.sum(np.where(trial_mask, values, 0.), axis=1) / ns
+        stds = np.sqrt(np.sum(np.where(trial_mask, (values - means[:, None]) ** 2, 0.), axis=1) / ns)
+    maxs = np.max(np.where(trial_mask, values, -np.inf), axis=1) if values.shape[1] > 0 else np.full(len(ns), -np.inf)
+    mins = np.min(np.where(trial_mask, values, np.inf), axis=1) if values.shape[1] > 0 else np.full(len(ns), np.inf)
+    maxs[ns == 0] = np.nan
+    mins[ns == 0] = np.nan
+    return means, maxs, mins, stds
+
+
 class DriftingGratingResponseMatrix(DataFrame):
     """
     class for response matrix to drifting grating circle
@@ -1410,27 +1947,122 @@ class DriftingGratingResponseMatrix(DataFrame):
 
         sta_ts_len = self.sta_ts.shape[0]
 
-        for row_i, row in self.iterrows():
+        if len(self) == 0:
+            return
 
-            if len(row['onset_ts']) == 0:
-                pass
-                # print('condition: {}. No onset timestamps available.'.format(self.get_condition_name(row_i)))
-            else:
-                if (len(row['onset_ts'].shape) != 1):
-                    raise ValueError(
-                        'condition: {}, onset_ts should be 1-d array.'.format(self.get_condition_name(row_i)))
+        row_inds = self.index.values
+        onset_shapes = [np.shape(o) for o in self['onset_ts'].values]
+        matrix_shapes = [np.shape(m) for m in self['matrix'].values]
+
+        onset_nums = np.array([s[0] if len(s) > 0 else 0 for s in onset_shapes])
+        onset_dims = np.array([len(s) for s in onset_shapes])
+        matrix_dims = np.array([len(s) for s in matrix_shapes])
 
-                if row['matrix'].shape[0] != row['onset_ts'].shape[0]:
-                    print('condition: {}, mismatched trial number ({}) and onset number ({}).'
-                                     .format(self.get_condition_name(row_i), row['matrix'].shape[0],
-                                             row['onset_ts'].shape[0]))
+        bad_onset = np.logical_and(onset_nums > 0, onset_dims != 1)
+        if bad_onset.any():
+            raise ValueError('condition: {}, onset_ts should be 1-d array.'
+                             .format(self.get_condition_name(row_inds[np.argmax(bad_onset)])))
 
-            if len(row['matrix'].shape) != 2:
-                raise ValueError('condition: {}, onset_ts should be 2-d array.'.format(self.get_condition_name(row_i)))
+        if (matrix_dims != 2).any():
+            raise ValueError('condition: {}, onset_ts should be 2-d array.'
+                             .format(self.get_condition_name(row_inds[np.argmax(matrix_dims != 2)])))
 
-            if row['matrix'].shape[1] != sta_ts_len:
-                raise ValueError('condition: {}, mismatched trace length ({}) and sta ts length ({}).'
-                                 .format(self.get_condition_name(row_i), row['matrix'].shape[1], sta_ts_len))
+        trial_nums = np.array([s[0] for s in matrix_shapes])
+        trace_lens = np.array([s[1] for s in matrix_shapes])
+
+        for i in np.nonzero(np.logical_and(onset_nums > 0, trial_nums != onset_nums))[0]:
+            print('condition: {}, mismatched trial number ({}) and onset number ({}).'
+                  .format(self.get_condition_name(row_inds[i]), trial_nums[i], onset_nums[i]))
+
+        if (trace_lens != sta_ts_len).any():
+            i = np.argmax(trace_lens != sta_ts_len)
+            raise ValueError('condition: {}, mismatched trace length ({}) and sta ts length ({}).'
+                             .format(self.get_condition_name(row_inds[i]), trace_lens[i], sta_ts_len))
+
+    def get_matrix_stack(self, dtype=np.float64):
+        """
+        stack the response matrices of all conditions into one 3d array (condition x trial x time point), conditions
+        with fewer trials are padded by nan. The order of conditions is the same as the rows of self.
+
+        :param dtype: data type of the stack
+        :return stack: 3d array, condition x trial x time point
+        :return trial_nums: 1d array of int, number of valid trials of each condition
+        """
+        return _stack_trial_matrices(list(self['matrix'].values), trace_len=self.sta_ts.shape[0], dtype=dtype)
+
+    def _from_matrix_stack(self, stack, trial_nums, trace_type, dtype=None):
+        """
+        return a copy of self with the 'matrix' column replaced by the matrices in a 3d stack
+        """
+        dgcrm = self.copy()
+        dgcrm['matrix'] = _unstack_trial_matrices(stack, trial_nums, dtype=dtype)
+        return DriftingGratingResponseMatrix(sta_ts=self.sta_ts, trace_type=trace_type, data=dgcrm)
+
+    def _get_trial_window_means(self, windows, stack, trial_nums):
+        """
+        mean of each trial within each time window, all conditions are calculated together
+
+        :param windows: list of time windows, each is [start, end] in seconds, start exclusive and end inclusive
+        :param stack: 3d array, condition x trial x time point, returned by self.get_matrix_stack()
+        :param trial_nums: 1d array of int, number of valid trials of each condition
+        :return trial_mask: 2d bool array, condition x trial, True for valid trials
+        :return window_means: list of 2d arrays (condition x trial), one for each window
+        """
+        trial_mask = _get_trial_mask(trial_nums, stack.shape[1])
+        window_means = []
+        for win in windows:
+            win_ind = np.logical_and(self.sta_ts > win[0], self.sta_ts <= win[1])
+            with np.errstate(invalid='ignore'):
+                window_means.append(np.mean(stack[:, :, win_ind], axis=2))
+        return trial_mask, window_means
+
+    def _get_response_table_from_trial_responses(self, trial_responses, trial_mask, trace_type, resp_mean=None):
+        """
+        fill response table with statistics across trials
+
+        :param trial_responses: 2d array, condition x trial
+        :param trial_mask: 2d bool array, condition x trial
+        :param resp_mean: 1d array, if None, the mean of trial_responses is used as 'resp_mean'
+        :return: DriftingGratingResponseTable object
+        """
+        means, maxs, mins, stds = _get_masked_trial_stats(trial_responses, trial_mask)
+        ns = np.sum(trial_mask, axis=1)
+
+        dgcrt = self.loc[:, ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']]
+        dgcrt['resp_mean'] = means if resp_mean is None else resp_mean
+        dgcrt['resp_max'] = maxs
+        dgcrt['resp_min'] = mins
+        dgcrt['resp_std'] = stds
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dgcrt['resp_stdev'] = stds / np.sqrt(ns)
+        return DriftingGratingResponseTable(trace_type=trace_type, data=dgcrt)
+
+    @staticmethod
+    def _get_p_values(response_table, trial_responses, trial_nums):
+        """
+        one-way anova across all conditions and paired ttest of peak positive and peak negative conditions
+        against blank condition.
+
+        :return p_anova, p_ttest_pos, p_ttest_neg:
+        """
+
+        trial_responses = [r[:n] for r, n in zip(trial_responses, trial_nums)]
+
+        _, p_anova = stats.f_oneway(*trial_responses)
+
+        if response_table.blank_condi_ind is None:
+            return p_anova, None, None
+
+        responses_blank = trial_responses[response_table.blank_condi_ind]
+        responses_peak_pos = trial_responses[response_table.peak_condi_ind_pos]
+        responses_peak_neg = trial_responses[response_table.peak_condi_ind_neg]
+
+        n_min_pos = np.min([len(responses_blank), len(responses_peak_pos)])
+        _, p_ttest_pos = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_pos[0:n_min_pos])
+        n_min_neg = np.min([len(responses_blank), len(responses_peak_neg)])
+        _, p_ttest_neg = stats.ttest_rel(responses_blank[0:n_min_neg], responses_peak_neg[0:n_min_neg])
+
+        return p_anova, p_ttest_pos, p_ttest_neg
 
     def get_df_response_matrix(self, baseline_win=(-0.5, 0.)):
         """
@@ -1442,15 +2074,10 @@ class DriftingGratingResponseMatrix(DataFrame):
 
         baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
 
-        dgcrm_df = self.copy()
-
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix'].astype(np.float64)
-            curr_baseline = np.mean(curr_matrix[:, baseline_ind], axis=1, keepdims=True)
-            dgcrm_df.loc[row_i, 'matrix'] = curr_matrix - curr_baseline
+        stack, trial_nums = self.get_matrix_stack()
+        stack -= np.mean(stack[:, :, baseline_ind], axis=2, keepdims=True)
 
-        return DriftingGratingResponseMatrix(sta_ts=self.sta_ts, trace_type='{}_df'.format(self.trace_type),
-                                             data=dgcrm_df)
+        return self._from_matrix_stack(stack, trial_nums, trace_type='{}_df'.format(self.trace_type))
 
     def get_zscore_response_matrix(self, baseline_win=(-0.5, 0.)):
         """
@@ -1463,16 +2090,20 @@ class DriftingGratingResponseMatrix(DataFrame):
 
         baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
 
-        dgcrm_zscore = self.copy()
+        stack, trial_nums = self.get_matrix_stack()
+        trial_mask = _get_trial_mask(trial_nums, stack.shape[1])
 
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix'].astype(np.float64)
-            curr_baseline_mean = np.mean(curr_matrix[:, baseline_ind], axis=1, keepdims=True)
-            curr_baseline_std = np.std(curr_matrix[:, baseline_ind].flat)
-            dgcrm_zscore.loc[row_i, 'matrix'] = (curr_matrix - curr_baseline_mean) / curr_baseline_std
+        # std of all baseline data points of each condition, pooled across valid trials
+        baseline = stack[:, :, baseline_ind]
+        baseline_ns = np.sum(trial_mask, axis=1) * baseline.shape[2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            baseline_grand_mean = np.sum(np.where(trial_mask[:, :, None], baseline, 0.), axis=(1, 2)) / baseline_ns
+            baseline_std = np.sqrt(np.sum(np.where(trial_mask[:, :, None],
+                                                   (baseline - baseline_grand_mean[:, None, None]) ** 2, 0.),
+                                          axis=(1, 2)) / baseline_ns)
+            stack = (stack - np.mean(baseline, axis=2, keepdims=True)) / baseline_std[:, None, None]
 
-        return DriftingGratingResponseMatrix(sta_ts=self.sta_ts, trace_type='{}_zscore'.format(self.trace_type),
-                                             data=dgcrm_zscore)
+        return self._from_matrix_stack(stack, trial_nums, trace_type='{}_zscore'.format(self.trace_type))
 
     def get_dff_response_matrix(self, baseline_win=(-0.5, 0.), bias=0., warning_level=0.9):
         """
@@ -1488,30 +2119,24 @@ class DriftingGratingResponseMatrix(DataFrame):
 
         baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
 
-        dgcrm_dff = self.copy()
+        stack, trial_nums = self.get_matrix_stack()
+        stack += bias
+        baselines = np.mean(stack[:, :, baseline_ind], axis=2)
 
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix'].astype(np.float64)
-            curr_matrix = curr_matrix + bias
-            dff_matrix = np.empty(curr_matrix.shape, dtype=np.float32)
-            for trial_i in range(curr_matrix.shape[0]):
-                curr_trial = curr_matrix[trial_i, :]
-                curr_baseline = np.mean(curr_trial[baseline_ind])
+        trial_mask = _get_trial_mask(trial_nums, stack.shape[1])
+        with np.errstate(invalid='ignore'):
+            low_condi_inds, low_trial_inds = np.nonzero(np.logical_and(trial_mask, baselines <= warning_level))
+        for condi_i, trial_i in zip(low_condi_inds, low_trial_inds):
+            msg = '\ncondition:{}, trial:{}, baseline too low: {}'.format(self.get_condition_name(self.index[condi_i]),
+                                                                          trial_i,
+                                                                          baselines[condi_i, trial_i])
+            warnings.warn(msg, RuntimeWarning)
 
-                # print(curr_baseline)
-                if curr_baseline <= warning_level:
-                    msg = '\ncondition:{}, trial:{}, baseline too low: {}'.format(self.get_condition_name(row_i),
-                                                                                  trial_i,
-                                                                                  curr_baseline)
-                    warnings.warn(msg, RuntimeWarning)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stack = (stack - baselines[:, :, None]) / baselines[:, :, None]
 
-                curr_trial_dff = (curr_trial - curr_baseline) / curr_baseline
-                dff_matrix[trial_i, :] = curr_trial_dff
-
-            dgcrm_dff.loc[row_i, 'matrix'] = dff_matrix
-
-        return DriftingGratingResponseMatrix(sta_ts=self.sta_ts, trace_type='{}_dff'.format(self.trace_type),
-                                             data=dgcrm_dff)
+        return self._from_matrix_stack(stack, trial_nums, trace_type='{}_dff'.format(self.trace_type),
+                                       dtype=np.float32)
 
     def get_condition_trial_responses(self, condi_i, response_win=(0., 1.)):
         """
@@ -1537,40 +2162,41 @@ class DriftingGratingResponseMatrix(DataFrame):
         :return: DriftingGratingResponseMatrix object
         """
 
-        dgcrm_collapsed = self.copy()
+        matrices = list(self['matrix'].values)
+        stack, trial_nums = _stack_trial_matrices(matrices, trace_len=self.sta_ts.shape[0])
+        trial_mask = _get_trial_mask(trial_nums, stack.shape[1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_traces = np.sum(np.where(trial_mask[:, :, None], stack, 0.), axis=1, keepdims=True) / \
+                          trial_nums[:, None, None]
 
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix']
-            dgcrm_collapsed.loc[row_i, 'matrix'] = np.mean(curr_matrix, axis=0, keepdims=True)
-            dgcrm_collapsed.loc[row_i, 'onset_ts'] = []
+        # keep the floating point type of the original matrices
+        dtype = np.result_type(*[m.dtype for m in matrices]) if len(matrices) > 0 else np.float64
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+
+        dgcrm_collapsed = self.copy()
+        dgcrm_collapsed['matrix'] = _unstack_trial_matrices(mean_traces, np.ones(len(trial_nums), dtype=np.int64),
+                                                            dtype=dtype)
+        onset_ts = np.empty(len(dgcrm_collapsed), dtype=object)
+        for condi_i in range(len(onset_ts)):
+            onset_ts[condi_i] = []
+        dgcrm_collapsed['onset_ts'] = onset_ts
 
         return DriftingGratingResponseMatrix(sta_ts=self.sta_ts, trace_type='{}_collapsed'.format(self.trace_type),
                                              data=dgcrm_collapsed)
 
     def get_response_table(self, response_win=(0., 1.)):
 
-        response_ind = np.logical_and(self.sta_ts > response_win[0], self.sta_ts <= response_win[1])
-
-        dgcrt = self.loc[:, ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']]
-        dgcrt['resp_mean'] = np.nan
-        dgcrt['resp_max'] = np.nan
-        dgcrt['resp_min'] = np.nan
-        dgcrt['resp_std'] = np.nan
-        dgcrt['resp_stdev'] = np.nan
+        trial_mask, (responses,) = self._get_trial_window_means([response_win], *self.get_matrix_stack())
 
-        for row_i, row in self.iterrows():
+        dgcrt = self._get_response_table_from_trial_responses(responses, trial_mask, trace_type=self.trace_type)
 
-            responses = np.mean(row['matrix'][:, response_ind], axis=1)
+        # std is only defined for conditions with more than one trial
+        single_trial = np.sum(trial_mask, axis=1) <= 1
+        dgcrt.loc[single_trial, 'resp_std'] = np.nan
+        dgcrt.loc[single_trial, 'resp_stdev'] = np.nan
 
-            dgcrt.loc[row_i, 'resp_mean'] = np.mean(responses)
-            dgcrt.loc[row_i, 'resp_max'] = np.max(responses)
-            dgcrt.loc[row_i, 'resp_min'] = np.min(responses)
-
-            if len(responses) > 1:
-                dgcrt.loc[row_i, 'resp_std'] = np.std(responses)
-                dgcrt.loc[row_i, 'resp_stdev'] = np.std(responses) / np.sqrt(len(responses))
-
-        return DriftingGratingResponseTable(trace_type=self.trace_type, data=dgcrt)
+        return dgcrt
 
     def get_df_response_table(self, baseline_win=(-0.5, 0.), response_win=(0., 1.)):
         """
@@ -1596,50 +2222,20 @@ class DriftingGratingResponseMatrix(DataFrame):
         :return p_ttest_neg:
         """
 
-        baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
-        response_ind = np.logical_and(self.sta_ts > response_win[0], self.sta_ts <= response_win[1])
-
-        dgcrt = self.loc[:, ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']]
-        dgcrt['resp_mean'] = np.nan
-        dgcrt['resp_max'] = np.nan
-        dgcrt['resp_min'] = np.nan
-        dgcrt['resp_std'] = np.nan
-        dgcrt['resp_stdev'] = np.nan
-
-        trial_responses = []
-
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix']
-            baseline_mean = np.mean(curr_matrix[:, baseline_ind].astype(np.float64).flat)
-            response_mean = np.mean(curr_matrix[:, response_ind].astype(np.float64).flat)
-            dgcrt.loc[row_i, 'resp_mean'] = response_mean - baseline_mean
-
-            baseline_trial = np.mean(curr_matrix[:, baseline_ind].astype(np.float64), axis=1)
-            response_trial = np.mean(curr_matrix[:, response_ind].astype(np.float64), axis=1)
-            curr_trial_responses = response_trial - baseline_trial
-            trial_responses.append(curr_trial_responses)
-
-            dgcrt.loc[row_i, 'resp_max'] = np.max(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_min'] = np.min(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_std'] = np.std(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_stdev'] = np.std(curr_trial_responses) / np.sqrt(len(curr_trial_responses))
+        trial_mask, (baseline_trial, response_trial) = self._get_trial_window_means([baseline_win, response_win],
+                                                                                    *self.get_matrix_stack())
+        trial_responses = response_trial - baseline_trial
 
-        _, p_anova = stats.f_oneway(*trial_responses)
+        # window means are averaged across trials with equal weight, the same as averaging all data points
+        baseline_mean, _, _, _ = _get_masked_trial_stats(baseline_trial, trial_mask)
+        response_mean, _, _, _ = _get_masked_trial_stats(response_trial, trial_mask)
 
-        df_response_table = DriftingGratingResponseTable(data=dgcrt, trace_type='{}_df'.format(self.trace_type))
+        df_response_table = self._get_response_table_from_trial_responses(trial_responses, trial_mask,
+                                                                          trace_type='{}_df'.format(self.trace_type),
+                                                                          resp_mean=response_mean - baseline_mean)
 
-        if df_response_table.blank_condi_ind is None:
-            p_ttest_pos = None
-            p_ttest_neg = None
-        else:
-            responses_blank = trial_responses[df_response_table.blank_condi_ind]
-            responses_peak_pos = trial_responses[df_response_table.peak_condi_ind_pos]
-            responses_peak_neg = trial_responses[df_response_table.peak_condi_ind_neg]
-
-            n_min_pos = np.min([len(responses_blank), len(responses_peak_pos)])
-            _, p_ttest_pos = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_pos[0:n_min_pos])
-            n_min_neg = np.min([len(responses_blank), len(responses_peak_neg)])
-            _, p_ttest_neg = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_neg[0:n_min_neg])
+        p_anova, p_ttest_pos, p_ttest_neg = self._get_p_values(df_response_table, trial_responses,
+                                                               np.sum(trial_mask, axis=1))
 
         return df_response_table, p_anova, p_ttest_pos, p_ttest_neg
 
@@ -1670,56 +2266,35 @@ class DriftingGratingResponseMatrix(DataFrame):
         :return p_ttest_neg:
         """
 
-        baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
-        response_ind = np.logical_and(self.sta_ts > response_win[0], self.sta_ts <= response_win[1])
-
-        dgcrt = self.loc[:, ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']]
-        dgcrt['resp_mean'] = np.nan
-        dgcrt['resp_max'] = np.nan
-        dgcrt['resp_min'] = np.nan
-        dgcrt['resp_std'] = np.nan
-        dgcrt['resp_stdev'] = np.nan
-
-        trial_responses = []
-
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix'] + bias
-            baseline_mean = np.mean(curr_matrix[:, baseline_ind].astype(np.float64).flat)
-            response_mean = np.mean(curr_matrix[:, response_ind].astype(np.float64).flat)
-            dgcrt.loc[row_i, 'resp_mean'] = (response_mean - baseline_mean) / baseline_mean
-
-            if baseline_mean <= warning_level:
-                msg = '\ncondition:{}, mean baseline too low: {}'.format(self.get_condition_name(row_i), baseline_mean)
-                warnings.warn(msg, RuntimeWarning)
-
+        stack, trial_nums = self.get_matrix_stack()
+        stack += bias
+        trial_mask, (baseline_trial, response_trial) = self._get_trial_window_means([baseline_win, response_win],
+                                                                                    stack, trial_nums)
 
-            baseline_trial = np.mean(curr_matrix[:, baseline_ind].astype(np.float64), axis=1)
-            response_trial = np.mean(curr_matrix[:, response_ind].astype(np.float64), axis=1)
-            curr_trial_responses = (response_trial - baseline_trial) / baseline_trial
+        baseline_mean, _, baseline_trial_min, _ = _get_masked_trial_stats(baseline_trial, trial_mask)
+        response_mean, _, _, _ = _get_masked_trial_stats(response_trial, trial_mask)
 
-            if np.min(baseline_trial) <= warning_level:
-                msg = '\ncondition:{}, trial baseline too low: {}'.format(self.get_condition_name(row_i),
-                                                                          np.min(baseline_trial))
+        with np.errstate(invalid='ignore'):
+            low_mean_inds = np.nonzero(baseline_mean <= warning_level)[0]
+            low_trial_inds = np.nonzero(baseline_trial_min <= warning_level)[0]
+        for condi_i in sorted(set(low_mean_inds) | set(low_trial_inds)):
+            condi_n = self.get_condition_name(self.index[condi_i])
+            if condi_i in low_mean_inds:
+                msg = '\ncondition:{}, mean baseline too low: {}'.format(condi_n, baseline_mean[condi_i])
+                warnings.warn(msg, RuntimeWarning)
+            if condi_i in low_trial_inds:
+                msg = '\ncondition:{}, trial baseline too low: {}'.format(condi_n, baseline_trial_min[condi_i])
                 warnings.warn(msg, RuntimeWarning)
 
+        with np.errstate(invalid='ignore', divide='ignore'):
+            resp_mean = (response_mean - baseline_mean) / baseline_mean
+            trial_responses = (response_trial - baseline_trial) / baseline_trial
 
-            trial_responses.append(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_max'] = np.max(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_min'] = np.min(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_std'] = np.std(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_stdev'] = np.std(curr_trial_responses) / np.sqrt(len(curr_trial_responses))
-
-        _, p_anova = stats.f_oneway(*trial_responses)
+        dff_response_table = self._get_response_table_from_trial_responses(trial_responses, trial_mask,
+                                                                           trace_type='{}_df'.format(self.trace_type),
+                                                                           resp_mean=resp_mean)
 
-        dff_response_table = DriftingGratingResponseTable(data=dgcrt, trace_type='{}_df'.format(self.trace_type))
-        responses_blank = trial_responses[dff_response_table.blank_condi_ind]
-        responses_peak_pos = trial_responses[dff_response_table.peak_condi_ind_pos]
-        responses_peak_neg = trial_responses[dff_response_table.peak_condi_ind_neg]
-
-        n_min_pos = np.min([len(responses_blank), len(responses_peak_pos)])
-        _, p_ttest_pos = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_pos[0:n_min_pos])
-        n_min_neg = np.min([len(responses_blank), len(responses_peak_neg)])
-        _, p_ttest_neg = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_neg[0:n_min_neg])
+        p_anova, p_ttest_pos, p_ttest_neg = self._get_p_values(dff_response_table, trial_responses, trial_nums)
 
         return dff_response_table, p_anova, p_ttest_pos, p_ttest_neg
 
@@ -1753,50 +2328,30 @@ class DriftingGratingResponseMatrix(DataFrame):
         """
 
         baseline_ind = np.logical_and(self.sta_ts > baseline_win[0], self.sta_ts <= baseline_win[1])
-        response_ind = np.logical_and(self.sta_ts > response_win[0], self.sta_ts <= response_win[1])
 
-        dgcrt = self.loc[:, ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']]
-        dgcrt['resp_mean'] = np.nan
-        dgcrt['resp_max'] = np.nan
-        dgcrt['resp_min'] = np.nan
-        dgcrt['resp_std'] = np.nan
-        dgcrt['resp_stdev'] = np.nan
-
-        trial_responses = []
-
-        for row_i, row in self.iterrows():
-            curr_matrix = row['matrix']
-
-            baseline = curr_matrix[:, baseline_ind].astype(np.float64)
-            baseline_trial = np.mean(baseline, axis=1, keepdims=True)
-            baseline_norm = baseline - baseline_trial
-            std_mean = np.std(baseline_norm.flat)
-            baseline_mean = np.mean(baseline_trial.flat)
-            response_mean = np.mean(curr_matrix[:, response_ind].astype(np.float64).flat)
-            dgcrt.loc[row_i, 'resp_mean'] = (response_mean - baseline_mean) / std_mean
-
-            baseline_trial = np.mean(curr_matrix[:, baseline_ind].astype(np.float64), axis=1)
-            # std_trial = np.std(curr_matrix[:, baseline_ind].astype(np.float64), axis=1)
-            response_trial = np.mean(curr_matrix[:, response_ind].astype(np.float64), axis=1)
-            curr_trial_responses = (response_trial - baseline_trial) / std_mean
-
-            trial_responses.append(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_max'] = np.max(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_min'] = np.min(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_std'] = np.std(curr_trial_responses)
-            dgcrt.loc[row_i, 'resp_stdev'] = np.std(curr_trial_responses) / np.sqrt(len(curr_trial_responses))
+        stack, trial_nums = self.get_matrix_stack()
+        trial_mask, (baseline_trial, response_trial) = self._get_trial_window_means([baseline_win, response_win],
+                                                                                    stack, trial_nums)
 
-        _, p_anova = stats.f_oneway(*trial_responses)
+        # std of the baselines after each trial is normalized to zero mean, pooled across valid trials
+        baseline_norm = stack[:, :, baseline_ind] - baseline_trial[:, :, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std_mean = np.sqrt(np.sum(np.where(trial_mask[:, :, None], baseline_norm ** 2, 0.), axis=(1, 2)) /
+                               (trial_nums * baseline_norm.shape[2]))
 
-        zscore_response_table = DriftingGratingResponseTable(data=dgcrt, trace_type='{}_df'.format(self.trace_type))
-        responses_blank = trial_responses[zscore_response_table.blank_condi_ind]
-        responses_peak_pos = trial_responses[zscore_response_table.peak_condi_ind_pos]
-        responses_peak_neg = trial_responses[zscore_response_table.peak_condi_ind_neg]
+        baseline_mean, _, _, _ = _get_masked_trial_stats(baseline_trial, trial_mask)
+        response_mean, _, _, _ = _get_masked_trial_stats(response_trial, trial_mask)
 
-        n_min_pos = np.min([len(responses_blank), len(responses_peak_pos)])
-        _, p_ttest_pos = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_pos[0:n_min_pos])
-        n_min_neg = np.min([len(responses_blank), len(responses_peak_neg)])
-        _, p_ttest_neg = stats.ttest_rel(responses_blank[0:n_min_pos], responses_peak_neg[0:n_min_neg])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            resp_mean = (response_mean - baseline_mean) / std_mean
+            trial_responses = (response_trial - baseline_trial) / std_mean[:, None]
+
+        zscore_response_table = self._get_response_table_from_trial_responses(trial_responses, trial_mask,
+                                                                              trace_type='{}_df'.format(
+                                                                                  self.trace_type),
+                                                                              resp_mean=resp_mean)
+
+        p_anova, p_ttest_pos, p_ttest_neg = self._get_p_values(zscore_response_table, trial_responses, trial_nums)
 
         return zscore_response_table, p_anova, p_ttest_pos, p_ttest_neg
 
@@ -2084,19 +2639,11 @@ class DriftingGratingResponseTable(DataFrame):
         if more than one blank conditions found, raise error
         :return: int, blank condition index. None if no blank condition found
         """
-        inds = []
-
-        for row_i, row in self.iterrows():
-            if row['sf'] == 0.:
-                inds.append(row_i)
-            if row['tf'] == 0.:
-                inds.append(row_i)
-            if row['con'] == 0.:
-                inds.append(row_i)
-            if row['rad'] == 0.:
-                inds.append(row_i)
+        is_blank = np.zeros(len(self), dtype=np.bool)
+        for col in ['sf', 'tf', 'con', 'rad']:
+            is_blank = np.logical_or(is_blank, self[col].values == 0.)
 
-        inds = list(set(inds))
+        inds = list(self.index[is_blank])
 
         if len(inds) == 0: # no blank condition
             return None
@@ -7,6 +7,7 @@ Created on Wed Jun 25 17:12:24 2014
 
 
 import os
+import sys
 import datetime
 import random
 from psychopy import visual, event
@@ -16,9 +17,14 @@ import time
 from random import shuffle
 
 import socket
+import hashlib
+import threading
+import Queue
+from collections import OrderedDict
 import tifffile as tf
 import core.FileTools as ft
 import core.ImageAnalysis as ia
+import core.MaskKernels as mk
 
 
 from zro import RemoteObject, Proxy
@@ -148,13 +154,38 @@ def lookup_image(img, lookupI, lookupJ):
     if not lookupI.shape == lookupJ.shape:
         raise LookupError, 'The lookupI and lookupJ should have same size!!'
 
-    img2 = np.zeros(img.shape)
+    return img[lookupI, lookupJ].astype(np.float64)
 
-    for i in range(img2.shape[0]):
-        for j in range(img2.shape[1]):
-            img2[i,j] = img[lookupI[i,j],lookupJ[i,j]]
 
-    return img2
+def _find_nearest_index(candidates, values):
+    """
+    for each element in values, find the index of the nearest element in a 1-d array of candidates. Same as
+    np.argmin(np.abs(candidates - value)) for each value, including picking the smaller index for ties, but
+    calculated by binary search instead of a full scan.
+
+    :param candidates: 1-d array, strictly monotonic
+    :param values: array of any shape
+    :return: array of int, same shape as values
+    """
+    candidates = np.asarray(candidates)
+    values = np.asarray(values)
+
+    order = np.argsort(candidates, kind='mergesort')
+    sortedCandidates = candidates[order]
+
+    pos = np.searchsorted(sortedCandidates, values)
+    lower = np.clip(pos - 1, 0, len(candidates) - 1)
+    upper = np.clip(pos, 0, len(candidates) - 1)
+
+    disLower = np.abs(sortedCandidates[lower] - values)
+    disUpper = np.abs(sortedCandidates[upper] - values)
+
+    indLower = order[lower]
+    indUpper = order[upper]
+
+    isUpper = np.logical_or(disUpper < disLower, np.logical_and(disUpper == disLower, indUpper < indLower))
+
+    return np.where(isUpper, indUpper, indLower)
 
 
 def in_hull(p, hull):
@@ -184,15 +215,7 @@ def get_warped_square(degCorX,degCorY,center,width,height,ori,foregroundColor=1,
 
     frame = np.ones(degCorX.shape,dtype=np.float32)*backgroundColor
 
-    if ori < 0. or ori > 180.: raise ValueError, 'ori should be between 0 and 180.'
-
-    k1 = np.tan(ori*np.pi/180.)
-    k2 = np.tan((ori+90.)*np.pi/180.)
-
-    disW = np.abs((k1*degCorX - degCorY + center[1] - k1 * center[0]) / np.sqrt(k1**2 +1))
-    disH = np.abs((k2*degCorX - degCorY + center[1] - k2 * center[0]) / np.sqrt(k2**2 +1))
-
-    frame[np.logical_and(disW<=width/2.,disH<=height/2.)] = foregroundColor
+    frame[mk.warped_square_mask(degCorX, degCorY, center, width, height, ori)] = foregroundColor
 
     return frame
 
@@ -209,17 +232,7 @@ def circle_mask(map_x, map_y, center, radius):
     :return: binary mask for the circle, value range [0., 1.]
     """
 
-    if map_x.shape != map_y.shape: raise ValueError, 'map_x and map_y should have same shape!'
-
-    if len(map_x.shape) != 2: raise ValueError, 'map_x and map_y should be 2-d!!'
-
-    circle_mask = np.zeros(map_x.shape, dtype = np.uint8)
-    for (i, j), value in  np.ndenumerate(circle_mask):
-        x=map_x[i,j]; y=map_y[i,j]
-        if ia.distance((x,y),center) <= radius:
-            circle_mask[i,j] = 1
-
-    return circle_mask
+    return mk.circle_mask(map_x, map_y, center, radius)
 
 
 def get_grating(map_x, map_y, ori=0., spatial_freq=0.1, center=(0.,60.), phase=0., contrast=1.):
@@ -235,18 +248,8 @@ def get_grating(map_x, map_y, ori=0., spatial_freq=0.1, center=(0.,60.), phase=0
     :return: a frame as floating point 2-d array with grating, value range [0., 1.]
     """
 
-    if map_x.shape != map_y.shape: raise ValueError, 'map_x and map_y should have same shape!'
-
-    if len(map_x.shape) != 2: raise ValueError, 'map_x and map_y should be 2-d!!'
-
-    map_x_h = np.array(map_x, dtype = np.float32)
-    map_y_h = np.array(map_y, dtype = np.float32)
-
-    distance = np.sin(ori) * (map_x_h - center[0]) - np.cos(ori) * (map_y_h - center[1])
-
-    grating = np.sin(distance * 2 * np.pi * spatial_freq + phase)
-    grating = (grating + 1.) / 2. # change the scale of grating to be [0., 1.]
-    grating = (grating * contrast) + (1 - contrast) / 2 # adjust contrast
+    distance = mk.grating_distance(map_x, map_y, ori, center)
+    grating = mk.get_grating_from_distance(distance, spatial_freq=spatial_freq, phase=phase, contrast=contrast)
 
     return grating.astype(map_x.dtype)
 
@@ -273,7 +276,8 @@ class Monitor(object):
                  gammaGrid=None,
                  luminance=None,
                  downSampleRate=10,
-                 refreshRate = 60.):
+                 refreshRate = 60.,
+                 lookupTableCacheFolder=None):
 
         if resolution[0] % downSampleRate != 0 or resolution[1] % downSampleRate != 0:
            raise ArithmeticError, 'Resolution pixel numbers are not divisible by down sampling rate'
@@ -294,6 +298,7 @@ class Monitor(object):
         self.gammaGrid = gammaGrid
         self.luminance = luminance
         self.refreshRate = 60
+        self.lookupTableCacheFolder = lookupTableCacheFolder # folder to save lookup tables, None: no caching
 
         #distance form the projection point of the eye to the bottom of the monitor
         self.C2Bcm = self.monHcm - self.C2Tcm
@@ -362,18 +367,15 @@ class Monitor(object):
         resolution[0]=self.resolution[0]/self.downSampleRate
         resolution[1]=self.resolution[1]/self.downSampleRate
 
-        mapcorX, mapcorY = np.meshgrid(range(resolution[1]), range(resolution[0]))
+        linX = self.linCorX[0, :]
+        linY = self.linCorY[:, 0]
 
         newmapX = np.zeros(resolution,dtype=np.float16)
         newmapY = np.zeros(resolution,dtype=np.float16)
 
-
-        for j in range(resolution[1]):
-            newmapX[:, j] = (180.0 / np.pi) * np.arctan(self.linCorX[0, j] / self.dis)
-            dis2 = np.sqrt(np.square(self.dis) + np.square(self.linCorX[0, j])) #distance from
-
-            for i in range(resolution[0]):
-                newmapY[i, j] = (180.0 / np.pi) * np.arctan(self.linCorY[i, 0] / dis2)
+        newmapX[:] = ((180.0 / np.pi) * np.arctan(linX / self.dis))[None, :]
+        dis2 = np.sqrt(np.square(self.dis) + np.square(linX)) # distance from eye to each column on the monitor
+        newmapY[:] = (180.0 / np.pi) * np.arctan(linY[:, None] / dis2[None, :])
 
         self.degCorX = newmapX+90-self.monTilt
         self.degCorY = newmapY
@@ -428,14 +430,46 @@ class Monitor(object):
     def save_monitor(self):
         pass
 
-    def generate_Lookup_table(self):
+    def get_geometry_key(self):
+        """
+        return a string identifying the geometry of the monitor (all parameters determine the coordinate maps)
+        """
+        geometry = (tuple(self.resolution), self.dis, self.monWcm, self.monHcm, self.C2Tcm, self.C2Acm,
+                    self.monTilt, self.visualField, self.downSampleRate)
+        return hashlib.md5(repr(geometry)).hexdigest()
+
+    def generate_Lookup_table(self, cacheFolder=None):
         """
         generate lookup talbe between degree corrdinates and linear corrdinates
         return two matrix:
         lookupI: i index in linear matrix to this pixel after warping
         lookupJ: j index in linear matrix to this pixel after warping
+
+        :param cacheFolder: str, folder to load/save the lookup table, the file name is given by the geometry of the
+                            monitor. if None, self.lookupTableCacheFolder is used. if both are None, the table is not
+                            cached
         """
 
+        if cacheFolder is None:
+            cacheFolder = self.lookupTableCacheFolder
+
+        if cacheFolder is not None:
+            cachePath = os.path.join(cacheFolder, 'lookup_table_' + self.get_geometry_key() + '.npz')
+            if os.path.isfile(cachePath):
+                cache = np.load(cachePath)
+                return cache['lookupI'], cache['lookupJ']
+
+        lookupI, lookupJ = self._generate_Lookup_table()
+
+        if cacheFolder is not None:
+            if not os.path.isdir(cacheFolder):
+                os.makedirs(cacheFolder)
+            np.savez(cachePath, lookupI=lookupI, lookupJ=lookupJ)
+
+        return lookupI, lookupJ
+
+    def _generate_Lookup_table(self):
+
         #length of one degree on monitor at gaze point
         degDis = np.tan(np.pi / 180) * self.dis
 
@@ -447,20 +481,11 @@ class Monitor(object):
         degCorX = self.degCorX+self.monTilt-90
         degCorY = self.degCorY
 
-        lookupI = np.zeros(degCorX.shape).astype(np.int32)
-        lookupJ = np.zeros(degCorX.shape).astype(np.int32)
-
-        for j in xrange(lookupI.shape[1]):
-            currDegX = degCorX[0,j]
-            diffDegX = degNoWarpCorX[0,:] - currDegX
-            IndJ = np.argmin(np.abs(diffDegX))
-            lookupJ[:,j] = IndJ
-
-            for i in xrange(lookupI.shape[0]):
-                currDegY = degCorY[i,j]
-                diffDegY = degNoWarpCorY[:,IndJ] - currDegY
-                indI = np.argmin(np.abs(diffDegY))
-                lookupI[i,j] = indI
+        # the linear map is a regular grid, so the nearest linear coordinates can be searched along each axis
+        # separately: every column of degNoWarpCorY is the same, every row of degNoWarpCorX is the same
+        indJ = _find_nearest_index(degNoWarpCorX[0, :], degCorX[0, :].astype(np.float64))
+        lookupJ = np.repeat(indJ[None, :], degCorX.shape[0], axis=0).astype(np.int32)
+        lookupI = _find_nearest_index(degNoWarpCorY[:, 0], degCorY.astype(np.float64)).astype(np.int32)
 
         return lookupI, lookupJ
 
@@ -587,6 +612,59 @@ class Stim(object):
         print 'First: a 3-d array (with format of uint8) of the stimulus to be displayed.'
         print 'Second: a dictionary contain the information of this particular stimulus'
 
+    def prepare_rendering(self):
+        """
+        place holder of function "prepare_rendering" for each specific stimulus. Called once by FrameSource before
+        any frame is rendered, all the data shared by many frames (masks, checker boards, ...) should be generated
+        here and saved in self._renderData
+        """
+        self._renderData = {}
+
+    def get_frame_key(self, frame):
+        """
+        place holder of function "get_frame_key" for each specific stimulus
+
+        :param frame: tuple, one element in the output of self.generate_frames()
+        :return: hashable key of the pixel content of the frame (indicator excluded), frames with same key should look
+                 exactly the same
+        """
+        raise NotImplementedError('"get_frame_key" is not implemented for {}.'.format(self.__class__.__name__))
+
+    def render_frame(self, frameKey):
+        """
+        place holder of function "render_frame" for each specific stimulus
+
+        :param frameKey: output of self.get_frame_key()
+        :return: 2-d array, float16, the frame to be displayed without indicator
+        """
+        raise NotImplementedError('"render_frame" is not implemented for {}.'.format(self.__class__.__name__))
+
+    def _get_map(self):
+        """
+        return the coordinate maps (mapX, mapY) defined by self.coordinate
+        """
+        if self.coordinate == 'degree':
+            return self.monitor.degCorX, self.monitor.degCorY
+        elif self.coordinate == 'linear':
+            return self.monitor.linCorX, self.monitor.linCorY
+        else:
+            raise LookupError, 'the "coordinate" attributate show be either "degree" or "linear"'
+
+    def get_log(self):
+        """
+        return the log dictionary of this stimulus, same as the second output of self.generate_movie()
+        """
+        mondict = dict(self.monitor.__dict__)
+        indicatordict = dict(self.indicator.__dict__)
+        indicatordict.pop('monitor')
+        stimdict = dict(self.__dict__)
+        stimdict.pop('monitor')
+        stimdict.pop('indicator')
+        stimdict.pop('_renderData', None)
+        return {'stimulation': stimdict,
+                'monitor': mondict,
+                'indicator': indicatordict}
+
     def clear(self):
         self.frames = None
 
@@ -682,6 +760,15 @@ class UniformContrast(Stim):
 
         return fullSequence, fullDictionary
 
+    def get_frame_key(self, frame):
+        return frame[0]
+
+    def render_frame(self, frameKey):
+        if frameKey == 0:
+            return self.background * np.ones(self.monitor.degCorX.shape, dtype=np.float16)
+        else:
+            return self.color * np.ones(self.monitor.degCorX.shape, dtype=np.float16)
+
 
 class KSstim(Stim):
     """
@@ -783,6 +870,34 @@ class KSstim(Stim):
         plt.figure()
         plt.imshow(self.squares)
 
+    def generate_sweep_table(self):
+        """
+        generate the sweep table without generating the sweep masks
+
+        :return: list of tuples, each tuple: (orientation, sweepStartCoordinate, sweepEndCoordinate)
+        """
+        sweepWidth = self.sweepWidth
+        stepWidth = self.stepWidth
+        direction = self.direction
+
+        mapX, mapY = self._get_map()
+
+        if direction == "B2U":
+            steps = np.arange(mapY.min() - sweepWidth, mapY.max() + stepWidth, stepWidth)
+        elif direction == "U2B":
+            steps = np.arange(mapY.min() - sweepWidth, mapY.max() + stepWidth, stepWidth)[::-1]
+        elif direction == "L2R":
+            steps = np.arange(mapX.min() - sweepWidth, mapX.max() + stepWidth, stepWidth)
+        elif direction == "R2L":
+            steps = np.arange(mapX.min() - sweepWidth, mapX.max() + stepWidth, stepWidth)[::-1]
+        else:
+            raise LookupError, 'attribute "direction" should be "B2U", "U2B", "L2R" or "R2L".'
+
+        if direction in ("L2R", "R2L"):
+            return [('V', step, step + sweepWidth) for step in steps]
+        else:
+            return [('H', step, step + sweepWidth) for step in steps]
+
     def generate_sweeps(self):
         """
         generate full screen sweep sequence
@@ -857,12 +972,11 @@ class KSstim(Stim):
         for gap frames the second and third elements should be 'None'
         """
 
-        sweeps, _ = self.generate_sweeps()
         sweepFrame = self.sweepFrame
         flickerFrame = self.flickerFrame
         iteration = self.iteration
 
-        sweepNum = np.size(sweeps,0) # Number of sweeps, vertical or horizontal
+        sweepNum = len(self.generate_sweep_table()) # Number of sweeps, vertical or horizontal
         displayFrameNum = sweepFrame * sweepNum # total frame number for the visual stimulation of 1 iteration
 
         #frames for one iteration
@@ -969,6 +1083,34 @@ class KSstim(Stim):
 
         return fullSequence, fulldictionary
 
+    def prepare_rendering(self):
+        """
+        generate checker board squares and sweep table, sweep masks are generated for each frame on demand
+        """
+        self.squares = self.generate_squares()
+        self.sweepTable = self.generate_sweep_table()
+        self._renderData = {'background': self.background * np.ones(self.monitor.degCorX.shape, dtype=np.float16)}
+
+    def get_frame_key(self, frame):
+        if frame[0] == 0:
+            return None
+        else:
+            return (frame[1], frame[2])  # (square polarity, sweep index)
+
+    def render_frame(self, frameKey):
+        background = self._renderData['background']
+
+        if frameKey is None:
+            return background.copy()
+
+        polarity, sweepIndex = frameKey
+        orientation, sweepStart, sweepEnd = self.sweepTable[sweepIndex]
+        mapX, mapY = self._get_map()
+        sweepMap = mapX if orientation == 'V' else mapY
+        currSweep = np.logical_and(sweepMap >= sweepStart, sweepMap < sweepEnd)
+        currSquare = self.squares * polarity
+        return ((currSweep * currSquare) + ((-1 * (currSweep - 1)) * background)).astype(np.float16)
+
     def clear(self):
         self.sweepTable = None
         self.frames = None
@@ -2157,6 +2299,22 @@ class FlashingCircle(Stim):
 
         return fullSequence, fullDictionary
 
+    def prepare_rendering(self):
+        mapX, mapY = self._get_map()
+        self._renderData = {'background': self.background * np.ones(mapX.shape, dtype=np.float16),
+                            'circleMask': circle_mask(mapX, mapY, self.center, self.radius).astype(np.float16)}
+
+    def get_frame_key(self, frame):
+        return frame[0]
+
+    def render_frame(self, frameKey):
+        background = self._renderData['background']
+        if frameKey == 0:
+            return background.copy()
+        else:
+            circleMask = self._renderData['circleMask']
+            return (circleMask * self.color) + ((-1 * (circleMask - 1)) * background)
+
 
 class SparseNoise(Stim):
     """
@@ -2366,22 +2524,18 @@ class SparseNoise(Stim):
 
         fullSequence = np.ones((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16) * self.background
 
+        maskCache = mk.MaskCache(corX, corY)
+
         for i, currFrame in enumerate(self.frames):
             if currFrame[0] == 1: # not a gap
                 if i == 0: # first frame and (not a gap)
-                    currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                          height=self.probeSize[1], ori=self.probeOrientation,
-                                                          foregroundColor=currFrame[2], backgroundColor=self.background)
+                    currDisplayMatrix = self._get_probe_frame(maskCache, currFrame[1], currFrame[2])
                 else: # (not first frame) and (not a gap)
                     if self.frames[i-1][1] is None: # (not first frame) and (not a gap) and (new square from gap)
-                        currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                              height=self.probeSize[1], ori=self.probeOrientation,
-                                                              foregroundColor=currFrame[2], backgroundColor=self.background)
+                        currDisplayMatrix = self._get_probe_frame(maskCache, currFrame[1], currFrame[2])
                     elif (currFrame[1]!=self.frames[i-1][1]).any() or (currFrame[2]!=self.frames[i-1][2]):
                         # (not first frame) and (not a gap) and (new square from old square)
-                        currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                              height=self.probeSize[1], ori=self.probeOrientation,
-                                                              foregroundColor=currFrame[2], backgroundColor=self.background)
+                        currDisplayMatrix = self._get_probe_frame(maskCache, currFrame[1], currFrame[2])
 
                 #assign current display matrix to full sequence
                 fullSequence[i] = currDisplayMatrix
@@ -2405,6 +2559,40 @@ class SparseNoise(Stim):
 
         return fullSequence, fulldictionary
 
+    def _get_probe_frame(self, maskCache, center, polarity):
+        """
+        generate a frame with a single probe, the probe shape is taken from maskCache, the same probe location with
+        either polarity shares one cached mask
+
+        :param maskCache: core.MaskKernels.MaskCache object on the coordinate map of this stimulus
+        :param center: center of the probe, (azimuth, altitude)
+        :param polarity: color of the probe, 1 or -1
+        :return: frame, 2-d array of np.float32, same as get_warped_square
+        """
+        mask = maskCache.warped_square_mask(center, self.probeSize[0], self.probeSize[1], self.probeOrientation)
+        frame = np.ones(mask.shape, dtype=np.float32) * self.background
+        frame[mask] = polarity
+        return frame
+
+    def prepare_rendering(self):
+        mapX, mapY = self._get_map()
+        self._renderData = {'maskCache': mk.MaskCache(mapX, mapY)}
+
+    def get_frame_key(self, frame):
+        if frame[0] == 0:
+            return None
+        else:
+            return (tuple(frame[1]), frame[2])  # ((azimuth, altitude), polarity)
+
+    def render_frame(self, frameKey):
+        maskCache = self._renderData['maskCache']
+
+        if frameKey is None:
+            return np.ones(maskCache.map_x.shape, dtype=np.float16) * self.background
+
+        center, polarity = frameKey
+        return self._get_probe_frame(maskCache, center, polarity).astype(np.float16)
+
 
 class DriftingGratingCircle(Stim):
     """
@@ -2566,32 +2754,49 @@ class DriftingGratingCircle(Stim):
 
         return tuple(frames)
 
-    def _generate_circle_mask_dict(self):
+    def _generate_circle_mask_dict(self, maskCache=None):
         """
         generate a dictionary of circle masks for each size in size list
+
+        :param maskCache: core.MaskKernels.MaskCache object on the coordinate map of this stimulus, if None, a new one
+                          will be created
         """
 
-        masks = {}
-        if self.coordinate=='degree':corX=self.monitor.degCorX;corY=self.monitor.degCorY
-        elif self.coordinate=='linear':corX=self.monitor.linCorX;corY=self.monitor.linCorY
+        if maskCache is None:
+            if self.coordinate=='degree':corX=self.monitor.degCorX;corY=self.monitor.degCorY
+            elif self.coordinate=='linear':corX=self.monitor.linCorX;corY=self.monitor.linCorY
+            maskCache = mk.MaskCache(corX, corY)
 
+        masks = {}
         for size in self.size_list:
-            curr_mask = circle_mask(corX, corY, self.center, size)
+            curr_mask = maskCache.circle_mask(self.center, size)
             masks.update({size:curr_mask})
 
         return masks
 
+    def _get_grating_frame(self, maskCache, sf, dire, con, phase):
+        """
+        generate a full screen grating frame, the distance field of each orientation is taken from maskCache
+
+        :return: 2-d array, same dtype as the coordinate map, value range [-1., 1.]
+        """
+        curr_grating = maskCache.get_grating(ori=self._get_ori(dire), spatial_freq=sf, center=self.center,
+                                             phase=phase, contrast=con)
+        return curr_grating.astype(maskCache.map_x.dtype) * 2. - 1.
+
     def generate_movie(self):
 
 
         self.frames = self.generate_frames()
-        mask_dict = self._generate_circle_mask_dict()
 
         if self.coordinate=='degree':corX=self.monitor.degCorX;corY=self.monitor.degCorY
         elif self.coordinate=='linear':corX=self.monitor.linCorX;corY=self.monitor.linCorY
         else:
             raise LookupError, "self.coordinate should be either 'linear' or 'degree'."
 
+        maskCache = mk.MaskCache(corX, corY)
+        mask_dict = self._generate_circle_mask_dict(maskCache)
+
         indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
         indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
         indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
@@ -2604,16 +2809,8 @@ class DriftingGratingCircle(Stim):
 
             if currFrame[0] == 1: # not a gap
 
-                curr_ori = self._get_ori(currFrame[4])
-
-                curr_grating = get_grating(corX,
-                                           corY,
-                                           ori = curr_ori,
-                                           spatial_freq = currFrame[2],
-                                           center = self.center,
-                                           phase = currFrame[7],
-                                           contrast = currFrame[5])
-                curr_grating = curr_grating * 2. - 1.
+                curr_grating = self._get_grating_frame(maskCache, sf=currFrame[2], dire=currFrame[4],
+                                                       con=currFrame[5], phase=currFrame[7])
 
                 curr_circle_mask = mask_dict[currFrame[6]]
 
@@ -2641,6 +2838,31 @@ class DriftingGratingCircle(Stim):
 
         return mov, log
 
+    def prepare_rendering(self):
+        mapX, mapY = self._get_map()
+        maskCache = mk.MaskCache(mapX, mapY)
+        self._renderData = {'background': np.ones(mapX.shape, dtype=np.float16) * self.background,
+                            'maskCache': maskCache,
+                            'circleMasks': self._generate_circle_mask_dict(maskCache)}
+
+    def get_frame_key(self, frame):
+        if frame[0] == 0:
+            return None
+        else:
+            return tuple(frame[2:8])  # (sf, tf, dire, con, size, phase)
+
+    def render_frame(self, frameKey):
+        background_frame = self._renderData['background']
+
+        if frameKey is None:
+            return background_frame.copy()
+
+        sf, _, dire, con, size, phase = frameKey
+        curr_grating = self._get_grating_frame(self._renderData['maskCache'], sf=sf, dire=dire, con=con, phase=phase)
+        curr_circle_mask = self._renderData['circleMasks'][size]
+        return ((curr_grating * curr_circle_mask) +
+                (background_frame * (curr_circle_mask * -1. + 1.))).astype(np.float16)
+
 
 class KSstimAllDir(object):
     """
@@ -2845,6 +3067,158 @@ class ObliqueKSstimAllDir(object):
         return mov, log
 
 
+class FrameSource(object):
+    """
+    lazy frame sequence of a Stim object, can be displayed by DisplaySequence in place of the 3-d array generated by
+    Stim.generate_movie()
+
+    frames are rendered on demand by stim.render_frame(), rendered frames are cached by their keys (given by
+    stim.get_frame_key()), so each unique frame is only rendered once as long as it is still in the cache. During
+    display, a background thread renders the frames ahead of the display loop into a buffer of limited size.
+
+    the stim object should implement "prepare_rendering", "get_frame_key" and "render_frame", and the last element of
+    each frame in stim.generate_frames() should be the indicator color
+    """
+
+    def __init__(self, stim, cacheSize=1000, bufferSize=120):
+        """
+        :param stim: Stim object
+        :param cacheSize: int, maximum number of unique frames saved in cache
+        :param bufferSize: int, maximum number of frames rendered ahead of display
+        """
+
+        self.stim = stim
+        self.cacheSize = int(cacheSize)
+        self.bufferSize = int(bufferSize)
+
+        self.frames = stim.generate_frames()
+        stim.frames = self.frames
+        stim.prepare_rendering()
+
+        self.frameKeys = [stim.get_frame_key(frame) for frame in self.frames]
+
+        indicator = stim.indicator
+        self._indicatorH = slice(indicator.centerHpixel - (indicator.height_pixel / 2),
+                                 indicator.centerHpixel + (indicator.height_pixel / 2))
+        self._indicatorW = slice(indicator.centerWpixel - (indicator.width_pixel / 2),
+                                 indicator.centerWpixel + (indicator.width_pixel / 2))
+
+        self._cache = OrderedDict()
+        self._cacheLock = threading.Lock()
+        self._buffer = None
+        self._bufferThread = None
+        self._bufferError = None
+        self._isBuffering = False
+
+    @property
+    def shape(self):
+        return (len(self.frames),) + self.stim.monitor.degCorX.shape
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _get_rendered_frame(self, frameKey):
+        """
+        return the rendered frame (without indicator) of a given frame key, from cache if possible
+        """
+        with self._cacheLock:
+            if frameKey in self._cache:
+                frame = self._cache.pop(frameKey)
+                self._cache[frameKey] = frame  # move to the end, most recently used
+                return frame
+
+        frame = self.stim.render_frame(frameKey)
+
+        with self._cacheLock:
+            self._cache[frameKey] = frame
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last=False)
+
+        return frame
+
+    def __getitem__(self, frameInd):
+        """
+        :param frameInd: int, index of the frame
+        :return: 2-d array, float16, frame with indicator
+        """
+        frame = self._get_rendered_frame(self.frameKeys[frameInd]).copy()
+        frame[self._indicatorH, self._indicatorW] = self.frames[frameInd][-1]
+        return frame
+
+    def get_key_table(self):
+        """
+        :return uniqueKeys: list of unique frame keys in the order of their first appearance
+        :return keyInds: 1-d array of int, index in uniqueKeys for each frame
+        """
+        uniqueKeys = []
+        keyDict = {}
+        keyInds = np.empty(len(self.frameKeys), dtype=np.int64)
+        for i, frameKey in enumerate(self.frameKeys):
+            if frameKey not in keyDict:
+                keyDict[frameKey] = len(uniqueKeys)
+                uniqueKeys.append(frameKey)
+            keyInds[i] = keyDict[frameKey]
+        return uniqueKeys, keyInds
+
+    def start_buffering(self, frameInds):
+        """
+        start a background thread rendering frames in the order of frameInds into the look-ahead buffer, the rendered
+        frames can be retrieved by self.get_next_frame(). if rendering fails, the exception is raised by
+        self.get_next_frame() once all frames rendered before the failure are retrieved.
+
+        :param frameInds: iterable of int, frame indices in display order
+        """
+        self.stop_buffering()
+        self._buffer = Queue.Queue(maxsize=self.bufferSize)
+        self._bufferError = None
+        self._isBuffering = True
+        self._bufferThread = threading.Thread(target=self._fill_buffer, args=(frameInds,))
+        self._bufferThread.daemon = True
+        self._bufferThread.start()
+
+    def _fill_buffer(self, frameInds):
+        for frameInd in frameInds:
+            try:
+                frame = self[frameInd]
+            except Exception:
+                # keep the exception with its traceback, it is raised in the display thread by get_next_frame()
+                self._bufferError = sys.exc_info()
+                return
+            while self._isBuffering:
+                try:
+                    self._buffer.put(frame, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if not self._isBuffering:
+                return
+
+    def get_next_frame(self):
+        """
+        return the next frame from the look-ahead buffer, block until it is rendered
+        """
+        while True:
+            try:
+                return self._buffer.get(timeout=0.1)
+            except Queue.Empty:
+                if not self._bufferThread.is_alive() and self._buffer.empty():
+                    if self._bufferError is not None:
+                        excType, excValue, excTraceback = self._bufferError
+                        raise excType, excValue, excTraceback
+                    raise LookupError, 'No more frames in the look-ahead buffer.'
+
+    def stop_buffering(self):
+        self._isBuffering = False
+        if self._bufferThread is not None:
+            self._bufferThread.join()
+        self._bufferThread = None
+        self._buffer = None
+
+    def clear_cache(self):
+        with self._cacheLock:
+            self._cache.clear()
+
+
 class DisplaySequence(object):
     """
     Display the numpy sequence from memory
@@ -2972,11 +3346,21 @@ class DisplaySequence(object):
         self.clear()
 
 
-    def set_stim(self, stim):
+    def set_stim(self, stim, isLazy=False, cacheSize=1000, bufferSize=120):
         """
         to display defined stim object
+
+        :param isLazy: bool, if True, frames are not pre-rendered into a 3-d array, instead they are rendered on
+                       demand during display by a FrameSource object. The stim should implement "prepare_rendering",
+                       "get_frame_key" and "render_frame"
+        :param cacheSize: int, maximum number of unique frames cached by FrameSource, only used if isLazy is True
+        :param bufferSize: int, number of frames rendered ahead of display, only used if isLazy is True
         """
-        self.sequence, self.sequenceLog = stim.generate_movie()
+        if isLazy:
+            self.sequence = FrameSource(stim, cacheSize=cacheSize, bufferSize=bufferSize)
+            self.sequenceLog = stim.get_log()
+        else:
+            self.sequence, self.sequenceLog = stim.generate_movie()
         self.clear()
 
 
@@ -3267,6 +3651,15 @@ class DisplaySequence(object):
 
         i = 0
 
+        isLazy = isinstance(self.sequence, FrameSource)
+        if isLazy:
+            if self.displayOrder == 1:
+                frameInds = (j % singleRunFrames for j in xrange(singleRunFrames * self.displayIteration))
+            else:
+                frameInds = (singleRunFrames - (j % singleRunFrames) - 1
+                             for j in xrange(singleRunFrames * self.displayIteration))
+            self.sequence.start_buffering(frameInds)
+
         while self.keepDisplay and i < (singleRunFrames * self.displayIteration):
 
             if self.displayOrder == 1:frameNum = i % singleRunFrames
@@ -3274,7 +3667,10 @@ class DisplaySequence(object):
             if self.displayOrder == -1:frameNum = singleRunFrames - (i % singleRunFrames) -1
 
             # currFrame=Image.fromarray(self.sequence[frameNum]) # removed PIL dependency
-            stim.setImage(self.sequence[frameNum][::-1,:])
+            if isLazy:
+                stim.setImage(self.sequence.get_next_frame()[::-1,:])
+            else:
+                stim.setImage(self.sequence[frameNum][::-1,:])
             stim.draw()
             timeStamp.append(time.clock()-startTime)
 
@@ -3294,6 +3690,9 @@ class DisplaySequence(object):
         stopTime = time.clock()
         window.close()
 
+        if isLazy:
+            self.sequence.stop_buffering()
+
         if self.isSyncPulse:syncPulseTask.StopTask()
 
         self.timeStamp = np.array(timeStamp)
@@ -3368,6 +3767,9 @@ class DisplaySequence(object):
         displayLog.pop('sequenceLog')
         displayLog.pop('displayControlSock')
         displayLog.pop('sequence')
+        if isinstance(self.sequence, FrameSource):
+            # frames were rendered on demand, save frame keys to recreate each displayed frame
+            displayLog['frameKeys'], displayLog['frameKeyIndices'] = self.sequence.get_key_table()
         if hasattr(self, 'remoteSync'):
             displayLog.pop("remoteSync")
         logFile.update({'presentation':displayLog})
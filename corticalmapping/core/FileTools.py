@@ -8,6 +8,12 @@ import struct
 import h5py
 import warnings
 import numbers
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import ImageAnalysis as ia
@@ -545,16 +551,111 @@ def int2str(num,length=None):
     elif length > len(rawstr): return '0'*(length-len(rawstr)) + rawstr
 
 
-def imageToHdf5(array_like, save_path, hdf5_path, spatial_zoom=None, chunk_size=1000, compression=None):
+def _put_until_stopped(q, item, stop_event, timeout=0.1):
+    """
+    put item into a bounded queue, give up if stop_event is set while waiting for a free slot
+
+    :return: bool, True if the item is put into the queue
+    """
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get_until_stopped(q, stop_event, timeout=0.1):
+    """
+    get an item from a queue, return None (the stop signal of the pipeline) if stop_event is set while waiting
+    """
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _drain_queue(q):
+    """
+    remove all items from a queue without blocking
+    """
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _read_image_chunks(array_like, chunk_ranges, read_queue, worker_num, stop_event):
+    """
+    reader of imageToHdf5, read chunks of frames in order and put them into the read queue, one stop signal (None) for
+    each transform worker is put at the end. stops early if stop_event is set
+    """
+    try:
+        for chunk_start, chunk_end in chunk_ranges:
+            if stop_event.is_set():
+                break
+            if not _put_until_stopped(read_queue, (chunk_start, chunk_end,
+                                                   np.asarray(array_like[chunk_start:chunk_end, :, :])), stop_event):
+                break
+    except Exception as e:
+        _put_until_stopped(read_queue, e, stop_event)
+    finally:
+        for _ in range(worker_num):
+            _put_until_stopped(read_queue, None, stop_event)
+
+
+def _transform_image_chunks(read_queue, write_queue, zoom, dtype, stop_event):
+    """
+    transform worker of imageToHdf5, spatially zoom chunks from the read queue and put them into the write queue, a
+    stop signal (None) is put into the write queue when the read queue is finished. stops early if stop_event is set
+    """
+    try:
+        while True:
+            item = _get_until_stopped(read_queue, stop_event)
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                _put_until_stopped(write_queue, item, stop_event)
+                continue
+            chunk_start, chunk_end, curr_chunk = item
+            if zoom is not None:
+                curr_chunk = ia.rigid_transform_cv2(curr_chunk, zoom=zoom)
+                if len(curr_chunk.shape) == 2:
+                    curr_chunk = curr_chunk.reshape((1, curr_chunk.shape[0], curr_chunk.shape[1]))
+            if not _put_until_stopped(write_queue, (chunk_start, chunk_end, curr_chunk.astype(dtype)), stop_event):
+                break
+    except Exception as e:
+        _put_until_stopped(write_queue, e, stop_event)
+    finally:
+        _put_until_stopped(write_queue, None, stop_event)
+
+
+def imageToHdf5(array_like, save_path, hdf5_path, spatial_zoom=None, chunk_size=1000, compression=None,
+                hdf5_chunks=None, is_align_chunks=False, worker_num=1, queue_size=2):
     """
     save a array_like object (hdf5 dataset, BinarySlicer object, np.array, etc) into a hdf5 file
 
+    the conversion is pipelined: a reader thread loads chunks of frames, worker_num transform threads zoom them and
+    the calling thread writes (and compresses) them into the hdf5 dataset. the stages are connected by bounded queues
+    so reading, zooming and writing of different chunks overlap while at most about 2 * queue_size + worker_num
+    chunks are held in memory.
+
     :param array_like: 3-d, array_like object (hdf5 dataset, BinarySlicer object, np.array, etc), dimension (zyx)
     :param save_path: str, the path of the hdf5 file to be saved
     :param hdf5_path: str, the path of the dataset within the hdf5 file
     :param spatial_zoom: tuple of 2 floats or one float, spatial zoom of y and x
     :param chunk_size: int, the number of frames of each chunk of processing
     :param compression: str, "gzip", "lzf", "szip"
+    :param hdf5_chunks: chunk shape of the hdf5 dataset, tuple of 3 ints, or True for auto-chunking by h5py, or None
+                        for h5py default (auto-chunking if compressed, contiguous if not)
+    :param is_align_chunks: bool, if True, chunk_size is rounded up to a multiple of the frame number of the hdf5
+                            chunks, so that each hdf5 chunk is written (and compressed) only once
+    :param worker_num: positive int, number of transform threads
+    :param queue_size: positive int, maximum number of chunks waiting in each queue
     :return:
     """
 
@@ -566,6 +667,15 @@ def imageToHdf5(array_like, save_path, hdf5_path, spatial_zoom=None, chunk_size=
     if len(original_shape) != 3:
         raise ValueError('the array_like should be 3-d!')
 
+    if chunk_size < 1:
+        raise ValueError('chunk_size should be a positive integer!')
+
+    if worker_num < 1:
+        raise ValueError('worker_num should be a positive integer!')
+
+    if queue_size < 1:
+        raise ValueError('queue_size should be a positive integer!')
+
     if spatial_zoom is not None:
         try:
             zoom = np.array([spatial_zoom[0], spatial_zoom[1]])
@@ -575,36 +685,63 @@ def imageToHdf5(array_like, save_path, hdf5_path, spatial_zoom=None, chunk_size=
         new_shape = (np.array(original_shape)[1:3] * zoom).astype(np.int)
         new_shape = (original_shape[0], new_shape[0], new_shape[1])
     else:
+        zoom = None
         new_shape = original_shape
 
     print('shape after transformation: ' + str(new_shape))
 
-    save_file = h5py.File(save_path)
-    if compression is not None:
-        dset = save_file.create_dataset(hdf5_path, new_shape, dtype=original_dtype, compression=compression)
-    else:
-        dset = save_file.create_dataset(hdf5_path, new_shape, dtype=original_dtype)
-
-    chunk_num = original_shape[0] // chunk_size
-
-    for i in range(chunk_num):
-        chunk_start = i * chunk_size
-        chunk_end = (i + 1) * chunk_size
-        print('transforming chunk: [' + str(chunk_start) + ':' + str(chunk_end) + '] ...')
-        curr_chunk =  array_like[chunk_start : chunk_end, :, :]
-        if spatial_zoom is not None:
-            curr_chunk = ia.rigid_transform_cv2(curr_chunk, zoom=zoom).astype(original_dtype)
-        dset[i * chunk_size : (i + 1) * chunk_size, :, :] = curr_chunk
-
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    threads = []
 
-    if chunk_num % chunk_size != 0:
-        print('transforming chunk: [' + str(chunk_size * chunk_num) + ':' + str(original_shape[0]) + '] ...')
-        last_chunk = array_like[chunk_size * chunk_num:, :, :]
-        if spatial_zoom is not None:
-            last_chunk = ia.rigid_transform_cv2(last_chunk, zoom=zoom).astype(original_dtype)
-        dset[chunk_size * chunk_num:, :, :] = last_chunk
-
-    save_file.close()
+    save_file = h5py.File(save_path, 'a')
+    try:
+        if compression is not None:
+            dset = save_file.create_dataset(hdf5_path, new_shape, dtype=original_dtype, compression=compression,
+                                            chunks=hdf5_chunks)
+        else:
+            dset = save_file.create_dataset(hdf5_path, new_shape, dtype=original_dtype, chunks=hdf5_chunks)
+
+        chunk_size = int(chunk_size)
+        if is_align_chunks and dset.chunks is not None:
+            chunk_size = int(np.ceil(float(chunk_size) / dset.chunks[0]) * dset.chunks[0])
+            print('chunk size aligned to hdf5 chunks ' + str(dset.chunks) + ': ' + str(chunk_size) + ' frames')
+
+        chunk_ranges = [(chunk_start, min(chunk_start + chunk_size, original_shape[0]))
+                        for chunk_start in range(0, original_shape[0], chunk_size)]
+
+        threads.append(threading.Thread(target=_read_image_chunks,
+                                        args=(array_like, chunk_ranges, read_queue, worker_num, stop_event)))
+        for _ in range(worker_num):
+            threads.append(threading.Thread(target=_transform_image_chunks,
+                                            args=(read_queue, write_queue, zoom, original_dtype, stop_event)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        finished_worker_num = 0
+        while finished_worker_num < worker_num:
+            item = write_queue.get()
+            if item is None:
+                finished_worker_num += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            chunk_start, chunk_end, curr_chunk = item
+            print('writing chunk: [' + str(chunk_start) + ':' + str(chunk_end) + '] ...')
+            dset[chunk_start:chunk_end, :, :] = curr_chunk
+    finally:
+        # if writing stopped early, release the reader and transform threads and the chunks they hold
+        stop_event.set()
+        for thread in threads:
+            while thread.is_alive():
+                _drain_queue(read_queue)
+                _drain_queue(write_queue)
+                thread.join(0.1)
+        _drain_queue(read_queue)
+        _drain_queue(write_queue)
+        save_file.close()
 
 
 def update_key(group, dataset_name, dataset_data, is_overwrite=True):
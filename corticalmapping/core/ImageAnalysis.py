@@ -7,9 +7,12 @@ import numpy as np
 from scipy import interpolate
 import scipy.ndimage as ni
 import scipy.stats as stats
+import scipy.sparse as sparse
 import skimage.morphology as sm
 import skimage.measure as measure
 import time
+import multiprocessing
+import h5py
 
 try:
     import FileTools as ft
@@ -21,6 +24,16 @@ try:
 except (AttributeError, ImportError):
     from . import PlottingTools as pt
 
+try:
+    import TimingAnalysis as ta
+except (AttributeError, ImportError):
+    from . import TimingAnalysis as ta
+
+try:
+    import MaskKernels as mk
+except (AttributeError, ImportError):
+    from . import MaskKernels as mk
+
 try:
     import cv2
 except ImportError as e:
@@ -637,12 +650,8 @@ def generate_oval_mask(shape, center, width, height, isplot = False):
 
     mask = np.zeros(shape); mask[:] = np.nan
 
-    width = float(width); height = float(height)
-
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            if ((i-center[0])/(height/2))**2 + ((j-center[1])/(width/2))**2 <= 1:
-                mask[i,j]=1
+    map_x, map_y = mk.get_pixel_map(shape)
+    mask[mk.oval_mask(map_x, map_y, center=(center[1], center[0]), width=width, height=height)] = 1
 
     if np.isnan(np.nansum(mask[:])):
         raise ArithmeticError('No element in mask!')
@@ -654,14 +663,13 @@ def generate_oval_mask(shape, center, width, height, isplot = False):
     return mask
 
 
-def get_trace(movie, mask, maskMode ='binary'):
+def _get_final_mask(mask, maskMode='binary'):
     '''
-    get a trace across a movie with averaged value in a mask
+    validate a mask and convert it into a float mask with zeros outside roi
 
-    maskMode: 'binary': ones in roi, zeros outside
-              'binaryNan': ones in roi, nans outside
-              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
-              'weightedNan': weighted values in roi, nans outside
+    maskMode: same as 'maskMode' in function get_trace
+
+    :return: finalMask, 2d float array; pixelNum, number of pixels in roi
     '''
 
     if maskMode == 'binary':
@@ -689,6 +697,21 @@ def get_trace(movie, mask, maskMode ='binary'):
     else:
         raise LookupError('maskMode not understood. Should be one of "binary", "binaryNan", "weighted", "weightedNan".')
 
+    return finalMask, pixelNum
+
+
+def get_trace(movie, mask, maskMode ='binary'):
+    '''
+    get a trace across a movie with averaged value in a mask
+
+    maskMode: 'binary': ones in roi, zeros outside
+              'binaryNan': ones in roi, nans outside
+              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
+              'weightedNan': weighted values in roi, nans outside
+    '''
+
+    finalMask, pixelNum = _get_final_mask(mask, maskMode)
+
     trace = np.sum(np.multiply(movie,finalMask),(1,2))/pixelNum
 
     return trace
@@ -854,6 +877,220 @@ def get_trace_binaryslicer3(bl_obj, masks, mask_mode = 'binary', loading_frame_n
     return traces
 
 
+def get_mask_matrix(masks, mask_mode='binary'):
+    '''
+    compile a dictionary of masks into a single sparse (pixel x mask) matrix. each column is the flattened mask
+    divided by its pixel number, so that multiplying a flattened movie with this matrix gives the same traces as
+    function get_trace.
+
+    :param masks: dictionary of masks, each value can be a 2d array, a ROI object or a WeightedROI object. 2d arrays
+                  are interpreted by mask_mode, ROI objects are treated as 'binary' and WeightedROI objects are
+                  treated as 'weighted' (trace = sum of weighted pixels / binary area) regardless of mask_mode
+    :param mask_mode: same as 'maskMode' in function get_trace
+
+    maskMode: 'binary': ones in roi, zeros outside
+              'binaryNan': ones in roi, nans outside
+              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
+              'weightedNan': weighted values in roi, nans outside
+
+    :return mask_matrix: scipy.sparse.csc_matrix, shape (pixel number, mask number), masks with no pixel have empty
+                         columns
+    :return mask_keys: list of keys of the masks, in the column order of mask_matrix
+    :return frame_shape: tuple of two ints, (height, width) of the masks
+    '''
+
+    mask_keys = sorted(masks.keys())
+
+    if len(mask_keys) == 0:
+        raise ValueError('No mask found!')
+
+    frame_shape = None
+    data = []
+    rows = []
+    cols = []
+
+    for col_i, key in enumerate(mask_keys):
+        mask = masks[key]
+
+        if isinstance(mask, WeightedROI):
+            final_mask, pixel_num = _get_final_mask(mask.get_weighted_mask(), 'weighted')
+        elif isinstance(mask, ROI):
+            final_mask, pixel_num = _get_final_mask(mask.get_binary_mask(), 'binary')
+        else:
+            if len(mask.shape) != 2: raise ValueError('Mask "' + str(key) + '" should be 2d!')
+            final_mask, pixel_num = _get_final_mask(mask, mask_mode)
+
+        if frame_shape is None:
+            frame_shape = final_mask.shape
+        elif final_mask.shape != frame_shape:
+            raise ValueError('the shape of mask "' + str(key) + '" ' + str(final_mask.shape) +
+                             ' is different from the shape of other masks ' + str(frame_shape) + '!')
+
+        if pixel_num == 0:
+            continue
+
+        curr_ind = np.flatnonzero(final_mask)
+        data.append(final_mask.flat[curr_ind] / float(pixel_num))
+        rows.append(curr_ind)
+        cols.append(np.zeros(curr_ind.shape, dtype=np.int64) + col_i)
+
+    if len(data) == 0:
+        data = np.zeros(0, dtype=np.float64)
+        rows = cols = np.zeros(0, dtype=np.int64)
+    else:
+        data = np.concatenate(data)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+    mask_matrix = sparse.csc_matrix((data, (rows, cols)),
+                                    shape=(frame_shape[0] * frame_shape[1], len(mask_keys)))
+
+    return mask_matrix, mask_keys, frame_shape
+
+
+def get_traces_from_mask_matrix(mov, mask_matrix):
+    '''
+    extract traces of all masks from a movie with one sparse matrix product
+
+    :param mov: 3d array, frame x height x width
+    :param mask_matrix: sparse (pixel x mask) matrix, output of function get_mask_matrix
+    :return: 2d array, float64, mask x frame
+    '''
+
+    if len(mov.shape) != 3: raise ValueError('Input movie should be 3d!')
+    if mov.shape[1] * mov.shape[2] != mask_matrix.shape[0]:
+        raise ValueError('the pixel number of each frame ({}) does not match the row number of '
+                         'mask matrix ({}).'.format(mov.shape[1] * mov.shape[2], mask_matrix.shape[0]))
+
+    mov_2d = np.asarray(mov).reshape((mov.shape[0], -1)).astype(np.float64)
+    return np.asarray(mask_matrix.transpose().dot(mov_2d.transpose()))
+
+
+def _get_movie_chunk(mov, ind_start, ind_end):
+    '''
+    load frames [ind_start, ind_end) from a movie
+
+    :param mov: 3d array like object (np.ndarray, BinarySlicer, h5py.Dataset, etc.), or path to a .npy file, or tuple
+                of (hdf5 file path, dataset path)
+    '''
+    if isinstance(mov, tuple):
+        with h5py.File(mov[0], 'r') as f:
+            return f[mov[1]][ind_start:ind_end]
+    elif isinstance(mov, str):
+        return np.array(np.load(mov, mmap_mode='r')[ind_start:ind_end])
+    else:
+        return mov[ind_start:ind_end]
+
+
+def _get_movie_shape(mov):
+    '''
+    get the shape of a movie, mov can be anything accepted by function _get_movie_chunk
+    '''
+    if isinstance(mov, tuple):
+        with h5py.File(mov[0], 'r') as f:
+            return f[mov[1]].shape
+    elif isinstance(mov, str):
+        return np.load(mov, mmap_mode='r').shape
+    else:
+        return mov.shape
+
+
+def _get_traces_chunk(params):
+    '''
+    worker function of get_trace_binaryslicer4, extract traces of one frame range
+    '''
+    mov, ind_start, ind_end, pixel_ind, mask_matrix = params
+    curr_mov = _get_movie_chunk(mov, ind_start, ind_end)
+    curr_mov = curr_mov.reshape((curr_mov.shape[0], -1))[:, pixel_ind]
+    return np.asarray(mask_matrix.transpose().dot(curr_mov.transpose().astype(np.float64)))
+
+
+def get_trace_binaryslicer4(bl_obj, masks, mask_mode='binary', loading_frame_num=1000, process_num=1):
+    '''
+
+    get traces for a dictionary of masks from a large movie, by loading chunk each time. all masks are compiled once
+    into a sparse (pixel x mask) matrix (see function get_mask_matrix), and traces of all masks in a chunk are
+    extracted by one sparse matrix product over the pixels covered by at least one mask. same output as function
+    get_trace_binaryslicer3 (except it is much faster for many masks)
+
+    :param bl_obj: the binary slicer object of a large matrix, or any 3d array like object can be sliced along the
+                   first axis (np.ndarray, np.memmap, h5py.Dataset), or path to a .npy file, or tuple of
+                   (hdf5 file path, dataset path). if process_num > 1, bl_obj is sent to each worker process, so it
+                   should be a file path or a path tuple to avoid copying the whole movie into each process
+    :param masks: a dictionary of masks, each value can be a 2d array, a ROI object or a WeightedROI object
+    :param mask_mode: same as 'mask_mode' in function get_trace, only applied to 2d array masks
+    :param loading_frame_num: frame number of each chunk
+    :param process_num: positive int, number of worker processes, each process extracts traces from disjoint frame
+                        ranges
+
+    maskMode: 'binary': ones in roi, zeros outside
+              'binaryNan': ones in roi, nans outside
+              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
+              'weightedNan': weighted values in roi, nans outside
+
+    :return: dictionary of extracted traces, keys: 'trace_' + mask key
+    '''
+
+    if loading_frame_num <= 1: raise ValueError('loading_frame_num should be a integer larger than 1!')
+    if process_num < 1: raise ValueError('process_num should be a positive integer!')
+
+    mov_shape = _get_movie_shape(bl_obj)
+    if len(mov_shape) != 3: raise ValueError('BinarySlicer object should be 3d!')
+
+    mask_matrix, mask_keys, frame_shape = get_mask_matrix(masks, mask_mode=mask_mode)
+    if tuple(mov_shape[1:]) != tuple(frame_shape):
+        raise ValueError('the size of each frame of the BinarySlicer object should be the same as the size of masks!')
+
+    # only pixels covered by at least one mask need to be loaded into the matrix product
+    pixel_ind = np.unique(mask_matrix.indices)
+    mask_matrix = mask_matrix.tocsr()[pixel_ind, :]
+
+    frameNum = mov_shape[0]
+
+    print('\nInput movie shape:', mov_shape)
+
+    chunkNum = frameNum // loading_frame_num
+    if frameNum % loading_frame_num == 0:
+        print('Translating in chunks: '+ str(chunkNum)+' x '+str(loading_frame_num)+' frame(s)')
+    else:
+        chunkNum += 1
+        print('Translating in chunks: '+str(chunkNum-1)+' x '+str(loading_frame_num)+' frame(s)'+' + '+str(frameNum % loading_frame_num)+' frame(s)')
+
+    chunk_params = []
+    for i in range(chunkNum):
+        indStart = i * loading_frame_num
+        indEnd = min((i + 1) * loading_frame_num, frameNum)
+        chunk_params.append((bl_obj, indStart, indEnd, pixel_ind, mask_matrix))
+
+    if process_num == 1:
+        chunk_traces = []
+        for i, params in enumerate(chunk_params):
+            print('Extracting signal from frame '+str(params[1])+' to frame '+str(params[2])+'.\t'+str(i*100./chunkNum)+'%')
+            chunk_traces.append(_get_traces_chunk(params))
+    else:
+        print('Extracting signal with ' + str(process_num) + ' processes.')
+        p = multiprocessing.Pool(process_num)
+        try:
+            chunk_traces = p.map(_get_traces_chunk, chunk_params)
+        finally:
+            p.close()
+            p.join()
+
+    all_traces = np.concatenate(chunk_traces, axis=1)
+
+    # masks without any pixel, same as function get_trace (division by zero)
+    empty_masks = np.diff(mask_matrix.tocsc().indptr) == 0
+
+    traces = {}
+    for key_i, key in enumerate(mask_keys):
+        if empty_masks[key_i]:
+            traces.update({'trace_' + key: np.zeros(frameNum) + np.nan})
+        else:
+            traces.update({'trace_' + key: all_traces[key_i]})
+
+    return traces
+
+
 def hit_or_miss(coor, mask):
     '''
     check if a cooridnate (coor) is in a mask, input mask can be int or float, nan and zero will considered as outside, any
@@ -1279,6 +1516,89 @@ def get_average_movie2(mov, frameTS, onsetTimes, chunkDur, verbose=True):
         return sumMov.astype(np.float32) / real_count, int(real_count)
 
 
+def get_average_movies(mov, frameTS, onsetTimes, chunkDurs, loading_frame_num=1000, verbose=True):
+    '''
+    average movie chunks triggered by several groups of onsets, while reading the movie only once. each chunk of the
+    movie is loaded once and its frames are added into the running sums of every trigger window overlapping with it.
+    the selection of triggers is the same as function get_average_movie.
+
+    :param mov: image movie, 3d array like object (np.ndarray, BinarySlicer, h5py dataset)
+    :param frameTS: the timestamps for each frame of the raw movie
+    :param onsetTimes: dictionary, {group key: time stamps of onset of each trigger in this group}
+    :param chunkDurs: dictionary, {group key: duration of each chunk in this group}, should have same keys as onsetTimes
+    :param loading_frame_num: frame number of each chunk loaded from mov
+    :param verbose: bool
+    :return aveMovs: dictionary, {group key: averaged movie of all chunks, 3d array, float32}
+    :return ns: dictionary, {group key: number of chunks that were averaged}
+    '''
+
+    if set(onsetTimes.keys()) != set(chunkDurs.keys()):
+        raise LookupError('onsetTimes and chunkDurs should have same keys!')
+
+    if loading_frame_num < 1: raise ValueError('loading_frame_num should be a positive integer!')
+
+    frameTS = np.asarray(frameTS)
+    meanFrameDur = np.mean(np.diff(frameTS))
+
+    sumMovs = {}
+    ns = {}
+    windows = []  # list of (group key, start frame index, frame number)
+
+    for key, onsets in onsetTimes.items():
+        chunkDur = chunkDurs[key]
+        chunkFrameDur = int(np.ceil(chunkDur / meanFrameDur))
+        sumMovs[key] = np.zeros((chunkFrameDur, mov.shape[1], mov.shape[2]), dtype=np.float64)
+        ns[key] = 0
+
+        onsets = np.asarray(onsets, dtype=np.float64).flatten()
+        onsets = onsets[np.logical_and(onsets >= frameTS[0], onsets + chunkDur <= frameTS[-1])]
+        if len(onsets) == 0:
+            continue
+
+        for onsetFrameInd in ta.find_nearest_sorted(frameTS, onsets):
+            if onsetFrameInd + chunkFrameDur <= mov.shape[0]:
+                windows.append((key, int(onsetFrameInd), chunkFrameDur))
+                ns[key] += 1
+            elif verbose:
+                print('Ending frame index ('+str(int(onsetFrameInd+chunkFrameDur))+') is larger than frames in movie (' +
+                      str(int(mov.shape[0]))+'.\nExclude this trigger.')
+
+    if len(windows) > 0:
+        winStarts = np.array([w[1] for w in windows])
+        winEnds = np.array([w[1] + w[2] for w in windows])
+        loadStart = np.min(winStarts)
+        loadEnd = np.max(winEnds)
+
+        t0 = time.time()
+        for indStart in range(loadStart, loadEnd, loading_frame_num):
+            indEnd = min(indStart + loading_frame_num, loadEnd)
+
+            if verbose:
+                print('{:09.2f} second: reading frame {} to frame {}. {:5.1f} %'
+                      .format(time.time() - t0, indStart, indEnd, (indStart - loadStart) * 100. / (loadEnd - loadStart)))
+
+            currMov = None
+            for win_i in np.where(np.logical_and(winStarts < indEnd, winEnds > indStart))[0]:
+                if currMov is None:
+                    currMov = np.asarray(mov[indStart:indEnd]).astype(np.float64)
+
+                key, winStart, _ = windows[win_i]
+                overlapStart = max(indStart, winStart)
+                overlapEnd = min(indEnd, winEnds[win_i])
+                sumMovs[key][overlapStart - winStart:overlapEnd - winStart] += \
+                    currMov[overlapStart - indStart:overlapEnd - indStart]
+
+    aveMovs = {}
+    for key, sumMov in sumMovs.items():
+        if ns[key] == 0:
+            print('\nNo valid chunk found for "' + str(key) + '"!')
+            aveMovs[key] = sumMov.astype(np.float32)
+        else:
+            aveMovs[key] = sumMov.astype(np.float32) / ns[key]
+
+    return aveMovs, ns
+
+
 def regression_detrend_1d(sig, trend):
     """
     detrend a signal trace by subtracting global trend (surround neural pil). It uses linear regress to determine the
@@ -1309,13 +1629,67 @@ def regression_detrend_1d(sig, trend):
     trend = trend.astype(np.float)
     trend = trend - np.mean(trend)
 
-    slope, intercept, r_value, p_value, stderr = stats.linregress(trend, sig)
+    slopes, _, r_values = linear_regress_multi(trend, sig[:, None])
+    slope = slopes[0]
+    r_value = r_values[0]
 
     sig_detrend = (sig - trend * slope).astype(sig.dtype)
 
     return sig_detrend, slope, r_value
 
 
+def linear_regress_multi(x, ys, is_return_p=False):
+    """
+    closed-form least-squares linear regression of many signals against one common regressor, all signals are solved
+    at once with matrix algebra. for each column of ys, the results are the same as scipy.stats.linregress(x, y)
+
+    :param x: 1-d array, regressor, length n
+    :param ys: 2-d array, n x m, each column is one signal
+    :param is_return_p: bool, if True, two-sided p values (t-test of slope equals 0) are also returned
+    :return: slopes, intercepts, r_values, 1-d arrays of length m
+             p_values, 1-d array of length m, only returned if is_return_p is True
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    if len(x.shape) != 1:
+        raise ValueError('Input x should be 1-dimensional!')
+
+    if len(ys.shape) != 2:
+        raise ValueError('Input ys should be 2-dimensional!')
+
+    if ys.shape[0] != x.shape[0]:
+        raise ValueError('The first dimension of ys should have same length as x.')
+
+    n = x.shape[0]
+    x_mean = np.mean(x)
+    y_means = np.mean(ys, axis=0)
+    x_cen = x - x_mean
+    ys_cen = ys - y_means
+
+    ssxm = np.dot(x_cen, x_cen)
+    ssxym = np.dot(x_cen, ys_cen)
+    ssym = np.sum(ys_cen * ys_cen, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = ssxym / ssxm
+        r_den = np.sqrt(ssxm * ssym)
+        r_values = np.where(r_den == 0, 0., ssxym / r_den)
+    r_values = np.clip(r_values, -1., 1.)
+    intercepts = y_means - slopes * x_mean
+
+    if not is_return_p:
+        return slopes, intercepts, r_values
+
+    df = n - 2
+    tiny = 1.0e-20
+    t = r_values * np.sqrt(df / ((1.0 - r_values + tiny) * (1.0 + r_values + tiny)))
+    p_values = 2 * stats.t.sf(np.abs(t), df)
+
+    return slopes, intercepts, r_values, p_values
+
+
 def merge_weighted_rois(roi1, roi2):
     """
     merge two WeightedROI objects, most useful for merge ON and OFF subfields
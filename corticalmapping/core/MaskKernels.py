@@ -0,0 +1,224 @@
+__author__ = 'junz'
+
+'''
+kernels to generate shape masks (circle, oval, warped square) and grating patterns on a coordinate map. A coordinate
+map is a pair of 2-d arrays (map_x, map_y) giving the coordinates of each pixel, for example the degree or linear
+coordinates of a monitor, or the pixel indices of an image (see get_pixel_map). All kernels are calculated by
+broadcasting over the whole map.
+'''
+
+import numpy as np
+from collections import OrderedDict
+
+
+def _check_map(map_x, map_y):
+
+    if map_x.shape != map_y.shape: raise ValueError('map_x and map_y should have same shape!')
+
+    if len(map_x.shape) != 2: raise ValueError('map_x and map_y should be 2-d!!')
+
+
+def get_pixel_map(shape):
+    """
+    return the coordinate map of the pixel indices of an image, map_x: column index, map_y: row index. The maps are
+    returned in broadcastable form (map_x: 1 x n, map_y: m x 1), use np.broadcast_arrays to get full 2-d arrays
+
+    :param shape: tuple of two ints, (height, width)
+    :return: map_x, map_y
+    """
+
+    if len(shape) != 2: raise LookupError('Shape should be two dimensional.')
+
+    map_y, map_x = np.ogrid[0:shape[0], 0:shape[1]]
+    return map_x, map_y
+
+
+def circle_mask(map_x, map_y, center, radius):
+    """
+    generate a binary mask of a circle with given center and radius on a map with coordinates for each pixel defined by
+    map_x and map_y. the distance from each pixel to the center is defined as in ImageAnalysis.distance
+
+    :param map_x: x coordinates for each pixel on a map
+    :param map_y: y coordinates for each pixel on a map
+    :param center: center coordinates of circle center {x, y}
+    :param radius: radius of the circle
+    :return: binary mask for the circle, 2-d array of np.uint8, value range [0, 1]
+    """
+
+    _check_map(map_x, map_y)
+
+    dis_x = np.asarray(map_x, dtype=np.float64) - center[0]
+    dis_y = np.asarray(map_y, dtype=np.float64) - center[1]
+    dis = np.sqrt((np.square(dis_x) + np.square(dis_y)) / 2.)
+
+    return (dis <= radius).astype(np.uint8)
+
+
+def oval_mask(map_x, map_y, center, width, height):
+    """
+    generate a binary mask of an oval with given center, width (along x) and height (along y)
+
+    :param map_x: x coordinates for each pixel on a map, should be broadcastable to map_y
+    :param map_y: y coordinates for each pixel on a map, should be broadcastable to map_x
+    :param center: center coordinates of the oval {x, y}
+    :param width: full width of the oval along x
+    :param height: full height of the oval along y
+    :return: binary mask for the oval, 2-d bool array
+    """
+
+    width = float(width); height = float(height)
+
+    return ((map_y - center[1]) / (height / 2)) ** 2 + ((map_x - center[0]) / (width / 2)) ** 2 <= 1
+
+
+def warped_square_mask(map_x, map_y, center, width, height, ori):
+    """
+    generate a binary mask of a square defined by center, width, height and orientation
+
+    :param map_x: x coordinates for each pixel on a map
+    :param map_y: y coordinates for each pixel on a map
+    :param center: center coordinates of the square {x, y}
+    :param width: width of the square
+    :param height: height of the square
+    :param ori: angle in degree, should be 0~180
+    :return: binary mask for the square, 2-d bool array
+    """
+
+    if ori < 0. or ori > 180.: raise ValueError('ori should be between 0 and 180.')
+
+    k1 = np.tan(ori * np.pi / 180.)
+    k2 = np.tan((ori + 90.) * np.pi / 180.)
+
+    dis_w = np.abs((k1 * map_x - map_y + center[1] - k1 * center[0]) / np.sqrt(k1 ** 2 + 1))
+    dis_h = np.abs((k2 * map_x - map_y + center[1] - k2 * center[0]) / np.sqrt(k2 ** 2 + 1))
+
+    return np.logical_and(dis_w <= width / 2., dis_h <= height / 2.)
+
+
+def grating_distance(map_x, map_y, ori, center):
+    """
+    signed distance of each pixel to the line going through center with orientation ori, the spatial part of a
+    grating, see get_grating_from_distance
+
+    :param map_x: x coordinates for each pixel on a map
+    :param map_y: y coordinates for each pixel on a map
+    :param ori: orientation of the grating in arc
+    :param center: center coordinates of the grating {x, y}
+    :return: 2-d array of np.float32
+    """
+
+    _check_map(map_x, map_y)
+
+    map_x_h = np.array(map_x, dtype=np.float32)
+    map_y_h = np.array(map_y, dtype=np.float32)
+
+    return np.sin(ori) * (map_x_h - center[0]) - np.cos(ori) * (map_y_h - center[1])
+
+
+def get_grating_from_distance(distance, spatial_freq=0.1, phase=0., contrast=1.):
+    """
+    generate a grating frame from a distance field returned by grating_distance
+
+    :param distance: 2-d array, output of grating_distance
+    :param spatial_freq: spatial frequency (cycle per unit)
+    :param phase: in arc
+    :param contrast: [0., 1.]
+    :return: 2-d array with grating, value range [0., 1.]
+    """
+
+    grating = np.sin(distance * 2 * np.pi * spatial_freq + phase)
+    grating = (grating + 1.) / 2. # change the scale of grating to be [0., 1.]
+    grating = (grating * contrast) + (1 - contrast) / 2 # adjust contrast
+
+    return grating
+
+
+class MaskCache(object):
+    """
+    memoizing cache of masks and grating distance fields on one coordinate map. since each cache is bound to a single
+    coordinate map, masks are keyed by their shape parameters only. Calculated arrays are shared between calls, they
+    should not be modified in place.
+
+    :param map_x: x coordinates for each pixel on a map
+    :param map_y: y coordinates for each pixel on a map
+    :param cache_size: int, maximum number of arrays kept in the cache, least recently used arrays are dropped first
+    """
+
+    def __init__(self, map_x, map_y, cache_size=100):
+
+        _check_map(map_x, map_y)
+
+        self.map_x = map_x
+        self.map_y = map_y
+        self.cache_size = int(cache_size)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _get(self, key, func, *args):
+
+        if key in self._cache:
+            value = self._cache.pop(key)
+        else:
+            value = func(self.map_x, self.map_y, *args)
+            while len(self._cache) >= self.cache_size > 0:
+                self._cache.popitem(last=False)
+
+        if self.cache_size > 0:
+            self._cache[key] = value
+
+        return value
+
+    def circle_mask(self, center, radius):
+        """
+        cached version of circle_mask
+        """
+        center = tuple(float(c) for c in center)
+        return self._get(('circle', center, float(radius)), circle_mask, center, radius)
+
+    def oval_mask(self, center, width, height):
+        """
+        cached version of oval_mask
+        """
+        center = tuple(float(c) for c in center)
+        return self._get(('oval', center, float(width), float(height)), oval_mask, center, width, height)
+
+    def warped_square_mask(self, center, width, height, ori):
+        """
+        cached version of warped_square_mask
+        """
+        center = tuple(float(c) for c in center)
+        return self._get(('warped_square', center, float(width), float(height), float(ori)),
+                         warped_square_mask, center, width, height, ori)
+
+    def grating_distance(self, ori, center):
+        """
+        cached version of grating_distance
+        """
+        center = tuple(float(c) for c in center)
+        return self._get(('grating_distance', float(ori), center), grating_distance, ori, center)
+
+    def get_grating(self, ori=0., spatial_freq=0.1, center=(0., 60.), phase=0., contrast=1.):
+        """
+        generate a grating frame using the cached distance field, see get_grating_from_distance
+
+        :return: 2-d array with grating, value range [0., 1.]
+        """
+        distance = self.grating_distance(ori, center)
+        return get_grating_from_distance(distance, spatial_freq=spatial_freq, phase=phase, contrast=contrast)
+
+
+if __name__ == '__main__':
+
+    # ============================================================
+    map_x, map_y = np.meshgrid(np.arange(-10., 10.), np.arange(-5., 5.))
+    cache = MaskCache(map_x, map_y)
+    print(cache.circle_mask((0., 0.), 3.))
+    print(cache.warped_square_mask((0., 0.), 4., 4., 0.).astype(np.uint8))
+    # ============================================================
+
+    print('for debug ...')
@@ -88,48 +88,87 @@ def discrete_cross_correlation(ts1, ts2, t_range=(-1., 1.), bins=100, isPlot=Fal
              value: numpy array, total event counts in each time bin per trigger
     """
 
-    bin_width = (float(t_range[1]) - float(t_range[0])) / bins
-    t = np.arange(bins).astype(np.float64) * bin_width + t_range[0]
-    intervals = zip(t, t + bin_width)
-    values = np.zeros(bins, dtype=np.int64)
-    ts1s = np.sort(ts1)  # sort first timestamps array
-    ts2s = np.sort(ts2)  # sort second timestamps array
-
-    # pick up valid timestamps in first sorted timestamps
-    ts1s = ts1s[(ts1s >= (ts2s[0] - t_range[0])) & (ts1s < (ts2s[-1] - t_range[1]))]
-
-    n = len(ts1s)
+    t, values, ns = discrete_cross_correlations([ts1], [ts2], t_range=t_range, bins=bins, is_return_n=True)
+    values = values[0, 0]
 
-    if n == 0:
+    if ns[0, 0] == 0:
         print('no overlapping time range (defined as ' + str(t_range) + ' between two input timestamp arrays')
-        # return None
-    else:
-        ts2_start_ind = 0
 
-        for curr_ts1 in ts1s:
-            ts2s_short = ts2s[ts2_start_ind:]
-            for i, curr_ts2 in enumerate(ts2s_short):
-                if curr_ts2 >= curr_ts1 + t_range[0]:
-                    break
-            ts2s_short = ts2s_short[i:]
-            ts2_start_ind += i
-            ts2s_short = ts2s_short[ts2s_short < curr_ts1 + t_range[1]]
+    if isPlot:
+        bin_width = (float(t_range[1]) - float(t_range[0])) / bins
+        f = plt.figure(figsize=(15, 4))
+        ax = f.add_subplot(111)
+        ax.bar(t, values, bin_width * 0.9)
 
-            for j, curr_int in enumerate(intervals):
-                curr_start = curr_ts1 + curr_int[0]
-                curr_end = curr_ts1 + curr_int[1]
+    return t, values
 
-                values[j] += np.sum(np.logical_and((ts2s_short >= curr_start),
-                                                   (ts2s_short < curr_end)))
 
-        values = values.astype(np.float64) / n
+def discrete_cross_correlations(trigger_ts_sets, ts_sets, t_range=(-1., 1.), bins=100, is_return_n=False):
+    """
+    crosscorrelograms of many event time series (units, i.e. spike trains) triggered by many sets of trigger events
+    (probes) in one call. Each event time series is sorted once, then the event counts in every time bin around every
+    trigger are found by np.searchsorted on the bin edges. for each pair of trigger set and event time series, the
+    result is the same as discrete_cross_correlation(trigger_ts, ts, t_range, bins).
 
-    if isPlot:
-        f = plt.figure(figsize=(15, 4))
-        ax = f.add_subplot(111)
-        ax.bar([a[0] for a in intervals], values, bin_width * 0.9)
+    for each event time series, only the triggers that have the whole temporal window inside the time range of the
+    event time series are used.
 
-    return t, values.astype(np.float64)
+    :param trigger_ts_sets: list of 1d arrays, each array is the timestamps of one set of triggers (probe)
+    :param ts_sets: list of 1d arrays, each array is the timestamps of one event time series (unit)
+    :param t_range: tuple of two elements, temporal window of crosscorrelogram, the first element should be smaller than
+                    the second element.
+    :param bins: int, number of bins
+    :param is_return_n: bool, if True, the number of valid triggers of each unit and probe is also returned
+    :return: t: numpy.array, time axis of crosscorrelorgams, mark the left edges of each time bin
+             values: 3d array, unit x probe x bin, event counts in each time bin per valid trigger, zeros if a probe
+                     has no valid trigger
+             ns: 2d array of int, unit x probe, number of valid triggers, only returned if is_return_n is True
+    """
+
+    bin_width = (float(t_range[1]) - float(t_range[0])) / bins
+    t = np.arange(bins).astype(np.float64) * bin_width + t_range[0]
+    t_end = t + bin_width
+
+    probe_num = len(trigger_ts_sets)
+    trigger_ts = [np.array(trigger_ts_set, dtype=np.float64).flatten() for trigger_ts_set in trigger_ts_sets]
+    probe_inds = np.concatenate([np.zeros(len(trigger_ts_set), dtype=np.int64) + i
+                                 for i, trigger_ts_set in enumerate(trigger_ts)] + [np.zeros(0, dtype=np.int64)])
+    trigger_ts = np.concatenate(trigger_ts + [np.zeros(0, dtype=np.float64)])
+
+    values = np.zeros((len(ts_sets), probe_num, bins), dtype=np.float64)
+    ns = np.zeros((len(ts_sets), probe_num), dtype=np.int64)
+
+    for unit_i, ts in enumerate(ts_sets):
+        tss = np.sort(np.array(ts, dtype=np.float64).flatten())
+        if len(tss) == 0:
+            continue
+
+        is_valid = (trigger_ts >= (tss[0] - t_range[0])) & (trigger_ts < (tss[-1] - t_range[1]))
+        curr_triggers = trigger_ts[is_valid]
+        curr_probe_inds = probe_inds[is_valid]
+        if len(curr_triggers) == 0:
+            continue
+
+        # bin edges of every valid trigger, trigger x bin
+        bin_starts = curr_triggers[:, None] + t[None, :]
+        bin_ends = curr_triggers[:, None] + t_end[None, :]
+        bin_ends[:, -1] = np.minimum(bin_ends[:, -1], curr_triggers + t_range[1])
+
+        counts = np.searchsorted(tss, bin_ends, side='left') - np.searchsorted(tss, bin_starts, side='left')
+        counts[counts < 0] = 0
+
+        curr_ns = np.bincount(curr_probe_inds, minlength=probe_num)
+        for bin_i in range(bins):
+            values[unit_i, :, bin_i] = np.bincount(curr_probe_inds, weights=counts[:, bin_i], minlength=probe_num)
+
+        has_trigger = curr_ns > 0
+        values[unit_i, has_trigger, :] = values[unit_i, has_trigger, :] / curr_ns[has_trigger, None]
+        ns[unit_i] = curr_ns
+
+    if is_return_n:
+        return t, values, ns
+    else:
+        return t, values
 
 
 def find_nearest(trace, value, direction=0):
@@ -162,6 +201,76 @@ def find_nearest(trace, value, direction=0):
         return np.nanargmin(diff)
 
 
+def find_nearest_sorted(trace, values):
+    '''
+    vectorized version of find_nearest (direction=0) for a monotonically non-decreasing trace, all values are
+    resolved with one np.searchsorted. if two elements are equally close, the smaller index is returned.
+
+    :param trace: 1d array, monotonically non-decreasing, usually timestamps
+    :param values: scalar or 1d array, values to look for
+    :return: 1d array of ints, the index in "trace" having the closest value to each value in "values"
+    '''
+
+    trace = np.asarray(trace)
+    values = np.asarray(values, dtype=np.float64).flatten()
+
+    if len(trace.shape) != 1:
+        raise ValueError('Input trace should be one dimensional!')
+
+    if trace.shape[0] == 0:
+        raise ValueError('Input trace should not be empty!')
+
+    if trace.shape[0] == 1:
+        return np.zeros(values.shape, dtype=np.int64)
+
+    ind = np.searchsorted(trace, values, side='left')
+    ind = np.clip(ind, 1, trace.shape[0] - 1).astype(np.int64)
+    left_diff = values - trace[ind - 1].astype(np.float64)
+    right_diff = trace[ind].astype(np.float64) - values
+    ind[left_diff <= right_diff] -= 1
+
+    return ind
+
+
+def event_triggered_traces(arr, arr_ts, trigger_ts, frame_start, frame_end, is_return_ind=False):
+    '''
+    extract event triggered windows from regularly sampled traces. the index of each trigger is resolved by
+    find_nearest_sorted and all windows are gathered with one fancy indexing into a (roi x trial x time) array.
+    triggers whose window is not fully within the traces are excluded.
+
+    :param arr: 2d array, roi x time, or 1d array (single trace)
+    :param arr_ts: 1d array, timestamps of arr, monotonically increasing, should have same size as the last axis of arr
+    :param trigger_ts: 1d array, timestamps of the triggers
+    :param frame_start: int, index of window start relative to trigger frame, can be negative
+    :param frame_end: int, index of window end (exclusive) relative to trigger frame, should be larger than frame_start
+    :param is_return_ind: bool, if True, also return the indices (in trigger_ts) of included triggers
+    :return sta: 3d array, roi x trial x time (2d array, trial x time, if arr is 1d)
+    :return trigger_ind: 1d array of ints, indices of included triggers, only returned if is_return_ind is True
+    '''
+
+    if frame_end <= frame_start:
+        raise ValueError('frame_end should be larger than frame_start!')
+
+    arr = np.asarray(arr)
+    arr_ts = np.asarray(arr_ts)
+
+    if arr.shape[-1] != arr_ts.shape[0]:
+        raise ValueError('the last dimension of arr ({}) should match the length of arr_ts '
+                         '({}).'.format(arr.shape[-1], arr_ts.shape[0]))
+
+    trig_ind = find_nearest_sorted(arr_ts, trigger_ts)
+    is_valid = np.logical_and(trig_ind + frame_start >= 0, trig_ind + frame_end <= arr.shape[-1])
+    trigger_ind = np.where(is_valid)[0]
+
+    win_ind = trig_ind[trigger_ind][:, None] + np.arange(frame_start, frame_end, dtype=np.int64)[None, :]
+    sta = arr[..., win_ind]
+
+    if is_return_ind:
+        return sta, trigger_ind
+    else:
+        return sta
+
+
 def get_event_with_pre_iei(ts_events, iei=None):
     """
     get events which has a pre inter event interval (IEI) longer than a certain period of time
@@ -606,17 +715,77 @@ def notch_filter(trace, fs=30000., freq_base=60., bandwidth=1., harmonics=4, ord
     return trace_filtered.astype(trace.dtype)
 
 
-def event_triggered_average_irregular(ts_event, continuous, ts_continuous, t_range=(-1., 1.), bins=100, is_plot=False):
+def _get_event_window_samples(ts_event, ts_continuous, t_range, bin_width, bins):
+    """
+    find all the samples falling in the temporal windows of all events with np.searchsorted
+
+    :param ts_event: 1-d array, float, timestamps of events
+    :param ts_continuous: 1-d array, float, monotonic increasing timestamps of the samples
+    :return: sample_inds: 1-d array, int, index of each sample in ts_continuous (a sample appears once for every window
+                          it falls in)
+             bin_inds: 1-d array, int, the bin in the event triggered average of each sample
+    """
+    window_starts = ts_event + t_range[0]
+    los = np.searchsorted(ts_continuous, window_starts, side='left')
+    his = np.searchsorted(ts_continuous, ts_event + t_range[1], side='left')
+    counts = his - los
+
+    total_num = np.sum(counts)
+    if total_num == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # consecutive indices from los[i] to his[i] of every event, concatenated
+    window_offsets = np.cumsum(counts) - counts
+    sample_inds = np.arange(total_num, dtype=np.int64) + np.repeat(los - window_offsets, counts)
+
+    bin_inds = ((ts_continuous[sample_inds] - np.repeat(window_starts, counts)) // bin_width).astype(np.int64)
+    bin_inds = np.clip(bin_inds, 0, bins - 1)
+
+    return sample_inds, bin_inds
+
+
+def _merge_bin_stats(n, mean, m2, values, bin_inds, bins):
+    """
+    merge the count, mean and sum of squared deviations of each bin with a new batch of binned values (Chan et al.
+    parallel algorithm)
+
+    :return: n, mean, m2 after merging
+    """
+    n_b = np.bincount(bin_inds, minlength=bins).astype(np.float64)
+    has_value = n_b > 0
+    mean_b = np.zeros(bins, dtype=np.float64)
+    mean_b[has_value] = np.bincount(bin_inds, weights=values, minlength=bins)[has_value] / n_b[has_value]
+    m2_b = np.bincount(bin_inds, weights=(values - mean_b[bin_inds]) ** 2, minlength=bins)
+
+    n_ab = n + n_b
+    delta = mean_b - mean
+    mean_ab = np.array(mean)
+    mean_ab[has_value] = mean[has_value] + delta[has_value] * n_b[has_value] / n_ab[has_value]
+    m2_ab = m2 + m2_b
+    m2_ab[has_value] += delta[has_value] ** 2 * n[has_value] * n_b[has_value] / n_ab[has_value]
+
+    return n_ab, mean_ab, m2_ab
+
+
+def event_triggered_average_irregular(ts_event, continuous, ts_continuous, t_range=(-1., 1.), bins=100, is_plot=False,
+                                      block_size=None):
     """
     event triggered average of an analog signal trigger by discrete events. The timestamps of the analog signal may not
     be regular
 
+    the window bounds of all events are found by np.searchsorted and the samples of all events are binned together,
+    the mean and standard deviation of each bin are accumulated with np.bincount.
+
     :param ts_event: 1-d array, float, timestamps of trigging event
     :param continuous: 1-d array, float, value of the analog signal
     :param ts_continuous: 1-d array, float, timestamps of the analog signal, should have same length as continuous
     :param t_range: tuple of 2 floats, temporal range of calculated average
     :param bins: int, number of bins of calculated average
     :param is_plot:
+    :param block_size: None or positive int. if None, the whole analog signal is loaded into memory. if int, the
+                       analog signal is streamed in blocks of block_size samples, continuous and ts_continuous can then
+                       be any array-like objects supporting slicing (e.g. h5py datasets), and ts_continuous should be
+                       monotonic increasing
     :return: eta: 1-d array, float, event triggered average
              n: 1-d array, unit, number of time point of each bin
              t: 1-d array, float, time axis of event triggered average
@@ -628,60 +797,69 @@ def event_triggered_average_irregular(ts_event, continuous, ts_continuous, t_ran
     if t_range[0] >= t_range[1]:
         raise ValueError('t_range[0] should be smaller than t_range[1].')
 
-    # sort continuous channel to be monotonic increasing in temporal domain
-    sort_ind = np.argsort(ts_continuous)
-    ts_continuous = ts_continuous[sort_ind]
-    continuous = continuous[sort_ind]
+    if block_size is None:
+        # sort continuous channel to be monotonic increasing in temporal domain
+        ts_continuous = np.asarray(ts_continuous)
+        sort_ind = np.argsort(ts_continuous)
+        ts_continuous = ts_continuous[sort_ind]
+        continuous = np.asarray(continuous)[sort_ind]
+        block_size = len(ts_continuous)
+    elif block_size < 1:
+        raise ValueError('block_size should be a positive integer.')
+
+    sample_num = len(ts_continuous)
+    if len(continuous) != sample_num:
+        raise ValueError('continuous and ts_continuous should have same length.')
 
     # initiation
     bin_width = (t_range[1] - t_range[0]) / bins
     t = t_range[0] + np.arange(bins, dtype=np.float32) * bin_width
 
-    eta_list = [[] for bin in t]
-    n = np.zeros(t.shape, dtype=np.uint64)
-    std = np.zeros(t.shape, dtype=np.float32)
+    n = np.zeros(bins, dtype=np.float64)
+    mean = np.zeros(bins, dtype=np.float64)
+    m2 = np.zeros(bins, dtype=np.float64)
+
+    print('\nStart calculating event triggered average ...')
+
+    # only events with the whole window inside the recording are included
+    ts_event = np.sort(np.array(ts_event, dtype=np.float64).flatten())
+    if sample_num > 0:
+        ts_event = ts_event[((ts_event + t_range[0]) > ts_continuous[0]) &
+                            ((ts_event + t_range[1]) < ts_continuous[sample_num - 1])]
+    else:
+        ts_event = ts_event[0:0]
+
+    for block_start in range(0, sample_num, block_size):
+        block_end = min(block_start + block_size, sample_num)
+
+        if len(ts_event) == 0:
+            break
+
+        if block_size < sample_num:
+            print('progress: ' + str(int(block_start * 100. / sample_num)) + '%')
+
+        ts_block = np.asarray(ts_continuous[block_start:block_end], dtype=np.float64)
+
+        # events whose window overlaps with this block
+        curr_events = ts_event[((ts_event + t_range[1]) > ts_block[0]) & ((ts_event + t_range[0]) <= ts_block[-1])]
+        if len(curr_events) == 0:
+            continue
+
+        sample_inds, bin_inds = _get_event_window_samples(curr_events, ts_block, t_range, bin_width, bins)
+        if len(sample_inds) == 0:
+            continue
+
+        values = np.asarray(continuous[block_start:block_end], dtype=np.float64)[sample_inds]
+        n, mean, m2 = _merge_bin_stats(n, mean, m2, values, bin_inds, bins)
+
     eta = np.zeros(t.shape, dtype=np.float32)
     eta[:] = np.nan
+    eta[n > 0] = mean[n > 0]
 
-    print('\nStart calculating event triggered average ...')
-    percentage = None
-
-    for ind_eve, eve in enumerate(ts_event):
-
-        # for display
-        curr_percentage =  int((float(ind_eve) * 100. / float(len(ts_event))) // 10) * 10
-        if curr_percentage != percentage:
-            print('progress: ' + str(curr_percentage) + '%')
-            # print(eve, ':', ts_continuous[-1])
-            percentage = curr_percentage
-
-        if ((eve + t_range[0]) > ts_continuous[0]) and ((eve + t_range[1]) < ts_continuous[-1]):
-
-            # slow algorithm
-            # bin_starts = t + eve
-            # for i, bin_start in enumerate(bin_starts):
-            #     curr_datapoint =  continuous[(ts_continuous >= bin_start) & (ts_continuous < (bin_start + bin_width))]
-            #     if len(curr_datapoint) != 0:
-            #         eta_list[i] += list(curr_datapoint)
-
-            # fast algorithm
-            all_bin_start = eve + t_range[0]
-            all_bin_end = eve + t_range[1]# - 1e-10
-            for i, curr_t in enumerate(ts_continuous):
-                if curr_t < all_bin_start:
-                    continue
-                elif curr_t >= all_bin_end:
-                    break
-                else:
-                    bin_ind = int((curr_t - all_bin_start) // bin_width)
-                    eta_list[bin_ind].append(continuous[i])
+    std = np.zeros(t.shape, dtype=np.float32)
+    std[n > 1] = np.sqrt(m2[n > 1] / n[n > 1])
 
-    for j, datapoints in enumerate(eta_list):
-        if len(datapoints) > 0:
-            eta[j] = np.mean(datapoints)
-            n[j] = len(datapoints)
-        if len(datapoints) > 1:
-            std[j] = np.std(datapoints)
+    n = n.astype(np.uint64)
 
     if is_plot:
         f = plt.figure(figsize=(10, 10))
@@ -690,7 +868,7 @@ def event_triggered_average_irregular(ts_event, continuous, ts_continuous, t_ran
         ax.plot(t, eta, '-k')
         ax.set_title('event triggered average')
         ax.set_xlabel('time (sec)')
-        ax.set_xlim([t_range[0], t_range[1] - 1. / fs])
+        ax.set_xlim([t_range[0], t_range[1] - bin_width])
         plt.show()
 
     return eta, t, n, std
@@ -791,6 +969,9 @@ def threshold_to_intervals(trace, thr, comparison='>='):
     """
     threshold a 1d trace, return intervals of indices that are above the threshold.
 
+    the intervals are found from the rising and falling edges of the thresholded trace (np.diff and np.nonzero). a
+    sample that can not be compared with the threshold (nan) keeps the state of the previous sample.
+
     :param trace: 1d array
     :param thr: float
     :param comparison: str, '>', '>=', '<' or '<='
@@ -802,56 +983,58 @@ def threshold_to_intervals(trace, thr, comparison='>='):
     if len(trace.shape) != 1:
         raise ValueError("the input 'trace' should be a 1d array.")
 
-    flag = False
-
-    start = []
-    end = []
+    with np.errstate(invalid='ignore'):
+        if comparison == '>=':
+            is_on, is_off = trace >= thr, trace < thr
+        elif comparison == '>':
+            is_on, is_off = trace > thr, trace <= thr
+        elif comparison == '<=':
+            is_on, is_off = trace <= thr, trace > thr
+        elif comparison == '<':
+            is_on, is_off = trace < thr, trace >= thr
+        else:
+            raise LookupError('Do not understand input "comparison", should be ">=", ">", "<=", "<".')
 
-    for pi, pv in enumerate(trace):
+    state = is_on.astype(np.int8)
 
-        if comparison == '>=':
-            if pv >= thr and (not flag):
-                start.append(pi)
-                flag = True
+    # samples neither on nor off keep the previous state
+    is_undefined = ~(is_on | is_off)
+    if np.any(is_undefined):
+        last_defined = np.maximum.accumulate(np.where(is_undefined, -1, np.arange(len(trace))))
+        state = np.where(last_defined >= 0, state[np.maximum(last_defined, 0)], 0).astype(np.int8)
 
-            if pv < thr and flag:
-                end.append(pi)
-                flag = False
+    edges = np.diff(np.concatenate(([0], state, [0])))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
 
-        elif comparison == '>':
-            if pv > thr and (not flag):
-                start.append(pi)
-                flag = True
+    return list(zip(starts.tolist(), ends.tolist()))
 
-            if pv <= thr and flag:
-                end.append(pi)
-                flag = False
 
-        elif comparison == '<=':
-            if pv <= thr and (not flag):
-                start.append(pi)
-                flag = True
+def merge_intervals(intervals):
+    """
+    merge a set of closed intervals which may be unsorted and may overlap with each other into sorted, non-overlapping
+    intervals covering the same time. intervals touching each other are also merged. intervals with end earlier than
+    start are discarded, zero-length intervals (start == end) are kept as single time points.
 
-            if pv > thr and flag:
-                end.append(pi)
-                flag = False
+    :param intervals: array like, shape (n, 2), each row: (start, end) of one interval
+    :return: 2d array, float64, shape (m, 2), sorted, non-overlapping intervals
+    """
 
-        elif comparison == '<':
-            if pv < thr and (not flag):
-                start.append(pi)
-                flag = True
+    intervals = np.array(intervals, dtype=np.float64).reshape((-1, 2))
+    intervals = intervals[intervals[:, 1] >= intervals[:, 0]]
 
-            if pv >= thr and flag:
-                end.append(pi)
-                flag = False
+    if intervals.shape[0] == 0:
+        return intervals
 
-        else:
-            raise LookupError('Do not understand input "comparison", should be ">=", ">", "<=", "<".')
+    intervals = intervals[np.argsort(intervals[:, 0], kind='mergesort')]
 
-    if len(start) - len(end) == 1:
-        end.append(len(trace))
+    # a new merged interval begins where the start is later than all previous ends
+    prev_max_ends = np.maximum.accumulate(intervals[:, 1])
+    is_new = np.concatenate(([True], intervals[1:, 0] > prev_max_ends[:-1]))
+    group_starts = np.nonzero(is_new)[0]
+    group_ends = np.concatenate((group_starts[1:], [intervals.shape[0]])) - 1
 
-    return zip(start, end)
+    return np.array([intervals[group_starts, 0], prev_max_ends[group_ends]]).transpose()
 
 
 def haramp(trace, periods, ceil_f=4):
@@ -898,7 +1081,8 @@ class TimeIntervals(object):
     column 0: start timestamps
     column 1: end timestamps
 
-    the intervals are incremental in time and should not have overlap within them.
+    the intervals are incremental in time and should not have overlap within them. since the intervals are saved as a
+    sorted array, overlap, union and containment are computed with np.searchsorted.
     """
 
     def __init__(self, intervals):
@@ -910,6 +1094,9 @@ class TimeIntervals(object):
     @staticmethod
     def check_integraty(intervals):
 
+        if len(intervals) == 0:
+            return np.zeros((0, 2), dtype=np.float64)
+
         intervals_cp = np.array([np.array(d, dtype=np.float64) for d in intervals])
         intervals_cp = intervals_cp.astype(np.float64)
 
@@ -919,15 +1106,10 @@ class TimeIntervals(object):
         if intervals_cp.shape[1] != 2:
             raise ValueError('intervals.shape[1] should be 2. (start, end) of the interval')
 
-        # for interval_i, interval in enumerate(intervals_cp):
-        #     if interval[1] <= interval[0]:
-        #         raise ValueError('the {}th interval: end time ({}) earlier than start time ({})'.
-        #                          format(interval_i, interval[1], interval[0]))
-
         intervals_cp = intervals_cp[intervals_cp[:, 0].argsort()]
 
-        ts_list = np.concatenate(intervals_cp, axis=0)
-        if not check_monotonicity(arr=ts_list, direction='increasing'):
+        # zero-length intervals (start == end, single time points) are allowed, different intervals can not touch
+        if np.any(intervals_cp[:, 1] < intervals_cp[:, 0]) or np.any(intervals_cp[1:, 0] <= intervals_cp[:-1, 1]):
             raise ValueError('The intervals should be incremental in time and should not have overlap within them.')
 
         return intervals_cp
@@ -937,49 +1119,42 @@ class TimeIntervals(object):
         return a new TimeIntervals object that represents the overlap between self and the input Timeintervals
 
         :param time_intervals: corticalmapping.core.TimingAnalysis.TimeIntervals object
+        :return: corticalmapping.core.TimingAnalysis.TimeIntervals object, None if there is no overlap
         """
 
-        starts0 = [[s, 1] for s in self._intervals[:, 0]]
-        ends0 = [[e, -1] for e in self._intervals[:, 1]]
+        intervals0 = self._intervals
+        intervals1 = time_intervals.get_intervals()
 
-        starts1 = [[s, 1] for s in time_intervals.get_intervals()[:, 0]]
-        ends1 = [[e, -1] for e in time_intervals.get_intervals()[:, 1]]
+        # for each interval in self, the range of intervals in the input that overlap with it
+        ind_los = np.searchsorted(intervals1[:, 1], intervals0[:, 0], side='right')
+        ind_his = np.searchsorted(intervals1[:, 0], intervals0[:, 1], side='left')
+        counts = np.maximum(ind_his - ind_los, 0)
 
-        events_lst = starts0 + ends0 + starts1 + ends1
-        # print(events_lst)
-
-        ts_arr = np.array([e[0] for e in events_lst])
-        events_lst = [events_lst[i] for i in np.argsort(ts_arr)]
-        # print(events_lst)
+        if np.sum(counts) == 0:
+            return None
 
-        mask = np.cumsum([e[1] for e in events_lst])
+        inds0 = np.repeat(np.arange(intervals0.shape[0]), counts)
+        inds1 = np.arange(np.sum(counts)) + np.repeat(ind_los - (np.cumsum(counts) - counts), counts)
 
-        new_starts = []
-        new_ends = []
+        new_starts = np.maximum(intervals0[inds0, 0], intervals1[inds1, 0])
+        new_ends = np.minimum(intervals0[inds0, 1], intervals1[inds1, 1])
 
-        flag = 0 # 1: within overlap, 0: outside overlap
-        for ts_i, msk in enumerate(mask):
+        is_valid = new_ends > new_starts
+        if not np.any(is_valid):
+            return None
 
-            if flag == 0 and msk == 2:
-                new_starts.append(events_lst[ts_i][0])
-                flag = 1
-            elif flag == 1 and msk < 2:
-                new_ends.append(events_lst[ts_i][0])
-                flag = 0
-            elif flag == 1 and msk == 2:
-                raise ValueError('do not understand the timestamps: flag={}, msk={}.'.format(flag, msk))
-            else:
-                pass
+        return TimeIntervals(intervals=np.array([new_starts[is_valid], new_ends[is_valid]]).transpose())
 
-        if len(new_starts) != len(new_ends):
-            raise ValueError('the length of new_starts ({}) does not equal the length of new_ends ({}).'.
-                             format(len(new_starts), len(new_ends)))
+    def union(self, time_intervals):
+        """
+        return a new TimeIntervals object that represents the union of self and the input Timeintervals, overlapping
+        or touching intervals are merged.
 
-        if new_starts:
-            new_intervals = np.array([np.array(new_starts), np.array(new_ends)]).transpose()
-            return TimeIntervals(intervals=new_intervals)
-        else:
-            return None
+        :param time_intervals: corticalmapping.core.TimingAnalysis.TimeIntervals object
+        :return: corticalmapping.core.TimingAnalysis.TimeIntervals object
+        """
+        return TimeIntervals(intervals=merge_intervals(np.concatenate((self._intervals,
+                                                                       time_intervals.get_intervals()), axis=0)))
 
     def is_contain(self, time_interval):
         """
@@ -993,28 +1168,45 @@ class TimeIntervals(object):
         if time_interval[0] >= time_interval[1]:
             raise ValueError('the start of input "time_interval" should be earlier than the end.')
 
-        for interval in self._intervals:
+        # the last interval starting before the input time_interval
+        ind = np.searchsorted(self._intervals[:, 0], time_interval[0], side='right') - 1
 
-            if interval[0] > time_interval[0]: # current interval starts after input time_interval
-                return False
-            else: # current interval starts before input time_interval
-                if interval[1] < time_interval[0]: # current interval ends before input time_interval
-                    pass
-                elif interval[1] < time_interval[1]: # current interval ends within input time_interval
-                    return False
-                else:
-                    return True # current interval contains input time_interval
+        if ind < 0: # all intervals in self start after input time_interval or self._intervals is empty
+            return False
+        else:
+            return bool(self._intervals[ind, 1] >= time_interval[1])
 
-        # all intervals in self end before input time_interval
-        # or self._intervals is empty
-        return False
+    def is_contain_ts(self, ts):
+        """
+        :param ts: 1d array, timestamps
+        :return: 1d boolean array, same shape as ts, if each timestamp is within any interval of self (including the
+                 start and the end)
+        """
+        ts = np.asarray(ts, dtype=np.float64)
+        inds = np.searchsorted(self._intervals[:, 0], ts, side='right') - 1
+        mask = inds >= 0
+        mask[mask] = ts[mask] <= self._intervals[inds[mask], 1]
+        return mask
 
     def to_h5_group(self, grp):
-        pass
+        """
+        save the intervals into a hdf5 group
+
+        :param grp: h5py group object
+        """
+        grp.create_dataset('intervals', data=self._intervals)
+        grp.attrs['shape'] = '(interval, start/end)'
+        grp.attrs['time_unit'] = 'second'
 
     @staticmethod
     def from_h5_group(grp):
-        pass
+        """
+        load TimeIntervals object from a hdf5 group saved by TimeIntervals.to_h5_group()
+
+        :param grp: h5py group object
+        :return: corticalmapping.core.TimingAnalysis.TimeIntervals object
+        """
+        return TimeIntervals(intervals=grp['intervals'].value)
 
 
 if __name__=='__main__':
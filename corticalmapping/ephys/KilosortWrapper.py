@@ -51,6 +51,60 @@ def get_clusters(csv_output):
     return output
 
 
+def get_cluster_spike_indices(spike_clusters, spike_times):
+    """
+    group spike indices by cluster with a single sort, instead of masking the whole spike array for each cluster
+    :param spike_clusters: 1d array, cluster id of each spike, content of spike_clusters.npy
+    :param spike_times: 1d array, index of each spike in the continuous recording, content of spike_times.npy
+    :return: dict, {cluster_id: 1d array of sorted spike indices of this cluster}, only clusters with spikes are
+             included
+    """
+
+    spike_times = np.asarray(spike_times).flatten()
+    spike_clusters = np.asarray(spike_clusters).flatten()
+
+    if len(spike_clusters) != len(spike_times):
+        raise ValueError('length of spike_cluster does not match length of spike_times!')
+
+    if len(spike_times) == 0:
+        return {}
+
+    if np.any(spike_times[1:] < spike_times[:-1]):
+        order = np.lexsort((spike_times, spike_clusters))
+    else:
+        # spike_times from kilosort are already sorted, so sorting by (cluster, position) keeps them sorted in each
+        # cluster. the position makes every key unique, so the fast unstable sort can be used
+        keys = (spike_clusters.astype(np.int64) - np.min(spike_clusters)) * len(spike_clusters) + \
+               np.arange(len(spike_clusters), dtype=np.int64)
+        order = np.argsort(keys)
+    sorted_clusters = spike_clusters[order]
+    sorted_times = spike_times[order]
+
+    first_ind = np.flatnonzero(sorted_clusters[1:] != sorted_clusters[:-1]) + 1
+    cluster_ids = sorted_clusters[np.concatenate(([0], first_ind))]
+    spike_groups = np.split(sorted_times, first_ind)
+
+    return dict(zip(cluster_ids.tolist(), spike_groups))
+
+
+def get_spike_indices_in_range(spikes, ind_start, ind_end):
+    """
+    get spike indices within [ind_start, ind_end), for example the part of a concatenated recording belonging to one
+    file
+    :param spikes: 1d array, spike indices, should be sorted, unsorted input will be sorted first
+    :param ind_start: int, start index (inclusive)
+    :param ind_end: int, end index (exclusive)
+    :return: 1d array, spike indices in range, same dtype as spikes
+    """
+
+    spikes = np.asarray(spikes)
+
+    if np.any(spikes[1:] < spikes[:-1]):
+        spikes = np.sort(spikes)
+
+    return spikes[np.searchsorted(spikes, ind_start, side='left'): np.searchsorted(spikes, ind_end, side='left')]
+
+
 def get_spike_times_indices(clusters, spike_clusters_path, spike_times_path):
     """
     get spike timestamps of defined clusters
@@ -65,24 +119,18 @@ def get_spike_times_indices(clusters, spike_clusters_path, spike_times_path):
     spike_times = np.load(spike_times_path).flatten()
     spike_cluster = np.load(spike_clusters_path).flatten()
 
-    if len(spike_cluster) != len(spike_times):
-        raise ValueError('length of spike_cluster does not match length of spike_times!')
+    cluster_spikes = get_cluster_spike_indices(spike_cluster, spike_times)
 
     spike_ind = {}
 
     for cluster, cluster_id in clusters.iteritems():
         if cluster == 'unit_mua':
-            mua_spike_ind = []
-            for id in cluster_id:
-                mua_spike_ind += list(spike_times[spike_cluster == id])
-            mua_spike_ind.sort()
+            mua_spike_ind = [cluster_spikes[id] for id in cluster_id if id in cluster_spikes]
             if len(mua_spike_ind) > 0:
-                spike_ind.update({'unit_mua': np.array(mua_spike_ind, dtype=spike_times.dtype)})
+                spike_ind.update({'unit_mua': np.sort(np.concatenate(mua_spike_ind))})
         else:
-            curr_cluster_ind = list(spike_times[spike_cluster == cluster_id])
-            curr_cluster_ind.sort()
-            if len(curr_cluster_ind) > 0:
-                spike_ind.update({cluster: np.array(curr_cluster_ind, dtype=spike_times.dtype)})
+            if cluster_id in cluster_spikes:
+                spike_ind.update({cluster: cluster_spikes[cluster_id]})
 
     return spike_ind
 
@@ -138,8 +186,8 @@ def get_spike_timestamps(spike_ind, h5_path):
 
         for unit, spikes in spike_ind.iteritems():
 
-            curr_spike_ind = [spk for spk in spikes if spk >= curr_start_ind and spk < curr_end_ind]
-            curr_spike_ind = np.array(curr_spike_ind, dtype=np.float32) - curr_start_ind
+            curr_spike_ind = get_spike_indices_in_range(spikes, curr_start_ind, curr_end_ind)
+            curr_spike_ind = curr_spike_ind.astype(np.float32) - curr_start_ind
             curr_spike_timestamps = curr_spike_ind / fs
             curr_dataset = curr_group['timestamps'].create_dataset(unit, data=curr_spike_timestamps)
             curr_dataset.attrs['unit'] = 'second'
@@ -10,37 +10,121 @@ CONTINUOUS_SAMPLE_PER_RECORD_DTYPE = np.dtype('<u2') # dtype of samples per reco
 CONTINUOUS_RECORDING_NUMBER_DTYPE = np.dtype('<u2') # dtype of recording number field in each record (block) of .continuous file
 CONTINUOUS_SAMPLE_DTYPE = np.dtype('>i2') # dtype of each sample in each record (block) of .continuous file
 CONTINUOUS_MARKER_BYTES = 10 # number of bytes of marker field in each record (block) of .continuous file
+CONTINUOUS_RECORD_DTYPE = np.dtype([('timestamp', CONTINUOUS_TIMESTAMP_DTYPE),
+                                    ('sample_num', CONTINUOUS_SAMPLE_PER_RECORD_DTYPE),
+                                    ('recording_number', CONTINUOUS_RECORDING_NUMBER_DTYPE),
+                                    ('samples', CONTINUOUS_SAMPLE_DTYPE, (oe.SAMPLES_PER_RECORD,)),
+                                    ('marker', np.dtype('<u1'), (CONTINUOUS_MARKER_BYTES,))]) # layout of each record (block) of .continuous file
 
 
-def find_next_valid_block(input_array, bytes_per_block, start_index):
+def find_next_valid_block(input_array, bytes_per_block, start_index, scan_bytes=2 ** 24):
     """
     this is for finding starting byte index of first valid block after a certain position of a continuous file. Valid
     block is defined as the last 10 bytes equals oe.RECORD_MARKER if read as unsigned integer 8-bit (little endian). This
     is useful when two open ephys recordings are accidentally recorded in a same file. To extract the data of the
     second recording. It is necessary to find the first valid block after the first recording.
 
-    :param input_array:
+    the marker is searched with array comparisons over windows of scan_bytes bytes, so input_array can be a memory map
+    of the whole file.
+
+    :param input_array: 1-d array of '<u1', bytes of the file
     :param bytes_per_block: positive integer, number of bytes per block
     :param start_index: non-negative int
+    :param scan_bytes: positive int, number of bytes searched in each window
     :return: first_block_start: non-negative int, the start index of the first block after start_index
     """
 
     if len(input_array.shape) != 1:
         raise ValueError('input_array should be 1-d array.')
 
-    first_valid_block_start = None
+    marker = np.array(oe.RECORD_MARKER, dtype=np.uint8)
+    marker_len = len(marker)
 
-    for i in range(start_index + bytes_per_block, len(input_array)):
+    first_valid_block_start = None
 
-        if np.array_equal(input_array[i-10: i], oe.RECORD_MARKER):
-            first_valid_block_start = i - bytes_per_block
+    # candidate ends of the marker: i in range(start_index + bytes_per_block, len(input_array))
+    win_start = start_index + bytes_per_block
+    while win_start < len(input_array):
+        win_end = min(win_start + scan_bytes, len(input_array))
+        window = np.asarray(input_array[win_start - marker_len: win_end - 1])
+        is_marker = window[0: win_end - win_start] == marker[0]
+        for k in range(1, marker_len):
+            is_marker &= window[k: k + win_end - win_start] == marker[k]
+
+        marker_ends = np.flatnonzero(is_marker)
+        if len(marker_ends) > 0:
+            first_valid_block_start = int(win_start + marker_ends[0] - bytes_per_block)
             break
+
+        win_start = win_end
     else:
         print 'no valid block found after index:', start_index
 
     return first_valid_block_start
 
 
+def get_continuous_records(file_path, start_ind=0):
+    """
+    memory-map a .continuous file as an array of records (blocks). Only the valid records from the first valid block
+    after start_ind are returned: reading stops before the first record with a wrong number of samples or a wrong
+    record marker, so the returned array is empty if the first record already has a wrong number of samples. Nothing
+    but the header is read into memory, so the samples of any range of records can be read lazily from the returned
+    array.
+
+    :param file_path:
+    :param start_ind: non-negative int, default 0. start byte index to search for the first valid block.
+    :return: header: dictionary, standard open ephys header for continuous file, with 'start_time' (second, timestamp
+                     of the first record after start_ind) added
+             records: 1d memory-mapped structured array with dtype CONTINUOUS_RECORD_DTYPE, fields: 'timestamp',
+                      'sample_num', 'recording_number', 'samples' (big endian int16, (oe.SAMPLES_PER_RECORD,)) and
+                      'marker'. The first sample of record i is sample i * oe.SAMPLES_PER_RECORD of the trace.
+    """
+
+    bytes_per_block = CONTINUOUS_RECORD_DTYPE.itemsize
+
+    input_array = np.memmap(file_path, dtype='<u1', mode='r')
+    file_length = input_array.shape[0]
+    print 'total length of the file: ', file_length, 'bytes.'
+
+    valid_block_start = find_next_valid_block(input_array, bytes_per_block=bytes_per_block, start_index=start_ind)
+    del input_array
+    print 'the beginning index of the first valid block after index: ' + str(start_ind) + ' is ' + \
+          str(valid_block_start)
+
+    if valid_block_start is None:
+        raise LookupError('no valid record is found in ' + file_path + ' after index: ' + str(start_ind) + '.')
+
+    print 'bytes per record block: ', bytes_per_block
+
+    with open(file_path, 'rb') as f:
+        header = oe.readHeader(f)
+
+    block_num = (file_length - valid_block_start) // bytes_per_block
+    print 'number of potential valid blocks after index', start_ind, ':', block_num
+
+    records = np.memmap(file_path, dtype=CONTINUOUS_RECORD_DTYPE, mode='r', offset=valid_block_start,
+                        shape=(block_num,))
+
+    # validate all records at once
+    is_invalid = records['sample_num'] != oe.SAMPLES_PER_RECORD
+    is_invalid |= np.any(records['marker'] != np.array(oe.RECORD_MARKER, dtype=np.uint8), axis=1)
+    invalid_inds = np.flatnonzero(is_invalid)
+
+    # timestamp of the very first record (block) for alignment of the digital event, taken before truncation so that
+    # it is still defined if the first record is already invalid
+    start_time = float(records['timestamp'][0]) / float(header['sampleRate'])
+    header.update({'start_time': start_time})
+
+    if len(invalid_inds) > 0:
+        i = invalid_inds[0]
+        print('samples per record (' + str(records['sample_num'][i]) + ') or record marker (' +
+              str(records['marker'][i]) + ') specified in block ' + str(i) + ' does not equal to expected value (' +
+              str(oe.SAMPLES_PER_RECORD) + ', ' + str(oe.RECORD_MARKER) + ')!')
+        records = records[0: i]
+
+    return header, records
+
+
 def get_digital_line_for_plot(h5_group):
     """
     use plt.step to plot, 'where' parameter should be set to be 'post'
@@ -149,88 +233,83 @@ def load_continuous_old(file_path, dtype=np.float32):
     return header, samples
 
 
-def load_continuous(file_path, dtype=np.float32, start_ind=0):
+def get_samples_from_records(header, records, dtype=np.float32, sample_range=None, is_return_timestamps=False):
     """
-    Jun's wrapper to load .continuous data from OpenEphys data files, this will try to load the whole file into memory,
-     using np.fromfile. It can also start from any position in the file (defined by the start_ind)
-
-    :param file_path:
-    :param dtype: np.float32 or np.int16
-    :param start_ind: non-negative int, default 0. start index to extract data.
-    :return: header: dictionary, standard open ephys header for continuous file
+    read samples from the memory-mapped records returned by get_continuous_records, only the records covering
+    sample_range are read into memory
+
+    :param header: dictionary, header returned by get_continuous_records
+    :param records: structured array of records returned by get_continuous_records
+    :param dtype: np.float32 (volts) or np.int16 (raw values)
+    :param sample_range: None or (start, end), sample indices of the trace to load, the end is exclusive. None for the
+                         whole trace
+    :param is_return_timestamps: bool, if True, the open ephys timestamp (sample count) of each loaded sample is also
+                                 returned
+    :return: header: dictionary, same as input
              samples: 1D np.array
+             timestamps: 1D np.array of int64, only returned if is_return_timestamps is True
     """
 
-    assert dtype in (np.float32, np.int16), \
-        'Invalid data type specified for loadContinous, valid types are np.float32 and np.int16'
-
-    print "\nLoading continuous data from " + file_path
-
-    bytes_per_block = CONTINUOUS_TIMESTAMP_DTYPE.itemsize + CONTINUOUS_SAMPLE_PER_RECORD_DTYPE.itemsize + \
-                      CONTINUOUS_RECORDING_NUMBER_DTYPE.itemsize + CONTINUOUS_MARKER_BYTES + \
-                      CONTINUOUS_SAMPLE_DTYPE.itemsize * oe.SAMPLES_PER_RECORD
-
-    input_array = np.fromfile(file_path, dtype='<u1')
-    file_length = input_array.shape[0]
-    print 'total length of the file: ', file_length, 'bytes.'
-
-    valid_block_start = find_next_valid_block(input_array, bytes_per_block=bytes_per_block, start_index=start_ind)
-    print 'the beginning index of the first valid block after index: ' + str(start_ind) + ' is ' + \
-          str(valid_block_start)
-
-    print 'bytes per record block: ', bytes_per_block
-
-    # read in the data
-    f = open(file_path, 'rb')
+    total_sample_num = len(records) * oe.SAMPLES_PER_RECORD
+    if sample_range is None:
+        sample_start, sample_end = 0, total_sample_num
+    else:
+        sample_start = max(int(sample_range[0]), 0)
+        sample_end = min(int(sample_range[1]), total_sample_num)
+        sample_end = max(sample_end, sample_start)
 
-    header = oe.readHeader(f)
+    record_start = sample_start // oe.SAMPLES_PER_RECORD
+    record_end = -(-sample_end // oe.SAMPLES_PER_RECORD)
+    curr_records = records[record_start: record_end]
+    offset = sample_start - record_start * oe.SAMPLES_PER_RECORD
 
-    block_num = (file_length - valid_block_start) // bytes_per_block
-    print 'number of potential valid blocks after index', start_ind, ':', block_num
+    samples = curr_records['samples'].reshape(-1)[offset: offset + sample_end - sample_start]
 
-    samples = np.empty(oe.SAMPLES_PER_RECORD * block_num, dtype=dtype)
+    if dtype == np.float32:
+        samples = (samples * float(header['bitVolts'])).astype(np.float32)
+    elif dtype == np.int16:
+        samples = samples.astype(np.int16)
+    else:
+        raise ValueError('Invalid data type, valid types are np.float32 and np.int16.')
 
-    _ = np.fromfile(f, np.dtype('<u1'), valid_block_start - oe.NUM_HEADER_BYTES)
+    if is_return_timestamps:
+        timestamps = (curr_records['timestamp'].astype(np.int64)[:, None] +
+                      np.arange(oe.SAMPLES_PER_RECORD, dtype=np.int64)[None, :]).reshape(-1)
+        timestamps = timestamps[offset: offset + sample_end - sample_start]
+        return header, samples, timestamps
+    else:
+        return header, samples
 
-    for i in range(block_num):
-        if i == 0:
-            # to get the timestamp of the very first record (block)
-            # for alignment of the digital event
-            start_ind = np.fromfile(f, CONTINUOUS_TIMESTAMP_DTYPE, 1)
-            start_time = float(start_ind) / float(header['sampleRate'])
-        else:
-            _ = np.fromfile(f, CONTINUOUS_TIMESTAMP_DTYPE, 1)
-        N = np.fromfile(f, CONTINUOUS_SAMPLE_PER_RECORD_DTYPE, 1)[0]
 
-        if N != oe.SAMPLES_PER_RECORD:
-            print('samples per record specified in block ' + str(i) + ' (' + str(N) +
-                  ') does not equal to expected value (' + str(oe.SAMPLES_PER_RECORD) + ')!')
-            samples = samples[0 : i * oe.SAMPLES_PER_RECORD]
-            print 'samples per record specified in block ' + str(i) + ' (' + str(N) + \
-                  ') does not equal to expected value (' + str(oe.SAMPLES_PER_RECORD) + ')!'
-            break
+def load_continuous(file_path, dtype=np.float32, start_ind=0, sample_range=None, is_return_timestamps=False):
+    """
+    Jun's wrapper to load .continuous data from OpenEphys data files. The file is memory-mapped as records (see
+    get_continuous_records), only the records covering sample_range are read into memory. It can also start from any
+    position in the file (defined by the start_ind)
 
-        _ = (np.fromfile(f, CONTINUOUS_RECORDING_NUMBER_DTYPE, 1))
+    :param file_path:
+    :param dtype: np.float32 or np.int16
+    :param start_ind: non-negative int, default 0. start index to extract data.
+    :param sample_range: None or (start, end), sample indices of the trace to load, the end is exclusive. None for the
+                         whole trace
+    :param is_return_timestamps: bool, if True, the open ephys timestamp (sample count) of each loaded sample is also
+                                 returned
+    :return: header: dictionary, standard open ephys header for continuous file
+             samples: 1D np.array
+             timestamps: 1D np.array of int64, only returned if is_return_timestamps is True
+    """
 
-        if dtype == np.float32:
-            curr_samples = (np.fromfile(f, CONTINUOUS_SAMPLE_DTYPE, N) * float(header['bitVolts'])).astype(np.float32)
-        elif dtype == np.int16:
-            curr_samples = np.fromfile(f, CONTINUOUS_SAMPLE_DTYPE, N).astype(np.int16)
-        else:
-            raise ValueError('Error in reading data of block:' + str(i))
+    assert dtype in (np.float32, np.int16), \
+        'Invalid data type specified for loadContinous, valid types are np.float32 and np.int16'
 
-        samples[i*oe.SAMPLES_PER_RECORD : (i+1)*oe.SAMPLES_PER_RECORD] = curr_samples
+    print "\nLoading continuous data from " + file_path
 
-        record_mark = np.fromfile(f, dtype=np.dtype('<u1'), count=10)
-        if not np.array_equal(record_mark, oe.RECORD_MARKER):
-            print('record marker specified in block ' + str(i) + ' (' + str(record_mark) +
-                  ') does not equal to expected array (oe.RECORD_MARKER)!')
-            break
+    header, records = get_continuous_records(file_path, start_ind=start_ind)
 
-    header.update({'start_time': start_time})
-    print 'continuous channel start time (for aligning digital events): ', start_time
+    print 'continuous channel start time (for aligning digital events): ', header['start_time']
 
-    return header, samples
+    return get_samples_from_records(header, records, dtype=dtype, sample_range=sample_range,
+                                    is_return_timestamps=is_return_timestamps)
 
 
 def load_events(file_path, channels=None):
@@ -312,14 +391,12 @@ def pack_folder(folder, prefix, digital_channels=('cam_read', 'cam_trigger', 'vi
     if len(events_files) != 1:
         raise LookupError('there should be one and only one .events file in folder: ' + folder)
 
+    all_records = {}
     for file in continuous_files:
         curr_path = os.path.join(folder, file)
         print '\nLoad ' + file + ' from source folder: ', folder
 
-        if file[0:len(prefix) + 3] == prefix + '_CH':
-            curr_header, curr_trace = load_continuous(curr_path, dtype=np.int16)
-        else:
-            curr_header, curr_trace = load_continuous(curr_path, dtype=np.float32)
+        curr_header, curr_records = get_continuous_records(curr_path)
 
         # check fs for each continuous channel
         if fs is None:
@@ -337,13 +414,20 @@ def pack_folder(folder, prefix, digital_channels=('cam_read', 'cam_trigger', 'vi
                 raise ValueError('start time of current file does not match start time of other files in this '
                                  'folder!')
 
-        curr_name = file[:-11]
-        output.update({curr_name: curr_trace})
-        sample_num.append(curr_trace.shape[0])
+        all_records.update({file: (curr_header, curr_records)})
+        sample_num.append(len(curr_records) * oe.SAMPLES_PER_RECORD)
 
+    # only the common length of all channels is read into memory
     min_sample_num = min(sample_num)
-    for ch in output.iterkeys():
-        output[ch] = output[ch][0:min_sample_num]
+    for file, (curr_header, curr_records) in all_records.iteritems():
+        if file[0:len(prefix) + 3] == prefix + '_CH':
+            _, curr_trace = get_samples_from_records(curr_header, curr_records, dtype=np.int16,
+                                                     sample_range=(0, min_sample_num))
+        else:
+            _, curr_trace = get_samples_from_records(curr_header, curr_records, dtype=np.float32,
+                                                     sample_range=(0, min_sample_num))
+        output.update({file[:-11]: curr_trace})
+    del all_records
     # for ch, trace in output.iteritems():
     #     print ch, ':', trace.shape
 
@@ -382,12 +466,12 @@ def pack_folder_for_nwb(folder, prefix, digital_channels=None):
     if len(events_files) != 1:
         raise LookupError('there should be one and only one .events file in folder: ' + folder)
 
+    all_records = {}
     for file in continuous_files:
         curr_path = os.path.join(folder, file)
         print '\nLoad ' + file + ' from source folder: ', folder
 
-        curr_header, curr_trace = load_continuous(curr_path, dtype=np.int16)
-        # curr_header, curr_trace = load_continuous_hack(curr_path, dtype=np.int16)
+        curr_header, curr_records = get_continuous_records(curr_path)
 
         # check fs for each continuous channel
         if fs is None:
@@ -405,13 +489,16 @@ def pack_folder_for_nwb(folder, prefix, digital_channels=None):
                 raise ValueError('start time of current file does not match start time of other files in this '
                                  'folder!')
 
-        curr_name = file[:-11]
-        output.update({curr_name: {'header': curr_header, 'trace': curr_trace}})
-        sample_num.append(curr_trace.shape[0])
+        all_records.update({file: (curr_header, curr_records)})
+        sample_num.append(len(curr_records) * oe.SAMPLES_PER_RECORD)
 
+    # only the common length of all channels is read into memory
     min_sample_num = min(sample_num)
-    for ch in output.iterkeys():
-        output[ch]['trace'] = output[ch]['trace'][0:min_sample_num]
+    for file, (curr_header, curr_records) in all_records.iteritems():
+        _, curr_trace = get_samples_from_records(curr_header, curr_records, dtype=np.int16,
+                                                 sample_range=(0, min_sample_num))
+        output.update({file[:-11]: {'header': curr_header, 'trace': curr_trace}})
+    del all_records
 
     events = load_events(os.path.join(folder, events_files[0]), channels=digital_channels)
     try:
@@ -452,79 +539,77 @@ def pack_folders(folder_list, output_folder, output_filename, continous_channels
     if os.path.isfile(output_path_dat) or os.path.isfile(output_path_h5):
         raise IOError('Output path already exists!')
 
-    h5_file = h5py.File(output_path_h5)
-    h5_file.attrs['device'] = 'tetrode'
-    _ = h5_file.create_dataset('channels', data=continous_channels)
-
-    curr_folder_start_ind = 0
-    data_all = []
-    sampling_rate = None
-
-    for i, folder in enumerate(folder_list):
-
-        curr_group = h5_file.create_group('folder' + ft.int2str(i, 4))
-        curr_group.attrs['path'] = folder
-        curr_con_group = curr_group.create_group('continuous')
-        curr_dig_group = curr_group.create_group('digital')
-        curr_ts_group = curr_group.create_group('timestamps')
-
-        curr_trace_dict, curr_sample_num, fs = pack_folder(folder, prefix, digital_channels=digital_channels)
-        all_channels = curr_trace_dict.keys()
-        print '\nall channels in folder ', folder, ':'
-        print all_channels
-        print
-
-        if sampling_rate is None:
-            sampling_rate = fs
-        else:
-            if fs != sampling_rate:
-                err = 'The sampling rate (' + str(fs) + 'Hz) of folder: (' + folder + ') does not match the sampling' +\
-                    ' rate (' + str(sampling_rate) + ') of other folders.'
-                raise ValueError(err)
-
-        curr_data_array = []
-
-        # add electrode channels
-        for channel in continous_channels:
-            curr_prefix = prefix + '_CH' + str(channel)
-
-            curr_key = [k for k in all_channels if k[:len(curr_prefix)] == curr_prefix]
-            if len(curr_key) == 0:
-                raise LookupError('no file is found in ' + folder +' for channel ' + str(channel) + '!')
-            elif len(curr_key) > 1:
-                raise LookupError('more than one files are found in ' + folder +' for channel ' + str(channel) + '!')
-            curr_key = curr_key[0]
-            curr_dset = curr_con_group.create_dataset('channel_' + ft.int2str(int(channel), 4),
-                                                      data=curr_trace_dict[curr_key])
-            curr_dset.attrs['unit'] = 'arbitrary_unit'
-            curr_data_array.append(curr_trace_dict[curr_key])
-        curr_data_array = np.array(curr_data_array, dtype=np.int16)
-        data_all.append(curr_data_array.flatten(order='F'))
-
-        # add continuous channels
-        for ch, trace in curr_trace_dict.iteritems():
-            if '_CH' not in ch and ch != 'events':
-                curr_dset = curr_con_group.create_dataset(ch[len(prefix) + 1:], data=trace)
-                curr_dset.attrs['unit'] = 'volt'
-
-        # add digital events
-        events = curr_trace_dict['events']
-        for dch, dch_dict in events.iteritems():
-            curr_dch_group = curr_dig_group.create_group(dch)
-            curr_dch_group.create_dataset('rise', data=dch_dict['rise'])
-            curr_dch_group.create_dataset('fall', data=dch_dict['fall'])
-
-        curr_group.attrs['start_index'] = curr_folder_start_ind
-        curr_group.attrs['end_index'] = curr_folder_start_ind + curr_sample_num
-        curr_folder_start_ind += curr_sample_num
-
-    h5_file.create_dataset('fs_hz', data=float(sampling_rate))
-
-    h5_file.close()
-
-    data_all = np.concatenate(data_all)
-
-    data_all.tofile(output_path_dat)
+    # electrode data of each folder is appended to the .dat file once it is packed, both files are closed even if
+    # packing fails
+    with h5py.File(output_path_h5) as h5_file, open(output_path_dat, 'wb') as dat_file:
+
+        h5_file.attrs['device'] = 'tetrode'
+        _ = h5_file.create_dataset('channels', data=continous_channels)
+
+        curr_folder_start_ind = 0
+        sampling_rate = None
+
+        for i, folder in enumerate(folder_list):
+
+            curr_group = h5_file.create_group('folder' + ft.int2str(i, 4))
+            curr_group.attrs['path'] = folder
+            curr_con_group = curr_group.create_group('continuous')
+            curr_dig_group = curr_group.create_group('digital')
+            curr_ts_group = curr_group.create_group('timestamps')
+
+            curr_trace_dict, curr_sample_num, fs = pack_folder(folder, prefix, digital_channels=digital_channels)
+            all_channels = curr_trace_dict.keys()
+            print '\nall channels in folder ', folder, ':'
+            print all_channels
+            print
+
+            if sampling_rate is None:
+                sampling_rate = fs
+            else:
+                if fs != sampling_rate:
+                    err = 'The sampling rate (' + str(fs) + 'Hz) of folder: (' + folder + ') does not match the ' +\
+                        'sampling rate (' + str(sampling_rate) + ') of other folders.'
+                    raise ValueError(err)
+
+            # interleaved electrode data, sample x channel
+            curr_data_array = np.empty((curr_sample_num, len(continous_channels)), dtype=np.int16)
+
+            # add electrode channels
+            for channel_i, channel in enumerate(continous_channels):
+                curr_prefix = prefix + '_CH' + str(channel)
+
+                curr_key = [k for k in all_channels if k[:len(curr_prefix)] == curr_prefix]
+                if len(curr_key) == 0:
+                    raise LookupError('no file is found in ' + folder +' for channel ' + str(channel) + '!')
+                elif len(curr_key) > 1:
+                    raise LookupError('more than one files are found in ' + folder + ' for channel ' + str(channel) +
+                                      '!')
+                curr_key = curr_key[0]
+                curr_dset = curr_con_group.create_dataset('channel_' + ft.int2str(int(channel), 4),
+                                                          data=curr_trace_dict[curr_key])
+                curr_dset.attrs['unit'] = 'arbitrary_unit'
+                curr_data_array[:, channel_i] = curr_trace_dict[curr_key]
+            curr_data_array.tofile(dat_file)
+            del curr_data_array
+
+            # add continuous channels
+            for ch, trace in curr_trace_dict.iteritems():
+                if '_CH' not in ch and ch != 'events':
+                    curr_dset = curr_con_group.create_dataset(ch[len(prefix) + 1:], data=trace)
+                    curr_dset.attrs['unit'] = 'volt'
+
+            # add digital events
+            events = curr_trace_dict['events']
+            for dch, dch_dict in events.iteritems():
+                curr_dch_group = curr_dig_group.create_group(dch)
+                curr_dch_group.create_dataset('rise', data=dch_dict['rise'])
+                curr_dch_group.create_dataset('fall', data=dch_dict['fall'])
+
+            curr_group.attrs['start_index'] = curr_folder_start_ind
+            curr_group.attrs['end_index'] = curr_folder_start_ind + curr_sample_num
+            curr_folder_start_ind += curr_sample_num
+
+        h5_file.create_dataset('fs_hz', data=float(sampling_rate))
 
 
 if __name__ == '__main__':
@@ -13,6 +13,7 @@ from shutil import copyfile
 date_range = [180301, 190610]
 database_folder = 'nwbs'
 save_folder_n = "dataframes"
+store_fn = "roi_results.hdf5"
 process_num = 8
 is_overwrite = False
 
@@ -316,8 +317,9 @@ columns = [
 
 def process_one_nwb_for_multi_thread(inputs):
 
-    nwb_path, params, columns, save_folder, t0, nwb_i, nwb_f_num, is_overwrite = inputs
+    nwb_path, params, columns, existing_planes, t0, nwb_i, nwb_f_num, is_overwrite = inputs
     nwb_fn = os.path.splitext(os.path.split(nwb_path)[1])[0]
+    date, mid = nwb_fn.split('_')[0:2]
 
     nwb_f = h5py.File(nwb_path, 'r')
 
@@ -326,6 +328,8 @@ def process_one_nwb_for_multi_thread(inputs):
     plane_ns.sort()
     # print('total plane number: {}'.format(len(plane_ns)))
 
+    plane_dfs = []
+
     for plane_n in plane_ns:
         print('\tt: {:5.0f} minutes, processing {}, {} / {}, {} ...'.format((time.time() - t0) / 60.,
                                                                             nwb_fn,
@@ -333,34 +337,27 @@ def process_one_nwb_for_multi_thread(inputs):
                                                                             nwb_f_num,
                                                                             plane_n))
 
-        save_fn = '_'.join(nwb_fn.split('_')[0:2]) + '_' + plane_n + '.xlsx'
-        save_path = os.path.join(save_folder, save_fn)
-        if os.path.isfile(save_path):
-
-            if is_overwrite: # overwrite existing xlsx files
-                print('\t{}, file already exists. Overwirite.'.format(os.path.split(save_path)[1]))
-                os.remove(save_path)
+        if (date, mid, plane_n) in existing_planes:
 
+            if is_overwrite: # overwrite existing planes in the result store
+                print('\t{}_{}_{}, plane already exists. Overwirite.'.format(date, mid, plane_n))
 
-            else: # do not overwrite existing xlsx files
-                print('\t{}, file already exists. Skip.'.format(os.path.split(save_path)[1]))
-                return
+            else: # do not overwrite existing planes in the result store
+                print('\t{}_{}_{}, plane already exists. Skip.'.format(date, mid, plane_n))
+                continue
 
         roi_ns = nwb_f['processing/rois_and_traces_{}/ImageSegmentation/imaging_plane/roi_list'.format(plane_n)].value
         roi_ns = [r.encode('utf-8') for r in roi_ns if r[0:4] == 'roi_']
         roi_ns.sort()
 
-        df = pd.DataFrame(np.nan, index=range(len(roi_ns)), columns=columns)
+        roi_results = dt.iter_everything_from_plane(nwb_f=nwb_f, plane_n=plane_n, roi_ns=roi_ns, params=params)
+        df = pd.DataFrame([roi_result[0] for _, roi_result in roi_results], columns=columns)
 
-        for roi_i, roi_n in enumerate(roi_ns):
-            # print('\t\t\troi: {} / {}'.format(roi_i+1, len(roi_ns)))
-            roi_properties, _, _, _, _, _, _, _, _, _, _, _, _, _ = \
-                dt.get_everything_from_roi(nwb_f=nwb_f, plane_n=plane_n, roi_n=roi_n, params=params)
-            for rp_name, rp_value in roi_properties.items():
-                df.loc[roi_i, rp_name] = rp_value
+        plane_dfs.append((date, mid, plane_n, df))
 
-        with pd.ExcelWriter(save_path, mode='w') as writer:
-                df.to_excel(writer, sheet_name='sheet1')
+    nwb_f.close()
+
+    return plane_dfs
 
 
 def run():
@@ -383,10 +380,16 @@ def run():
 
     copyfile(os.path.realpath(__file__), os.path.join(save_folder, 'script_log.py'))
 
+    store_path = os.path.join(save_folder, store_fn)
+    if os.path.isfile(store_path):
+        existing_planes = set(dt.get_result_planes(store_path))
+    else:
+        existing_planes = set()
+
     inputs_lst = [(os.path.join(curr_folder, database_folder, nwb_fn),
                    params,
                    columns,
-                   save_folder,
+                   existing_planes,
                    t0,
                    nwb_i,
                    len(nwb_fns),
@@ -394,7 +397,11 @@ def run():
 
     print('\nprocessing individual nwb files ...')
     p = Pool(process_num)
-    p.map(process_one_nwb_for_multi_thread, inputs_lst)
+    # workers only compute, all planes are written into the result store from the main process
+    for plane_dfs in p.imap_unordered(process_one_nwb_for_multi_thread, inputs_lst):
+        for date, mid, plane_n, df in plane_dfs:
+            dt.write_plane_results(store_path=store_path, df=df, date=date, mouse_id=mid, plane_n=plane_n,
+                                   is_overwrite=is_overwrite)
     # process_one_nwb_for_multi_thread(inputs_lst[0])
 
     # print('\nConcatenating indiviudal dataframes ...')
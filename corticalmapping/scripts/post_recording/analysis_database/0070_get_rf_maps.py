@@ -4,7 +4,6 @@ import os
 import numpy as np
 import h5py
 import datetime
-import pandas as pd
 import corticalmapping.DatabaseTools as dt
 import corticalmapping.core.ImageAnalysis as ia
 import corticalmapping.SingleCellAnalysis as sca
@@ -13,6 +12,7 @@ from shutil import copyfile
 table_folder = 'dataframes_190529210731'
 nwb_folder = 'nwbs'
 save_folder = "intermediate_results"
+store_fn = 'roi_results.hdf5'
 
 response_dir = 'pos'
 skew_thr = 0.6
@@ -37,20 +37,21 @@ copyfile(os.path.realpath(__file__),
          os.path.join(save_folder,
                       'script_log_{}.py'.format(datetime.datetime.now().strftime('%y%m%d%H%M%S'))))
 
-table_fns = [f for f in os.listdir(table_folder) if f[-5:] == '.xlsx']
-table_fns.sort()
-print('number of planes: {}'.format(len(table_fns)))
+store_path = os.path.join(table_folder, store_fn)
+planes = dt.get_result_planes(store_path)
+print('number of planes: {}'.format(len(planes)))
 
-for table_i, table_fn in enumerate(table_fns):
-    print('\nanalyzing {}, {} / {} ... '.format(table_fn, table_i+1, len(table_fns)))
+for plane_i, (date, mid, plane_n) in enumerate(planes):
+    plane_name = '{}_{}_{}'.format(date, mid, plane_n)
+    print('\nanalyzing {}, {} / {} ... '.format(plane_name, plane_i+1, len(planes)))
 
-    save_fn = table_fn[0:-5] + '_{}.hdf5'.format(response_dir)
+    save_fn = plane_name + '_{}.hdf5'.format(response_dir)
 
     if os.path.isfile(os.path.join(save_folder, save_fn)):
         print('\tAlready analyzed. Skip.')
         continue
 
-    df = pd.read_excel(os.path.join(table_folder, table_fn), sheetname='sheet1')
+    df = dt.read_results(store_path, dates=[date], mouse_ids=[mid], plane_ns=[plane_n])
     subdf = df[np.logical_not(df['rf_pos_on_peak_z'].isnull())]
     subdf = subdf[subdf['skew_fil'] >= skew_thr]
 
@@ -61,18 +62,17 @@ for table_i, table_fn in enumerate(table_fns):
 
         save_f = h5py.File(os.path.join(save_folder, save_fn))
 
-        nwb_fn = table_fn[0:-11] + '110_repacked.nwb'
+        nwb_fn = '{}_{}_110_repacked.nwb'.format(date, mid)
         nwb_f = h5py.File(os.path.join(nwb_folder, nwb_fn), 'r')
-        plane_n = table_fn[-11:-5]
 
         # S2
         s2_df = subdf[(subdf['rf_{}_on_peak_z'.format(response_dir)] >= analysis_params['rf_z_thr_abs']) &
                       (subdf['rf_{}_off_peak_z'.format(response_dir)] >= analysis_params['rf_z_thr_abs'])].reset_index()
 
         if len(s2_df) > 0:
-            s2_grp = save_f.create_group(table_fn[0:-5] + '_{}_ONOFF'.format(response_dir))
-            s1_on_grp = save_f.create_group(table_fn[0:-5] + '_{}_ON'.format(response_dir))
-            s1_off_grp = save_f.create_group(table_fn[0:-5] + '_{}_OFF'.format(response_dir))
+            s2_grp = save_f.create_group(plane_name + '_{}_ONOFF'.format(response_dir))
+            s1_on_grp = save_f.create_group(plane_name + '_{}_ON'.format(response_dir))
+            s1_off_grp = save_f.create_group(plane_name + '_{}_OFF'.format(response_dir))
 
             for roi_i, roi_row in s2_df.iterrows():
 
@@ -146,7 +146,7 @@ for table_i, table_fn in enumerate(table_fns):
 
         if len(s1_on_df) > 0:
 
-            s1_on_grp_n = table_fn[0:-5] + '_{}_ON'.format(response_dir)
+            s1_on_grp_n = plane_name + '_{}_ON'.format(response_dir)
 
             if s1_on_grp_n in save_f.keys():
                 s1_on_grp = save_f[s1_on_grp_n]
@@ -197,7 +197,7 @@ for table_i, table_fn in enumerate(table_fns):
 
         if len(s1_off_df) > 0:
 
-            s1_off_grp_n = table_fn[0:-5] + '_{}_OFF'.format(response_dir)
+            s1_off_grp_n = plane_name + '_{}_OFF'.format(response_dir)
 
             if s1_off_grp_n in save_f.keys():
                 s1_off_grp = save_f[s1_off_grp_n]
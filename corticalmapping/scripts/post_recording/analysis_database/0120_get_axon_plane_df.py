@@ -13,6 +13,7 @@ df_folder = r'other_dataframes\dataframes_190530171338'
 clu_folder = r'intermediate_results\bouton_clustering\AllStimuli_DistanceThr_1.30'
 process_num = 6
 is_overwrite = True
+store_fn = 'roi_results.hdf5'
 
 curr_folder = os.path.dirname(os.path.realpath(__file__))
 os.chdir(curr_folder)
@@ -308,7 +309,7 @@ columns = [
 
 def process_one_nwb_for_multi_thread(inputs):
 
-    nwb_path, df_folder, clu_folder, params, columns, save_folder, t0, nwb_i, nwb_f_num, is_overwrite = inputs
+    nwb_path, roi_store_path, clu_folder, params, columns, existing_planes, t0, nwb_i, nwb_f_num, is_overwrite = inputs
 
     nwb_fn = os.path.splitext(os.path.split(nwb_path)[1])[0]
 
@@ -318,6 +319,8 @@ def process_one_nwb_for_multi_thread(inputs):
     plane_ns = dt.get_plane_ns(nwb_f=nwb_f)
     plane_ns.sort()
 
+    plane_dfs = []
+
     for plane_n in plane_ns:
         print('\tt: {:5.0f} minutes, processing {}, {} / {}, {} ...'.format((time.time() - t0) / 60.,
                                                                              nwb_fn,
@@ -325,8 +328,10 @@ def process_one_nwb_for_multi_thread(inputs):
                                                                              nwb_f_num,
                                                                              plane_n))
 
-        roi_df_fn = '{}_{}_{}.csv'.format(date, mid, plane_n)
-        roi_df = pd.read_csv(os.path.join(df_folder, roi_df_fn))
+        if (date, mid, plane_n) in existing_planes and not is_overwrite:
+            raise IOError('Axon dataframe of {}_{}_{} already exists.'.format(date, mid, plane_n))
+
+        roi_df = dt.read_results(store_path=roi_store_path, dates=[date], mouse_ids=[mid], plane_ns=[plane_n])
 
         clu_fn = '{}_{}_{}_axon_grouping.hdf5'.format(date, mid, plane_n)
         clu_f = h5py.File(os.path.join(clu_folder, clu_fn), 'r')
@@ -334,17 +339,17 @@ def process_one_nwb_for_multi_thread(inputs):
         axon_ns = clu_f['axons'].keys()
         axon_ns.sort()
 
-        axon_df = pd.DataFrame(np.nan, index=range(len(axon_ns)), columns=columns)
+        roi_df = roi_df.set_index('roi_n', drop=False)
+
+        axon_rows = []
 
         for axon_i, axon_n in enumerate(axon_ns):
 
             roi_lst = clu_f['axons/{}'.format(axon_n)].value
 
             if len(roi_lst) == 1:
-                curr_roi_df = roi_df[roi_df['roi_n'] == roi_lst[0]].reset_index()
-                for col in columns:
-                    axon_df.loc[axon_i, col] = curr_roi_df.loc[0, col]
-                axon_df.loc[axon_i, 'roi_n'] = axon_n
+                axon_properties = roi_df.loc[roi_lst[0], [c for c in columns if c in roi_df.columns]].to_dict()
+                axon_properties['roi_n'] = axon_n
             else:
                 axon_properties, _, _, _, _, _, _, _, _, _, _, _, _, _ = \
                                 dt.get_everything_from_axon(nwb_f=nwb_f,
@@ -353,19 +358,19 @@ def process_one_nwb_for_multi_thread(inputs):
                                                             axon_n=axon_n,
                                                             params=params,
                                                             verbose=False)
-                for rp_name, rp_value in axon_properties.items():
-                        axon_df.loc[axon_i, rp_name] = rp_value
 
-        save_path = os.path.join(save_folder, '{}_{}_{}.csv'.format(date, mid, plane_n))
+            axon_rows.append(axon_properties)
+
+        axon_df = pd.DataFrame(axon_rows, columns=columns)
+
+        clu_f.close()
+
+        plane_dfs.append((date, mid, plane_n, axon_df))
+
+    nwb_f.close()
+
+    return plane_dfs
 
-        if os.path.isfile(save_path):
-            if is_overwrite:
-                os.remove(save_path)
-                axon_df.to_csv(save_path)
-            else:
-                raise IOError('Axon dataframe file already exists. \npath: {}'.format(save_path))
-        else:
-            axon_df.to_csv(save_path)
 
 def run():
 
@@ -393,12 +398,18 @@ def run():
 
     shutil.copyfile(os.path.realpath(__file__), os.path.join(save_folder, 'script_log.py'))
 
+    store_path = os.path.join(save_folder, store_fn)
+    if os.path.isfile(store_path):
+        existing_planes = set(dt.get_result_planes(store_path))
+    else:
+        existing_planes = set()
+
     inputs_lst = [(os.path.join(curr_folder, nwb_folder, nwb_fn),
-                   os.path.realpath(df_folder),
+                   os.path.join(os.path.realpath(df_folder), store_fn),
                    os.path.realpath(clu_folder),
                    params,
                    columns,
-                   save_folder,
+                   existing_planes,
                    t0,
                    nwb_i,
                    len(nwb_fns),
@@ -406,7 +417,11 @@ def run():
 
     print('\nprocessing individual nwb files ...')
     p = Pool(process_num)
-    p.map(process_one_nwb_for_multi_thread, inputs_lst)
+    # workers only compute, all planes are written into the result store from the main process
+    for plane_dfs in p.imap_unordered(process_one_nwb_for_multi_thread, inputs_lst):
+        for date, mid, plane_n, axon_df in plane_dfs:
+            dt.write_plane_results(store_path=store_path, df=axon_df, date=date, mouse_id=mid, plane_n=plane_n,
+                                   is_overwrite=is_overwrite)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import os
 import pandas as pd
+import corticalmapping.DatabaseTools as dt
 
 df_folder = 'other_dataframes'
 # df_fn = 'dataframes_190530171338'
@@ -7,27 +8,16 @@ df_folder = 'other_dataframes'
 # df_fn = 'dataframes_190530171338_axon_AllStimuli_DistanceThr_1.00'
 df_fn = 'dataframes_190530171338_axon_AllStimuli_DistanceThr_1.30'
 plane_df_fn = 'plane_table_190530170648.xlsx'
+store_fn = 'roi_results.hdf5'
 
 curr_folder = os.path.dirname(os.path.realpath(__file__))
 os.chdir(curr_folder)
 
-csv_fns = [fn for fn in os.listdir(os.path.join(df_folder, df_fn)) if fn[-4:] == '.csv']
-csv_fns.sort()
-
 plane_df = pd.read_excel(os.path.join(df_folder, plane_df_fn), sheetname='sheet1')
+plane_df['date'] = plane_df['date'].astype(str) # dates are strings in the result store
 
-df_all = []
-
-for csv_fn in csv_fns:
-    print('reading {} ...'.format(csv_fn))
-    df_all.append(pd.read_csv(os.path.join(df_folder, df_fn, csv_fn)))
-
-df_all = pd.concat(df_all, axis=0)
-
-try:
-    df_all.drop(['Unnamed: 0', 'Unnamed: 0.1'], axis=1, inplace=True)
-except KeyError:
-    pass
+print('reading {} ...'.format(store_fn))
+df_all = dt.read_results(os.path.join(df_folder, df_fn, store_fn))
 
 print(df_all.columns)
 
@@ -38,7 +38,8 @@ def get_chunk_frames(frame_num, chunk_size):
 def get_traces(params):
     t0 = time.time()
 
-    chunk_ind, chunk_start, chunk_end, nwb_path, data_path, curr_folder, center_array, surround_array = params
+    chunk_ind, chunk_start, chunk_end, nwb_path, data_path, curr_folder, center_matrix, surround_matrix, \
+    surround_scales = params
 
     nwb_f = h5py.File(nwb_path, 'r')
     print('\nstart analyzing chunk: {}'.format(chunk_ind))
@@ -46,16 +47,11 @@ def get_traces(params):
     nwb_f.close()
 
     # print 'extracting traces'
-    curr_traces_center = np.empty((center_array.shape[0], curr_mov.shape[0]), dtype=np.float32)
-    curr_traces_surround = np.empty((center_array.shape[0], curr_mov.shape[0]), dtype=np.float32)
-    for i in range(center_array.shape[0]):
-        curr_center = ia.WeightedROI(center_array[i])
-        curr_surround = ia.ROI(surround_array[i])
-        curr_traces_center[i, :] = curr_center.get_weighted_trace_pixelwise(curr_mov)
+    curr_traces_center = ia.get_traces_from_mask_matrix(curr_mov, center_matrix).astype(np.float32)
 
-        # scale surround trace to be similar as center trace
-        mean_center_weight = curr_center.get_mean_weight()
-        curr_traces_surround[i, :] = curr_surround.get_binary_trace_pixelwise(curr_mov) * mean_center_weight
+    # scale surround trace to be similar as center trace
+    curr_traces_surround = ia.get_traces_from_mask_matrix(curr_mov, surround_matrix) * surround_scales[:, None]
+    curr_traces_surround = curr_traces_surround.astype(np.float32)
 
     # print 'saveing chunk {} ...'.format(chunk_ind)
     chunk_folder = os.path.join(curr_folder, 'chunks')
@@ -95,9 +91,16 @@ def run():
     total_frame = nwb_f[data_path].shape[0]
     nwb_f.close()
 
+    print('\ncompiling masks ...')
+    center_rois = dict([(i, ia.WeightedROI(center_array[i])) for i in range(center_array.shape[0])])
+    surround_rois = dict([(i, ia.ROI(surround_array[i])) for i in range(surround_array.shape[0])])
+    center_matrix, _, _ = ia.get_mask_matrix(center_rois)
+    surround_matrix, _, _ = ia.get_mask_matrix(surround_rois)
+    surround_scales = np.array([center_rois[i].get_mean_weight() for i in range(center_array.shape[0])])
+
     chunk_frames = get_chunk_frames(total_frame, CHUNK_SIZE)
-    chunk_params = [(cf[0], cf[1], cf[2], nwb_path, data_path,
-                     curr_folder, center_array, surround_array) for cf in chunk_frames]
+    chunk_params = [(cf[0], cf[1], cf[2], nwb_path, data_path, curr_folder,
+                     center_matrix, surround_matrix, surround_scales) for cf in chunk_frames]
 
     p = Pool(PROCESS_NUM)
     p.map(get_traces, chunk_params)
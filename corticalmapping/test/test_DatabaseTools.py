@@ -0,0 +1,204 @@
+import os
+import unittest
+import h5py
+import numpy as np
+import pandas as pd
+import corticalmapping.DatabaseTools as dt
+import corticalmapping.SingleCellAnalysis as sca
+
+curr_folder = os.path.dirname(os.path.realpath(__file__))
+test_data_folder = os.path.join(curr_folder, 'data')
+
+
+def _write_small_nwb(nwb_path, roi_num=6, trace_type='f_center_subtracted'):
+    """
+    write a small nwb-like file with one plane, roi masks, traces, a sparse noise strf and a drifting grating
+    response table, enough for get_everything_from_roi() and iter_everything_from_plane()
+    """
+
+    sta_ts = np.arange(-0.5, 1.5, 0.1)
+
+    with h5py.File(nwb_path, 'w') as nwb_f:
+        nwb_f['identifier'] = '180101_M000001_110'
+        nwb_f['acquisition/timeseries/2p_movie_plane0/pixel_size'] = np.array([0.000001, 0.000001])
+        nwb_f['acquisition/timeseries/2p_movie_plane0/pixel_size_unit'] = 'meter'
+
+        plane_grp = nwb_f.create_group('processing/rois_and_traces_plane0')
+        plane_grp['imaging_depth_micron'] = 150.
+        seg_grp = plane_grp.create_group('ImageSegmentation/imaging_plane')
+        roi_ns = ['roi_{:04d}'.format(i) for i in range(roi_num)]
+        seg_grp['roi_list'] = roi_ns + ['neuropil']
+        for roi_i, roi_n in enumerate(roi_ns):
+            mask = np.zeros((16, 16), dtype=np.float32)
+            mask[roi_i:roi_i + 4, 2 * roi_i:2 * roi_i + 3] = 1.
+            seg_grp['{}/img_mask'.format(roi_n)] = mask
+        plane_grp['Fluorescence/{}/data'.format(trace_type)] = np.random.rand(roi_num, 2000) + 1.
+        plane_grp['Fluorescence/{}/timestamps'.format(trace_type)] = np.arange(2000) * 0.1
+
+        strf_grp = nwb_f.create_group('analysis/strf_001_SparseNoise/plane0')
+        strf_grp.attrs['sta_timestamps'] = sta_ts
+        for alt in [0., 10., 20., 30.]:
+            for azi in [0., 10., 20., 30.]:
+                for sign in [-1, 1]:
+                    probe_grp = strf_grp.create_group('alt{:06.1f}_azi{:06.1f}_sign{:02d}'.format(alt, azi, sign))
+                    probe_grp['sta_' + trace_type] = np.random.rand(roi_num, 5, len(sta_ts)) + 1.
+                    probe_grp['global_trigger_timestamps'] = np.arange(5) * 10. + 1.
+
+        dgc_grp = nwb_f.create_group('analysis/response_table_002_DriftingGratingCircle/plane0')
+        dgc_grp.attrs['sta_timestamps'] = sta_ts
+        for sf in [0.04, 0.08]:
+            for dire in [0, 90, 180, 270]:
+                condi_n = sca.get_dgc_condition_name(alt=0., azi=10., sf=sf, tf=2., dire=dire, con=1., rad=30)
+                condi_grp = dgc_grp.create_group(condi_n)
+                condi_grp.attrs['global_trigger_timestamps'] = np.arange(4) * 20. + 3.
+                condi_grp['sta_' + trace_type] = np.random.rand(roi_num, 4, len(sta_ts)) + 1.
+        nwb_f['stimulus/presentation/002_DriftingGratingCircle/block_dur'] = 2.
+
+
+class TestDatabaseTools(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = os.path.join(test_data_folder, 'test_result_store.hdf5')
+        self.nwb_path = os.path.join(test_data_folder, 'test_small.nwb')
+        for path in [self.store_path, self.nwb_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def tearDown(self):
+        for path in [self.store_path, self.nwb_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _get_plane_df(self, date, mouse_id, plane_n, roi_num, offset=0):
+        return pd.DataFrame({'date': [date] * roi_num,
+                             'mouse_id': [mouse_id] * roi_num,
+                             'plane_n': [plane_n] * roi_num,
+                             'roi_n': ['roi_{:04d}'.format(i) for i in range(roi_num)],
+                             'roi_area': np.arange(roi_num, dtype=np.int64) + offset,
+                             'dgc_osi': np.linspace(0., 1., roi_num).astype(np.float32)})
+
+    def test_result_store_round_trip(self):
+        columns = ['date', 'mouse_id', 'plane_n', 'roi_n', 'roi_area', 'dgc_osi', 'rf_pos_peak_z']
+        schema = dt.get_result_schema(self._get_plane_df('180101', 'M001', 'plane0', 1), columns=columns)
+        assert (schema == [('date', 'S'), ('mouse_id', 'S'), ('plane_n', 'S'), ('roi_n', 'S'),
+                           ('roi_area', np.dtype(np.int64).str), ('dgc_osi', np.dtype(np.float32).str),
+                           ('rf_pos_peak_z', 'f8')])
+
+        dt.write_plane_results(self.store_path, self._get_plane_df('180101', 'M001', 'plane0', 3),
+                               date='180101', mouse_id='M001', plane_n='plane0', schema=schema)
+        dt.write_plane_results(self.store_path, self._get_plane_df('180101', 'M001', 'plane1', 2),
+                               date='180101', mouse_id='M001', plane_n='plane1', schema=schema)
+        dt.write_plane_results(self.store_path, self._get_plane_df('180202', 'M002', 'plane0', 4),
+                               date='180202', mouse_id='M002', plane_n='plane0', schema=schema)
+
+        assert (dt.get_result_planes(self.store_path) == [('180101', 'M001', 'plane0'),
+                                                          ('180101', 'M001', 'plane1'),
+                                                          ('180202', 'M002', 'plane0')])
+
+        df = dt.read_results(self.store_path)
+        assert (list(df.columns) == columns)
+        assert (len(df) == 9)
+        assert (list(df.index) == list(range(9)))
+        for col in ['date', 'mouse_id', 'plane_n', 'roi_n']:
+            assert (all([isinstance(v, str) for v in df[col]]))
+        assert (df['roi_area'].dtype == np.int64)
+        assert (df['dgc_osi'].dtype == np.float32)
+        assert (df['rf_pos_peak_z'].dtype == np.float64)
+        assert (np.all(np.isnan(df['rf_pos_peak_z'])))  # not in the written dataframes
+        assert (list(df['roi_n'][0:3]) == ['roi_0000', 'roi_0001', 'roi_0002'])
+
+        # filters and column selection
+        df = dt.read_results(self.store_path, dates=['180101'], plane_ns=['plane1'], columns=['roi_n', 'roi_area'])
+        assert (list(df.columns) == ['roi_n', 'roi_area'])
+        assert (list(df['roi_n']) == ['roi_0000', 'roi_0001'])
+        assert (np.array_equal(df['roi_area'], [0, 1]))
+
+        df = dt.read_results(self.store_path, mouse_ids=['M002'])
+        assert (len(df) == 4)
+        assert (set(df['date']) == {'180202'})
+
+        # nothing matches
+        df = dt.read_results(self.store_path, mouse_ids=['M003'], columns=['roi_n'])
+        assert (len(df) == 0)
+        assert (list(df.columns) == ['roi_n'])
+
+        # overwriting
+        new_df = self._get_plane_df('180101', 'M001', 'plane1', 5, offset=10)
+        self.assertRaises(IOError, dt.write_plane_results, self.store_path, new_df, '180101', 'M001', 'plane1',
+                          schema)
+        df = dt.read_results(self.store_path, plane_ns=['plane1'])
+        assert (len(df) == 2)
+
+        dt.write_plane_results(self.store_path, new_df, date='180101', mouse_id='M001', plane_n='plane1',
+                               schema=schema, is_overwrite=True)
+        df = dt.read_results(self.store_path, plane_ns=['plane1'])
+        assert (len(df) == 5)
+        assert (np.array_equal(df['roi_area'], np.arange(5) + 10))
+
+        # int columns can not be filled with NaN
+        self.assertRaises(ValueError, dt.write_plane_results, self.store_path, new_df, '180101', 'M001', 'plane2',
+                          schema + [('roi_num', 'i8')])
+
+    def test_result_store_mixed_dtypes(self):
+        df = pd.DataFrame({'date': ['180101'] * 3,
+                           'mouse_id': ['M001'] * 3,
+                           'plane_n': ['plane0'] * 3,
+                           'roi_n': ['roi_0000', 'roi_0002', 'roi_0005'],
+                           'roi_ind': np.array([0, 2, 5], dtype=np.int64),
+                           'frame_num': np.array([10, 20, 30], dtype=np.uint16),
+                           'has_lsn': np.array([True, False, True]),
+                           'skew_fil': np.array([0.5, np.nan, 1.5], dtype=np.float64),
+                           'dgc_osi': np.array([0.1, 0.2, 0.3], dtype=np.float32),
+                           'cell_type': ['exc', 'inh', 'exc'],
+                           'has_dgc': [True, np.nan, False]},
+                          columns=['date', 'mouse_id', 'plane_n', 'roi_n', 'roi_ind', 'frame_num', 'has_lsn',
+                                   'skew_fil', 'dgc_osi', 'cell_type', 'has_dgc'])
+
+        dt.write_plane_results(self.store_path, df, date='180101', mouse_id='M001', plane_n='plane0')
+        df_read = dt.read_results(self.store_path)
+
+        assert (list(df_read.columns) == list(df.columns))
+        for col in ['roi_ind', 'frame_num', 'has_lsn', 'skew_fil', 'dgc_osi']:
+            assert (df_read[col].dtype == df[col].dtype)
+        for col in ['roi_ind', 'frame_num', 'has_lsn', 'dgc_osi']:
+            assert (np.array_equal(df_read[col], df[col]))
+        assert (np.array_equal(df_read['skew_fil'][[0, 2]], [0.5, 1.5]))
+        assert (np.isnan(df_read['skew_fil'][1]))
+        for col in ['date', 'mouse_id', 'plane_n', 'roi_n', 'cell_type']:
+            assert (list(df_read[col]) == list(df[col]))
+
+        # object column of bools with missing values is saved as float
+        assert (df_read['has_dgc'].dtype == np.float64)
+        assert (df_read['has_dgc'][0] == 1.)
+        assert (np.isnan(df_read['has_dgc'][1]))
+        assert (df_read['has_dgc'][2] == 0.)
+
+    def test_iter_everything_from_plane(self):
+        _write_small_nwb(self.nwb_path)
+
+        roi_ns = ['roi_0004', 'roi_0001', 'roi_0002', 'roi_0005'] # unsorted and non-contiguous
+        with h5py.File(self.nwb_path, 'r') as nwb_f:
+            results = list(dt.iter_everything_from_plane(nwb_f=nwb_f, plane_n='plane0', roi_ns=roi_ns, batch_size=3))
+            assert ([roi_n for roi_n, _ in results] == roi_ns)
+
+            for roi_n, outputs in results:
+                outputs_single = dt.get_everything_from_roi(nwb_f=nwb_f, plane_n='plane0', roi_n=roi_n)
+                assert (len(outputs) == len(outputs_single))
+
+                roi_properties, roi_properties_single = outputs[0], outputs_single[0]
+                assert (roi_properties['roi_n'] == roi_n)
+                assert (set(roi_properties.keys()) == set(roi_properties_single.keys()))
+                for key, value in roi_properties.items():
+                    if isinstance(value, float) and np.isnan(value):
+                        assert (np.isnan(roi_properties_single[key]))
+                    else:
+                        assert (value == roi_properties_single[key])
+
+                assert (np.array_equal(outputs[1].get_weighted_mask(), outputs_single[1].get_weighted_mask()))
+                assert (np.array_equal(outputs[2], outputs_single[2]))  # trace
+                for matrix, matrix_single in zip(outputs[7]['matrix'], outputs_single[7]['matrix']):
+                    assert (np.array_equal(matrix, matrix_single))
+
+
+if __name__ == '__main__':
+    unittest.main()
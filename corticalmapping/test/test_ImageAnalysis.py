@@ -30,6 +30,44 @@ class TestImageAnalysis(unittest.TestCase):
         trace4 = ia.get_trace(mov, mask4, maskMode='weightedNan')
         assert(trace4[2] == 58)
 
+    def test_get_trace_binaryslicer4(self):
+        mov = np.random.rand(50, 8, 8)
+
+        mask1 = np.zeros((8, 8)); mask1[2:4, 3:6] = 1
+        mask2 = np.zeros((8, 8)); mask2[:] = np.nan; mask2[5, 5] = 1; mask2[1, 6] = 1
+        mask3 = np.zeros((8, 8)); mask3[4:7, 0:3] = np.random.rand(3, 3)
+
+        masks = {'mask1': mask1, 'mask3': ia.WeightedROI(mask3), 'mask4': ia.ROI(mask1)}
+        traces = ia.get_trace_binaryslicer4(mov, masks, mask_mode='binary', loading_frame_num=7)
+        assert (np.allclose(traces['trace_mask1'], ia.get_trace(mov, mask1, maskMode='binary')))
+        assert (np.allclose(traces['trace_mask3'], ia.get_trace(mov, mask3, maskMode='weighted')))
+        assert (np.allclose(traces['trace_mask4'], ia.get_trace(mov, mask1, maskMode='binary')))
+
+        traces = ia.get_trace_binaryslicer4(mov, {'mask2': mask2}, mask_mode='binaryNan', loading_frame_num=50)
+        assert (np.allclose(traces['trace_mask2'], ia.get_trace(mov, mask2, maskMode='binaryNan')))
+
+    def test_get_average_movies(self):
+        mov = np.random.rand(100, 4, 5)
+        frameTS = np.arange(100) * 0.1
+        onsetTimes = {'a': np.arange(11) * 0.9 + 0.02, 'b': np.arange(12) * 0.6 + 0.33}
+        chunkDurs = {'a': 1.0, 'b': 2.3}
+        aveMovs, ns = ia.get_average_movies(mov, frameTS, onsetTimes, chunkDurs, loading_frame_num=7, verbose=False)
+        for key in ['a', 'b']:
+            aveMov, n = ia.get_average_movie(mov, frameTS, onsetTimes[key], chunkDurs[key], isReturnN=True)
+            assert (n == ns[key])
+            assert (np.allclose(aveMov, aveMovs[key]))
+
+    def test_linear_regress_multi(self):
+        import scipy.stats as stats
+        x = np.random.rand(50)
+        ys = np.random.rand(50, 6) + x[:, None] * np.arange(6)
+        ys[:, 0] = 1.
+        slopes, intercepts, r_values, p_values = ia.linear_regress_multi(x, ys, is_return_p=True)
+        for i in range(ys.shape[1]):
+            slope, intercept, r_value, p_value, _ = stats.linregress(x, ys[:, i])
+            assert (np.allclose([slopes[i], intercepts[i], r_values[i]], [slope, intercept, r_value]))
+            assert (np.allclose(p_values[i], p_value))
+
     def test_ROI_binary_overlap(self):
         roi1 = np.zeros((10, 10))
         roi1[4:8, 3:7] = 1
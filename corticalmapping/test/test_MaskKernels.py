@@ -0,0 +1,45 @@
+__author__ = 'junz'
+
+import unittest
+import numpy as np
+import corticalmapping.core.MaskKernels as mk
+
+
+class TestMaskKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.map_x, self.map_y = np.meshgrid(np.arange(-10., 10.), np.arange(-5., 5.))
+
+    def test_oval_mask(self):
+        map_x, map_y = mk.get_pixel_map((9, 11))
+        mask = mk.oval_mask(map_x, map_y, center=(5, 4), width=6, height=2)
+        assert (mask.shape == (9, 11))
+        assert (np.array_equal(np.where(mask[4])[0], [2, 3, 4, 5, 6, 7, 8]))
+        assert (np.array_equal(np.where(mask[:, 5])[0], [3, 4, 5]))
+
+    def test_warped_square_mask(self):
+        mask = mk.warped_square_mask(self.map_x, self.map_y, center=(0., 0.), width=4., height=2., ori=0.)
+        # at ori 0, width is measured from the horizontal line through center
+        assert (np.array_equal(np.unique(self.map_y[mask]), [-2., -1., 0., 1., 2.]))
+        assert (np.array_equal(np.unique(self.map_x[mask]), [-1., 0., 1.]))
+        self.assertRaises(ValueError, mk.warped_square_mask, self.map_x, self.map_y, (0., 0.), 4., 2., 200.)
+
+    def test_MaskCache(self):
+        cache = mk.MaskCache(self.map_x, self.map_y, cache_size=2)
+        mask1 = cache.circle_mask((1., 2.), 3.)
+        assert (np.array_equal(mask1, mk.circle_mask(self.map_x, self.map_y, (1., 2.), 3.)))
+        assert (cache.circle_mask(np.array([1., 2.]), 3.) is mask1)
+
+        grating = cache.get_grating(ori=0.3, spatial_freq=0.2, center=(1., 2.), phase=0.5, contrast=0.8)
+        distance = mk.grating_distance(self.map_x, self.map_y, ori=0.3, center=(1., 2.))
+        assert (np.array_equal(grating, mk.get_grating_from_distance(distance, spatial_freq=0.2, phase=0.5,
+                                                                    contrast=0.8)))
+        assert (len(cache) == 2)
+
+        _ = cache.oval_mask((0., 0.), 4., 2.)
+        assert (len(cache) == 2)
+        assert (cache.circle_mask((1., 2.), 3.) is not mask1)
+
+
+if __name__ == '__main__':
+    unittest.main()
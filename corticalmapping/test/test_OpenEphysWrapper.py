@@ -0,0 +1,62 @@
+import os
+import unittest
+import numpy as np
+import corticalmapping.ephys.OpenEphysWrapper as oew
+
+curr_folder = os.path.dirname(os.path.realpath(__file__))
+test_data_folder = os.path.join(curr_folder, 'data')
+
+
+def _write_continuous_file(file_path, sample_nums, first_timestamp=3000, sample_rate=30000., bit_volts=0.195):
+    """
+    write a small .continuous file, one record for each element of sample_nums (the number of samples written in
+    the 'sample_num' field of each record, the record itself always has oew.oe.SAMPLES_PER_RECORD samples)
+    """
+
+    header = 'header.format = \'Open Ephys Data Format\';\nheader.sampleRate = {};\nheader.bitVolts = {};\n'\
+        .format(sample_rate, bit_volts)
+    header = header + ' ' * (oew.oe.NUM_HEADER_BYTES - len(header))
+
+    records = np.zeros(len(sample_nums), dtype=oew.CONTINUOUS_RECORD_DTYPE)
+    records['timestamp'] = first_timestamp + np.arange(len(sample_nums)) * oew.oe.SAMPLES_PER_RECORD
+    records['sample_num'] = sample_nums
+    records['samples'] = np.arange(len(sample_nums) * oew.oe.SAMPLES_PER_RECORD).reshape(len(sample_nums), -1)
+    records['marker'] = oew.oe.RECORD_MARKER
+
+    with open(file_path, 'wb') as f:
+        f.write(header.encode())
+        records.tofile(f)
+
+
+class TestOpenEphysWrapper(unittest.TestCase):
+
+    def setUp(self):
+        self.file_path = os.path.join(test_data_folder, 'test_OpenEphysWrapper.continuous')
+
+    def tearDown(self):
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def test_load_continuous(self):
+        spr = oew.oe.SAMPLES_PER_RECORD
+        _write_continuous_file(self.file_path, sample_nums=[spr, spr, 10, spr])
+        header, samples = oew.load_continuous(self.file_path, dtype=np.int16)
+        assert (header['start_time'] == 0.1)
+        assert (np.array_equal(samples, np.arange(2 * spr)))
+
+    def test_load_continuous_bad_first_record(self):
+        spr = oew.oe.SAMPLES_PER_RECORD
+        _write_continuous_file(self.file_path, sample_nums=[10, spr, spr])
+
+        header, records = oew.get_continuous_records(self.file_path)
+        assert (len(records) == 0)
+        assert (header['start_time'] == 0.1)
+
+        header, samples, timestamps = oew.load_continuous(self.file_path, is_return_timestamps=True)
+        assert (samples.shape == (0,))
+        assert (samples.dtype == np.float32)
+        assert (timestamps.shape == (0,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -127,6 +127,40 @@ def test_SpatialTemporalReceptiveField_shrink():
     STRF.shrink(None,[0,20])
     assert(np.array_equal(np.unique(np.array(STRF.get_locations())[:, 1]), np.array([0., 5., 10., 15., 20.])))
 
+def test_DenseSpatialTemporalReceptiveField():
+    # probes in sorted order, SpatialTemporalReceptiveField._sort_index() relies on positional index
+    locations = [[alt, azi] for alt in np.arange(5) * 5. for azi in np.arange(6) * 5. for _ in range(2)]
+    signs = [-1, 1] * 30
+    traces = [np.random.rand(np.random.randint(2, 5), 8) for _ in range(60)]
+    traces[3] = np.random.rand(1, 8)
+    time = np.arange(-3, 5) * 0.1
+    STRF = sca.SpatialTemporalReceptiveField(locations, signs, traces, time)
+    DSTRF = sca.DenseSpatialTemporalReceptiveField(locations, signs, traces, time)
+
+    assert(DSTRF.get_probe_num() == 60)
+    for dense_map, old_map in zip(DSTRF.get_amplitude_map(), STRF.get_amplitude_map()):
+        assert(np.allclose(dense_map, old_map, equal_nan=True))
+    for dense_map, old_map in zip(DSTRF.get_zscore_map(), STRF.get_zscore_map()):
+        assert(np.allclose(dense_map, old_map, rtol=1e-5, atol=1e-5, equal_nan=True))
+
+    STRF2 = DSTRF.to_strf()
+    assert(np.array_equal(STRF2.data['traces'][0], STRF.data['traces'][0]))
+
+    DSTRF2 = sca.DenseSpatialTemporalReceptiveField(locations[:4] * 2, signs[:4] * 2, traces[:8], time)
+    DSTRF2.merge_duplication()
+    assert(DSTRF2.get_probe_num() == 4)
+    assert(np.array_equal(DSTRF2.trial_nums, [len(traces[i]) + len(traces[i + 4]) for i in range(4)]))
+
+    if os.path.isfile(testH5Path):os.remove(testH5Path)
+    testFile = h5py.File(testH5Path)
+    DSTRF.to_h5_group(testFile.create_group('dense_spatial_temporal_receptive_field'))
+    testFile.close()
+    h5File = h5py.File(testH5Path)
+    DSTRF3 = sca.DenseSpatialTemporalReceptiveField.from_h5_group(h5File['dense_spatial_temporal_receptive_field'])
+    h5File.close()
+    assert(np.array_equal(DSTRF3.trial_nums, DSTRF.trial_nums))
+    assert(np.allclose(DSTRF3.traces, DSTRF.traces, equal_nan=True))
+
 def test_SpatialReceptiveField():
     SRF = sca.SpatialReceptiveField(np.arange(9).reshape((3,3)),np.arange(3),np.arange(3))
     assert(np.array_equal(SRF.weights,np.arange(1,9)))
@@ -141,6 +175,39 @@ def test_SpatialReceptiveField_interpolate():
     SRF.interpolate(5)
     assert(SRF.get_weighted_mask().shape == (20, 20))
 
+def test_DriftingGratingResponseMatrix():
+    import pandas as pd
+    sta_ts = np.arange(-5, 10) * 0.1
+    dgcrm = pd.DataFrame([], columns=['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad', 'onset_ts', 'matrix'])
+    for condi_i, (sf, dire, trial_num) in enumerate([(0., 0, 4), (0.04, 0, 3), (0.04, 90, 5), (0.08, 0, 1)]):
+        dgcrm.loc[condi_i] = [0., 0., sf, 2. if sf else 0., dire, 0.8 if sf else 0., 20 if sf else 0,
+                              np.arange(trial_num, dtype=np.float64), np.random.rand(trial_num, len(sta_ts)) + 1.]
+    dgcrm = sca.DriftingGratingResponseMatrix(sta_ts=sta_ts, trace_type='f', data=dgcrm)
+
+    baseline_ind = np.logical_and(sta_ts > -0.5, sta_ts <= 0.)
+    response_ind = np.logical_and(sta_ts > 0., sta_ts <= 0.5)
+
+    dgcrm_df = dgcrm.get_df_response_matrix(baseline_win=(-0.5, 0.))
+    assert(dgcrm_df.trace_type == 'f_df')
+    for matrix, matrix_df in zip(dgcrm['matrix'], dgcrm_df['matrix']):
+        assert(matrix_df.shape == matrix.shape)
+        assert(np.allclose(matrix_df, matrix - np.mean(matrix[:, baseline_ind], axis=1, keepdims=True)))
+
+    dgcrm_collapsed = dgcrm.collapse_trials()
+    assert(np.allclose(dgcrm_collapsed.loc[2, 'matrix'], np.mean(dgcrm.loc[2, 'matrix'], axis=0, keepdims=True)))
+
+    dgcrt = dgcrm.get_response_table(response_win=(0., 0.5))
+    responses = np.mean(dgcrm.loc[1, 'matrix'][:, response_ind], axis=1)
+    assert(np.isclose(dgcrt.loc[1, 'resp_mean'], np.mean(responses)))
+    assert(np.isclose(dgcrt.loc[1, 'resp_std'], np.std(responses)))
+    assert(np.isnan(dgcrt.loc[3, 'resp_std']))
+    assert(dgcrt.blank_condi_ind == 0)
+
+    dgcrt_df, _, _, _ = dgcrm.get_df_response_table(baseline_win=(-0.5, 0.), response_win=(0., 0.5))
+    matrix = dgcrm.loc[2, 'matrix']
+    assert(np.isclose(dgcrt_df.loc[2, 'resp_mean'],
+                      np.mean(matrix[:, response_ind]) - np.mean(matrix[:, baseline_ind])))
+
 def test_get_orientation_properties():
     import pandas as pd
     dires = np.arange(8) * 45
@@ -223,6 +290,88 @@ def test_get_orientation_properties():
 
     assert (peak_dire_raw == int(vs_dire_raw) == int(vs_dire_ele) == int(vs_dire_rec) == 90)
 
+def _write_sta_groups(f, roi_num=6, trace_type='sta_f'):
+    sta_ts = np.arange(-5, 10) * 0.1
+
+    strf_grp = f.create_group('strf')
+    strf_grp.attrs['sta_timestamps'] = sta_ts
+    for alt in [0., 10.]:
+        for azi in [0., 10., 20.]:
+            for sign in [-1, 1]:
+                probe_grp = strf_grp.create_group('alt{:06.1f}_azi{:06.1f}_sign{:02d}'.format(alt, azi, sign))
+                probe_grp[trace_type] = np.random.rand(roi_num, 3, len(sta_ts))
+                probe_grp['global_trigger_timestamps'] = np.arange(3) * 10.
+
+    dgc_grp = f.create_group('dgc')
+    dgc_grp.attrs['sta_timestamps'] = sta_ts
+    for sf, dire in [(0.04, 0), (0.04, 90), (0.08, 0), (0.08, 90)]:
+        condi_grp = dgc_grp.create_group(sca.get_dgc_condition_name(alt=0., azi=10., sf=sf, tf=2., dire=dire,
+                                                                    con=0.8, rad=20))
+        condi_grp.attrs['global_trigger_timestamps'] = np.arange(4) * 20.
+        condi_grp[trace_type] = np.random.rand(roi_num, 4, len(sta_ts))
+    return strf_grp, dgc_grp
+
+def test_read_roi_rows():
+    dset = np.arange(40).reshape((10, 4))
+    for roi_inds in [[2, 3, 4], [4, 2, 3], [7, 1, 7, 0]]:
+        assert(np.array_equal(sca._read_roi_rows(dset, roi_inds), dset[roi_inds]))
+        # sparse read
+        assert(np.array_equal(sca._read_roi_rows(dset, roi_inds, max_span_ratio=1.), dset[roi_inds]))
+
+    h5_path = os.path.join(testDataFolder, 'test_read_roi_rows.hdf5')
+    try:
+        with h5py.File(h5_path, 'w') as f:
+            f['data'] = dset
+            for roi_inds in [[2, 3, 4], [4, 2, 3], [7, 1, 7, 0]]:
+                assert(np.array_equal(sca._read_roi_rows(f['data'], roi_inds), dset[roi_inds]))
+                assert(np.array_equal(sca._read_roi_rows(f['data'], roi_inds, max_span_ratio=1.), dset[roi_inds]))
+    finally:
+        if os.path.isfile(h5_path):
+            os.remove(h5_path)
+
+def test_get_strfs_from_nwb():
+    h5_path = os.path.join(testDataFolder, 'test_get_strfs_from_nwb.hdf5')
+    try:
+        with h5py.File(h5_path, 'w') as f:
+            strf_grp, _ = _write_sta_groups(f)
+            roi_inds = [4, 1, 2, 5] # unsorted and non-contiguous
+            strfs = sca.get_strfs_from_nwb(strf_grp, roi_inds=roi_inds, trace_type='sta_f')
+            assert(len(strfs) == len(roi_inds))
+            for roi_ind, strf in zip(roi_inds, strfs):
+                strf_single = sca.get_strf_from_nwb(strf_grp, roi_ind=roi_ind, trace_type='sta_f')
+                assert(strf.name == strf_single.name == 'roi_{:04d}'.format(roi_ind))
+                assert(np.array_equal(strf.time, strf_single.time))
+                assert(np.array_equal(strf.get_probes(), strf_single.get_probes()))
+                for col in ['traces', 'trigger_ts']:
+                    for value, value_single in zip(strf.data[col], strf_single.data[col]):
+                        assert(np.array_equal(value, value_single))
+    finally:
+        if os.path.isfile(h5_path):
+            os.remove(h5_path)
+
+def test_get_dgc_response_matrices_from_nwb():
+    h5_path = os.path.join(testDataFolder, 'test_get_dgc_response_matrices_from_nwb.hdf5')
+    try:
+        with h5py.File(h5_path, 'w') as f:
+            _, dgc_grp = _write_sta_groups(f)
+            roi_inds = [4, 1, 2, 5] # unsorted and non-contiguous
+            dgcrms = sca.get_dgc_response_matrices_from_nwb(dgc_grp, roi_inds=roi_inds, trace_type='sta_f')
+            assert(len(dgcrms) == len(roi_inds))
+            for roi_ind, dgcrm in zip(roi_inds, dgcrms):
+                dgcrm_single = sca.get_dgc_response_matrix_from_nwb(dgc_grp, roi_ind=roi_ind, trace_type='sta_f')
+                assert(len(dgcrm) == len(dgcrm_single) == 4)
+                assert(np.array_equal(dgcrm.sta_ts, dgcrm_single.sta_ts))
+                assert(dgcrm.trace_type == dgcrm_single.trace_type == 'sta_f')
+                for col in ['alt', 'azi', 'sf', 'tf', 'dire', 'con', 'rad']:
+                    assert(np.array_equal(dgcrm[col], dgcrm_single[col]))
+                for col in ['onset_ts', 'matrix']:
+                    for value, value_single in zip(dgcrm[col], dgcrm_single[col]):
+                        assert(np.array_equal(value, value_single))
+                assert(np.array_equal(dgcrm.loc[1, 'matrix'], dgc_grp.values()[1]['sta_f'][roi_ind]))
+    finally:
+        if os.path.isfile(h5_path):
+            os.remove(h5_path)
+
 plt.show()
 
 if __name__ == '__main__':
@@ -49,4 +49,38 @@ class TestTimeIntervals(unittest.TestCase):
         assert (ti.is_contain([20., 26.]))
         assert (ti.is_contain([52.2, 54.]))
         assert (ti.is_contain([30., 36.]))
-        assert (ti.is_contain([15., 21.]))
\ No newline at end of file
+        assert (ti.is_contain([15., 21.]))
+
+    def test_union(self):
+        intervals1 = [[3., 7.], [13., 26.], [52.2, 55.5]]
+        intervals2 = [[1., 4.], [7., 9.], [30., 40.], [54., 60.]]
+        ti = TimeIntervals(intervals=intervals1).union(TimeIntervals(intervals=intervals2))
+        assert (np.array_equal(ti.get_intervals(), [[1., 9.], [13., 26.], [30., 40.], [52.2, 60.]]))
+
+    def test_is_contain_ts(self):
+        intervals = [[3., 7.], [13., 26.]]
+        ti = TimeIntervals(intervals=intervals)
+        ts = np.array([1., 3., 5., 7., 10., 13., 30.])
+        assert (np.array_equal(ti.is_contain_ts(ts), [False, True, True, True, False, True, False]))
+
+    def test_zero_length_intervals(self):
+        from corticalmapping.core.TimingAnalysis import merge_intervals
+        merged = merge_intervals([[13., 13.], [3., 7.], [7., 7.], [20., 19.]])
+        assert (np.array_equal(merged, [[3., 7.], [13., 13.]]))
+        ti = TimeIntervals(intervals=merged)
+        ts = np.array([2., 7., 12.9, 13., 13.1])
+        assert (np.array_equal(ti.is_contain_ts(ts), [False, True, False, True, False]))
+        self.assertRaises(ValueError, TimeIntervals, [[3., 7.], [7., 9.]])
+
+    def test_h5_group(self):
+        import h5py
+        ti = TimeIntervals(intervals=[[3., 7.], [13., 26.]])
+        test_path = os.path.join(curr_folder, 'data', 'test_TimeIntervals.hdf5')
+        test_f = h5py.File(test_path, 'w')
+        try:
+            ti.to_h5_group(test_f.create_group('intervals'))
+            ti2 = TimeIntervals.from_h5_group(test_f['intervals'])
+            assert (np.array_equal(ti.get_intervals(), ti2.get_intervals()))
+        finally:
+            test_f.close()
+            os.remove(test_path)
@@ -79,6 +79,20 @@ class TestTimingAnalysis(unittest.TestCase):
         assert (np.array_equal(cc, np.array([0., 0., 0., 0., 0., 2., 0., 0., 0., 0., 0., 0., 0., 0., 0., 2., 0., 0.,
                                              0., 0.])))
 
+    def test_discrete_cross_correlations(self):
+        units = [np.sort(np.random.rand(200) * 20.), np.sort(np.random.rand(50) * 20.), np.array([])]
+        probes = [np.random.rand(10) * 20., np.array([5.]), np.array([100.])]
+        t, ccgs, ns = ta.discrete_cross_correlations(probes, units, t_range=(-0.5, 1.), bins=15, is_return_n=True)
+        assert (ccgs.shape == (3, 3, 15))
+        assert (np.array_equal(ns[:, 2], [0, 0, 0]))
+        assert (np.array_equal(ns[2], [0, 0, 0]))
+        assert (not np.any(ccgs[2]))
+        for i in range(2):
+            for j in range(2):
+                t_ij, cc = ta.discrete_cross_correlation(probes[j], units[i], t_range=(-0.5, 1.), bins=15)
+                assert (np.array_equal(t, t_ij))
+                assert (np.allclose(ccgs[i, j], cc))
+
     def test_haramp(self):
         t = np.arange(1000) * 0.001
         trace = np.sin(t * 2 * 2 * np.pi) + 1
@@ -107,8 +121,43 @@ class TestTimingAnalysis(unittest.TestCase):
             assert(np.max(trace[intv[0]: intv[1]]) < 3.0)
 
 
+    def test_find_nearest_sorted(self):
+        trace = np.arange(10)
+        values = [1.4, 1.6, -1, 11, 2.5]
+        ind = ta.find_nearest_sorted(trace, values)
+        assert (np.array_equal(ind, [ta.find_nearest(trace, v) for v in values]))
+
+    def test_event_triggered_traces(self):
+        arr = np.arange(40).reshape((2, 20))
+        arr_ts = np.arange(20) * 0.1
+        trigger_ts = [0.05, 0.52, 1.49, 1.8]
+        sta, trigger_ind = ta.event_triggered_traces(arr, arr_ts, trigger_ts, frame_start=-1, frame_end=3,
+                                                     is_return_ind=True)
+        assert (sta.shape == (2, 2, 4))
+        assert (np.array_equal(trigger_ind, [1, 2]))
+        assert (np.array_equal(sta[0, 0], [4, 5, 6, 7]))
+        assert (np.array_equal(sta[1, 1], [34, 35, 36, 37]))
+        sta = ta.event_triggered_traces(arr[0], arr_ts, trigger_ts, frame_start=0, frame_end=2)
+        assert (np.array_equal(sta, [[0, 1], [5, 6], [15, 16], [18, 19]]))
+
+    def test_event_triggered_average_irregular(self):
+        ts_continuous = np.arange(100) * 0.1 + 0.05
+        continuous = np.arange(100, dtype=np.float64)
+        ts_event = np.array([0.1, 3., 5., 9.9])
+        eta, t, n, std = ta.event_triggered_average_irregular(ts_event, continuous, ts_continuous, t_range=(-0.5, 1.),
+                                                              bins=3)
+        assert (np.array_equal(n, [10, 10, 10]))
+        assert (np.allclose(eta, [37., 42., 47.]))
+        assert (np.allclose(std, np.sqrt(102.)))
+        eta2, _, n2, std2 = ta.event_triggered_average_irregular(ts_event, continuous, ts_continuous,
+                                                                 t_range=(-0.5, 1.), bins=3, block_size=7)
+        assert (np.array_equal(n, n2))
+        assert (np.allclose(eta, eta2))
+        assert (np.allclose(std, std2))
+
+
 if __name__ == '__main__':
     TestTimingAnalysis.test_get_onset_time_stamps()
     TestTimingAnalysis.test_get_burst()
     TestTimingAnalysis.test_find_nearest()
-    TestTimingAnalysis.test_get_event_with_pre_iei()
\ No newline at end of file
+    TestTimingAnalysis.test_get_event_with_pre_iei()